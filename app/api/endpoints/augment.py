@@ -1,5 +1,6 @@
 from fastapi import APIRouter, HTTPException, UploadFile, File, Form
 from fastapi.responses import JSONResponse, StreamingResponse
+from app.core.request_context import get_request_id
 from app.services.data_augmentation import (
     augment_images,
     rotate_images,
@@ -9,14 +10,69 @@ from app.services.data_augmentation import (
     adjust_saturation,
     adjust_hue,
     add_gaussian_noise,
-    apply_blur
+    apply_blur,
+    generate_variants,
+    run_augmentation_pipeline,
+    augment_dataset
 )
-import os
-import zipfile
-from io import BytesIO
+from app.services.output_store import output_store
+from app.utils.files_utils import is_safe_id, iter_zip
+from app.utils.responses import inline_response, validate_response_mode
+from typing import Optional
+import json
 
 router = APIRouter()
 
+def _respond(result, response_mode: str):
+    # "files" returns the saved filenames; "multipart" and "zip" stream the images, which never touched the disk
+    if response_mode != "files":
+        return inline_response(result, response_mode, "augmented_images")
+    return JSONResponse(content={"request_id": get_request_id(), "filenames": result}, status_code=200)
+
+@router.post("/pipeline/")
+async def augmentation_pipeline_endpoint(
+    files: list[UploadFile] = File(...),
+    operations: str = Form(...),
+    prefix: str = Form("augmented"),
+    response_mode: str = Form("files")
+):
+    """
+    Applies an ordered list of operations to every image in one pass.
+
+    `operations` is a JSON list such as
+    `[{"op": "rotate", "angle": 15}, {"op": "brightness", "factor": 1.2}, {"op": "blur", "radius": 1.5}]`.
+    Each image is decoded once and encoded once, however many operations are listed.
+    """
+    validate_response_mode(response_mode)
+    try:
+        result = await run_augmentation_pipeline(files, json.loads(operations), prefix, inline=response_mode != "files")
+        return _respond(result, response_mode)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/ingest/")
+async def augment_dataset_endpoint(
+    source: str = Form(...),
+    operations: str = Form(...),
+    prefix: str = Form("augmented"),
+    response_mode: str = Form("files")
+):
+    """
+    Applies an ordered list of operations to every image of a server-local directory, tar or zip archive.
+
+    `source` must lie under one of the server's allowed ingestion roots, and `operations` takes the same JSON
+    list as /pipeline/. The dataset is read a chunk at a time instead of being uploaded. With "files" only
+    counts and the first errors are returned; download the outputs with the returned `request_id`.
+    """
+    validate_response_mode(response_mode)
+    try:
+        result = await augment_dataset(source, json.loads(operations), prefix, inline=response_mode != "files")
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if response_mode != "files":
+        return inline_response(result, response_mode, "augmented_images")
+    return JSONResponse(content={"request_id": get_request_id(), **result.to_dict()}, status_code=200)
+
 @router.post("/default_augment/")
 async def augment_images_endpoint(
     files: list[UploadFile] = File(...),
@@ -30,23 +86,28 @@ async def augment_images_endpoint(
     gaussian_noise: bool = Form(False),
     noise_level: float = Form(25.0),
     blur: bool = Form(False),
-    blur_radius: float = Form(2.0)
+    blur_radius: float = Form(2.0),
+    response_mode: str = Form("files")
 ):
+    validate_response_mode(response_mode)
     try:
         result = await augment_images(
             files, rotate, flip_horizontal, flip_vertical,
             brightness, contrast, saturation, hue,
-            gaussian_noise, noise_level, blur, blur_radius
+            noise_level if gaussian_noise else 0.0,
+            blur_radius if blur else 0.0,
+            inline=response_mode != "files"
         )
-        return JSONResponse(content={"filenames": result}, status_code=200)
+        return _respond(result, response_mode)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/rotate/")
-async def rotate_images_endpoint(files: list[UploadFile] = File(...), rotate: int = Form(...)):
+async def rotate_images_endpoint(files: list[UploadFile] = File(...), rotate: int = Form(...), response_mode: str = Form("files")):
+    validate_response_mode(response_mode)
     try:
-        result = await rotate_images(files, rotate)
-        return JSONResponse(content={"filenames": result}, status_code=200)
+        result = await rotate_images(files, rotate, inline=response_mode != "files")
+        return _respond(result, response_mode)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -54,43 +115,49 @@ async def rotate_images_endpoint(files: list[UploadFile] = File(...), rotate: in
 async def flip_images_endpoint(
     files: list[UploadFile] = File(...),
     flip_horizontal: bool = Form(False),
-    flip_vertical: bool = Form(False)
+    flip_vertical: bool = Form(False),
+    response_mode: str = Form("files")
 ):
+    validate_response_mode(response_mode)
     try:
-        result = await flip_images(files, flip_horizontal, flip_vertical)
-        return JSONResponse(content={"filenames": result}, status_code=200)
+        result = await flip_images(files, flip_horizontal, flip_vertical, inline=response_mode != "files")
+        return _respond(result, response_mode)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/brightness/")
-async def adjust_brightness_endpoint(files: list[UploadFile] = File(...), brightness: float = Form(...)):
+async def adjust_brightness_endpoint(files: list[UploadFile] = File(...), brightness: float = Form(...), response_mode: str = Form("files")):
+    validate_response_mode(response_mode)
     try:
-        result = await adjust_brightness(files, brightness)
-        return JSONResponse(content={"filenames": result}, status_code=200)
+        result = await adjust_brightness(files, brightness, inline=response_mode != "files")
+        return _respond(result, response_mode)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/contrast/")
-async def adjust_contrast_endpoint(files: list[UploadFile] = File(...), contrast: float = Form(...)):
+async def adjust_contrast_endpoint(files: list[UploadFile] = File(...), contrast: float = Form(...), response_mode: str = Form("files")):
+    validate_response_mode(response_mode)
     try:
-        result = await adjust_contrast(files, contrast)
-        return JSONResponse(content={"filenames": result}, status_code=200)
+        result = await adjust_contrast(files, contrast, inline=response_mode != "files")
+        return _respond(result, response_mode)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/saturation/")
-async def adjust_saturation_endpoint(files: list[UploadFile] = File(...), saturation: float = Form(...)):
+async def adjust_saturation_endpoint(files: list[UploadFile] = File(...), saturation: float = Form(...), response_mode: str = Form("files")):
+    validate_response_mode(response_mode)
     try:
-        result = await adjust_saturation(files, saturation)
-        return JSONResponse(content={"filenames": result}, status_code=200)
+        result = await adjust_saturation(files, saturation, inline=response_mode != "files")
+        return _respond(result, response_mode)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/hue/")
-async def adjust_hue_endpoint(files: list[UploadFile] = File(...), hue: float = Form(...)):
+async def adjust_hue_endpoint(files: list[UploadFile] = File(...), hue: float = Form(...), response_mode: str = Form("files")):
+    validate_response_mode(response_mode)
     try:
-        result = await adjust_hue(files, hue)
-        return JSONResponse(content={"filenames": result}, status_code=200)
+        result = await adjust_hue(files, hue, inline=response_mode != "files")
+        return _respond(result, response_mode)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -98,11 +165,13 @@ async def adjust_hue_endpoint(files: list[UploadFile] = File(...), hue: float =
 async def add_gaussian_noise_endpoint(
     files: list[UploadFile] = File(...),
     gaussian_noise: bool = Form(...),
-    noise_level: float = Form(25.0)
+    noise_level: float = Form(25.0),
+    response_mode: str = Form("files")
 ):
+    validate_response_mode(response_mode)
     try:
-        result = await add_gaussian_noise(files, gaussian_noise, noise_level)
-        return JSONResponse(content={"filenames": result}, status_code=200)
+        result = await add_gaussian_noise(files, noise_level if gaussian_noise else 0.0, inline=response_mode != "files")
+        return _respond(result, response_mode)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -110,37 +179,65 @@ async def add_gaussian_noise_endpoint(
 async def apply_blur_endpoint(
     files: list[UploadFile] = File(...),
     blur: bool = Form(False),
-    blur_radius: float = Form(2.0)
+    blur_radius: float = Form(2.0),
+    response_mode: str = Form("files")
 ):
+    validate_response_mode(response_mode)
     try:
-        result = await apply_blur(files, blur, blur_radius)
-        return JSONResponse(content={"filenames": result}, status_code=200)
+        result = await apply_blur(files, blur_radius if blur else 0.0, inline=response_mode != "files")
+        return _respond(result, response_mode)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@router.get("/download/")
-async def download_augmented_images():
+@router.post("/variants/")
+async def generate_variants_endpoint(
+    files: list[UploadFile] = File(...),
+    count: int = Form(...),
+    ranges: str = Form("{}"),
+    seed: Optional[int] = Form(None),
+    response_mode: str = Form("zip")
+):
+    """
+    Generates `count` randomized variants of every image from a single decode.
+
+    `ranges` is a JSON object such as
+    `{"rotate": [-15, 15], "brightness": [0.8, 1.2], "hue": [-0.05, 0.05], "noise": [0, 10], "flip_horizontal": 0.5}`.
+    Ranges are sampled uniformly and flips are applied with the given probability. The same `seed` and
+    images always give the same variants; the seed used is returned in the `X-Augment-Seed` header, and
+    in the body for `response_mode=files`. Inline modes stream variants out as they are rendered.
+    """
+    validate_response_mode(response_mode)
     try:
-        output_dir = "/outputs/augmented_images"
-        if not os.path.exists(output_dir) or not os.listdir(output_dir):
-            raise HTTPException(status_code=404, detail="No images found to download")
+        seed, result = await generate_variants(files, count, json.loads(ranges), seed, inline=response_mode != "files")
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        # Create a BytesIO object to hold the zip file in memory
-        zip_buffer = BytesIO()
+    if response_mode != "files":
+        response = inline_response(result, response_mode, "augmented_variants")
+        response.headers["X-Augment-Seed"] = str(seed)
+        return response
+    filenames, errors = result
+    return JSONResponse(
+        content={"request_id": get_request_id(), "seed": seed, "filenames": filenames, "errors": errors},
+        headers={"X-Augment-Seed": str(seed)},
+        status_code=200
+    )
 
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            for root, _, files in os.walk(output_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    zip_file.write(file_path, os.path.relpath(file_path, output_dir))
+@router.get("/download/")
+async def download_augmented_images(request_id: Optional[str] = None):
+    """
+    Streams the augmented images as a ZIP archive while it is being generated.
 
-        zip_buffer.seek(0)  # Move to the beginning of the BytesIO object
+    Pass the `request_id` returned by an augmentation endpoint to download only that request's outputs.
+    """
+    if request_id is not None and not is_safe_id(request_id):
+        raise HTTPException(status_code=400, detail="Invalid request_id")
+    if not output_store.has_files("augmented", request_id):
+        raise HTTPException(status_code=404, detail="No images found to download")
 
-        return StreamingResponse(
-            zip_buffer,
-            media_type="application/zip",
-            headers={"Content-Disposition": "attachment; filename=augmented_images.zip"}
-        )
-        
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))    
+    filename = f"augmented_images_{request_id}.zip" if request_id else "augmented_images.zip"
+    return StreamingResponse(
+        iter_zip(output_store.files("augmented", request_id)),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
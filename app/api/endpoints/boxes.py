@@ -5,7 +5,21 @@ This API allows users to generate bounding boxes for uploaded images and downloa
 
 Endpoints:
     - POST /api/boxes/generate: Generates bounding boxes for a list of uploaded images.
+    - POST /api/boxes/generate/stream: Streams each image's bounding boxes as NDJSON or Server-Sent Events as soon as it is ready.
     - GET /api/boxes/download: Downloads the bounding boxes data in an Excel file.
+    - POST /api/boxes/tasks: Runs several Florence-2 tasks, e.g. `<OD>` and `<CAPTION>`, on each image with one vision encoding.
+    - POST /api/boxes/jobs: Submits a background detection job and returns its id at once.
+    - POST /api/boxes/jobs/ingest: Submits a background detection job over a server-local directory, tar or zip archive.
+    - GET /api/boxes/jobs/{job_id}: Reports a job's status and how many images are done out of the total.
+    - GET /api/boxes/jobs/{job_id}/download: Downloads the results file of a completed job.
+    - POST /api/boxes/augment: Detects once on each original image and carries the boxes through an augmentation pipeline analytically.
+    - GET /api/boxes/profiles: Lists the generation profiles and their observed latency.
+    - POST /api/boxes/profiles/evaluate: Measures each profile's latency and agreement with the baseline profile on uploaded images.
+    - GET /api/boxes/cache/stats: Reports the detection cache size and hit/miss counters.
+    - GET /api/boxes/near-duplicates/stats: Reports the size and hits of the near-duplicate index.
+    - DELETE /api/boxes/near-duplicates: Clears the near-duplicate index.
+    - DELETE /api/boxes/cache: Clears the detection cache.
+    - DELETE /api/boxes/cache/{image_hash}: Removes the cached results of one image, identified by the SHA-256 of its bytes.
 
 Imports:
     - fastapi: Provides the necessary classes and functions for building the API.
@@ -18,10 +32,21 @@ Imports:
 """
 
 
-from fastapi import APIRouter, UploadFile, File, HTTPException
+import json
+import re
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Query
 from fastapi.responses import FileResponse
-from app.services.bounding_boxes import process_images, generate_excel
-from typing import List
+from app.services.bounding_boxes import (
+    answer_to_rows, process_images, process_tasks, stream_detections, generate_excel, evaluate_profiles
+)
+from app.services.detection_cache import detection_cache
+from app.services.detection_jobs import job_manager
+from app.services.exporters import get_writer_class
+from app.services.generation_profiles import GENERATION_PROFILES, available_profiles, profile_latency
+from app.services.labelled_augmentation import detect_and_augment
+from app.services.near_duplicates import near_duplicate_index
+from app.utils.responses import stream_response, validate_stream_format
+from typing import List, Optional
 
 
 # Define the API router
@@ -29,28 +54,82 @@ router = APIRouter()
 
 
 @router.post("/generate")
-async def generate_boxes(files: List[UploadFile] = File(...)):
+async def generate_boxes(
+    files: List[UploadFile] = File(...),
+    profile: Optional[str] = Query(None),
+    dedupe: Optional[bool] = Query(None)
+):
     """
     Generate bounding boxes for a list of uploaded images.
 
     Parameters:
         files (List[UploadFile]): A list of uploaded image files.
+        profile (Optional[str]): The generation profile, e.g. "fast" or "accurate". Defaults to the configured default profile.
+        dedupe (Optional[bool]): Whether near-duplicate images reuse each other's boxes. Defaults to `NEAR_DUPLICATE_ENABLED`.
 
     Returns:
-        dict: A dictionary containing a message indicating that the bounding boxes are generated and the filename of the generated Excel file.
+        dict: A dictionary containing a message indicating that the bounding boxes are generated, the bounding box rows,
+        and the images whose boxes were reused from a near-duplicate.
+
+    Raises:
+        HTTPException: If the generation profile is unknown.
     """
-    data = await process_images(files)
-    return {"message": "Bounding boxes are generated.", "excel_filename": data}
+    try:
+        data, deduplicated = await process_images(files, profile, dedupe)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"message": "Bounding boxes are generated.", "excel_filename": data, "deduplicated": deduplicated}
 
 
 
+@router.post("/generate/stream")
+async def stream_boxes(
+    files: List[UploadFile] = File(...),
+    profile: Optional[str] = Query(None),
+    format: str = Query("ndjson")
+):
+    """
+    Generate bounding boxes for a list of uploaded images and stream each image's boxes as soon as they are ready.
+
+    Parameters:
+        files (List[UploadFile]): A list of uploaded image files.
+        profile (Optional[str]): The generation profile. Defaults to the configured default profile.
+        format (str): "ndjson" for one JSON object per line, "sse" for Server-Sent Events.
+
+    Returns:
+        StreamingResponse: In completion order, a "result" event per image with its upload index, name and box rows,
+        an "error" event per image that failed, and a final "done" event with the counts.
+
+    Raises:
+        HTTPException: If the generation profile or the format is unknown.
+    """
+    validate_stream_format(format)
+    try:
+        detections = await stream_detections(files, profile)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def events():
+        errors = 0
+        async for index, image_name, result in detections:
+            if isinstance(result, Exception):
+                errors += 1
+                yield "error", {"index": index, "image_name": image_name, "error": str(result)}
+            else:
+                yield "result", {"index": index, "image_name": image_name, "rows": answer_to_rows(image_name, result)}
+        yield "done", {"images": len(files), "errors": errors}
+
+    return stream_response(events(), format)
+
+
 @router.post("/generate_excel")
-async def generate_boxes(files: List[UploadFile] = File(...)):
+async def generate_boxes(files: List[UploadFile] = File(...), profile: Optional[str] = Query(None)):
     """
     Generate bounding boxes for a list of uploaded images and save them to an Excel file.
 
     Parameters:
         files (List[UploadFile]): A list of uploaded image files.
+        profile (Optional[str]): The generation profile, e.g. "fast" or "accurate". Defaults to the configured default profile.
 
     Returns:
         dict: A dictionary containing a message indicating that the bounding boxes are generated and the filename of the generated Excel file.
@@ -61,8 +140,10 @@ async def generate_boxes(files: List[UploadFile] = File(...)):
     """
     excel_filename = "bounding_boxes.xlsx"
     try:
-        await generate_excel(files, excel_filename)
+        await generate_excel(files, excel_filename, profile)
         return {"message": "Bounding boxes generated and saved to Excel.", "excel_filename": excel_filename}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -82,3 +163,221 @@ async def download_boxes():
     excel_filename = "bounding_boxes.xlsx"
     return FileResponse(path=excel_filename, filename=excel_filename, media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 
+
+@router.post("/tasks")
+async def run_tasks(
+    files: List[UploadFile] = File(...),
+    tasks: List[str] = Query(["<OD>"]),
+    profile: Optional[str] = Query(None)
+):
+    """
+    Runs several Florence-2 tasks on each uploaded image, encoding every image only once.
+
+    Parameters:
+        files (List[UploadFile]): A list of uploaded image files.
+        tasks (List[str]): The task prompts, repeated, e.g. `?tasks=<OD>&tasks=<CAPTION>&tasks=<DENSE_REGION_CAPTION>`.
+        profile (Optional[str]): The generation profile. Defaults to the configured default profile.
+
+    Returns:
+        dict: Per image, the parsed answer of each task keyed by task prompt.
+
+    Raises:
+        HTTPException: If a task is not supported or the generation profile is unknown.
+    """
+    try:
+        results = await process_tasks(files, tasks, profile)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"tasks": list(dict.fromkeys(tasks)), "images": results}
+
+
+@router.post("/jobs", status_code=202)
+async def submit_job(files: List[UploadFile] = File(...), profile: Optional[str] = Query(None), format: str = Query("xlsx")):
+    """
+    Submit a background job that generates bounding boxes for a list of uploaded images.
+
+    Parameters:
+        files (List[UploadFile]): A list of uploaded image files.
+        profile (Optional[str]): The generation profile. Defaults to the configured default profile.
+        format (str): The results file format: "xlsx", "csv" or "parquet".
+
+    Returns:
+        dict: The job id and its initial status. Poll GET /jobs/{job_id} for progress.
+
+    Raises:
+        HTTPException: If the generation profile or results format is unknown.
+    """
+    try:
+        job = await job_manager.submit(files, profile, format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"message": "Detection job submitted.", **job.to_dict()}
+
+
+@router.post("/jobs/ingest", status_code=202)
+async def submit_ingest_job(source: str = Query(...), profile: Optional[str] = Query(None), format: str = Query("xlsx")):
+    """
+    Submit a background job that generates bounding boxes for every image of a server-local dataset.
+
+    Parameters:
+        source (str): A directory, tar or zip archive under one of the server's allowed ingestion roots.
+        profile (Optional[str]): The generation profile. Defaults to the configured default profile.
+        format (str): The results file format: "xlsx", "csv" or "parquet".
+
+    Returns:
+        dict: The job id and its initial status. Poll GET /jobs/{job_id} for progress; the total grows as the
+        dataset is read.
+
+    Raises:
+        HTTPException: If the source may not be ingested, or the generation profile or results format is unknown.
+    """
+    try:
+        job = await job_manager.submit_source(source, profile, format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"message": "Detection job submitted.", **job.to_dict()}
+
+
+@router.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """
+    Report the status of a detection job.
+
+    Raises:
+        HTTPException: If the job does not exist.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+@router.get("/jobs/{job_id}/download")
+async def download_job(job_id: str):
+    """
+    Download the results file of a completed detection job.
+
+    Raises:
+        HTTPException: If the job does not exist or has not completed.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    result_path = job_manager.result_path(job)
+    if result_path is None:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    writer_class = get_writer_class(job.export_format)
+    return FileResponse(path=result_path, filename=f"bounding_boxes_{job_id}{writer_class.extension}", media_type=writer_class.media_type)
+
+
+@router.post("/augment")
+async def augment_with_boxes(
+    files: List[UploadFile] = File(...),
+    operations: str = Form(...),
+    prefix: str = Form("augmented"),
+    profile: Optional[str] = Query(None),
+    format: str = Query("csv")
+):
+    """
+    Detects objects once on each original image, applies an augmentation pipeline and maps the boxes onto the result.
+
+    Parameters:
+        files (List[UploadFile]): A list of uploaded image files.
+        operations (str): A JSON augmentation pipeline, e.g. `[{"op": "flip_horizontal"}, {"op": "rotate", "angle": 10}]`.
+            `rotate`, `flip_horizontal`, `flip_vertical`, `crop` and `resize` move the boxes; the other operations keep them.
+        prefix (str): The prefix of the augmented image filenames.
+        profile (Optional[str]): The generation profile to detect with. Defaults to the configured default profile.
+        format (str): The labels file format: "csv", "parquet" or "xlsx".
+
+    Returns:
+        dict: The request id, the augmented filenames, the labels filename and the transformed box rows.
+        The images and labels file download together from `/api/v1/outputs/{request_id}/download`.
+
+    Raises:
+        HTTPException: If the operations, the profile or the format are invalid.
+    """
+    try:
+        return await detect_and_augment(files, json.loads(operations), prefix, profile, format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/profiles")
+async def list_profiles():
+    """
+    Lists the available generation profiles with their settings and the per-image latency observed so far.
+    """
+    latency = profile_latency.report()
+    return {
+        name: {**GENERATION_PROFILES[name], "observed": latency.get(name)}
+        for name in available_profiles()
+    }
+
+
+@router.post("/profiles/evaluate")
+async def evaluate(files: List[UploadFile] = File(...), profiles: Optional[List[str]] = Query(None)):
+    """
+    Runs the uploaded images through each generation profile and reports its latency and its agreement with the baseline.
+
+    Parameters:
+        files (List[UploadFile]): A list of uploaded image files.
+        profiles (Optional[List[str]]): The profiles to evaluate. Defaults to every available profile.
+
+    Raises:
+        HTTPException: If a profile is unknown.
+    """
+    try:
+        return await evaluate_profiles(files, profiles)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/cache/stats")
+async def cache_stats():
+    """
+    Returns the detection cache size and hit/miss counters.
+    """
+    return detection_cache.stats()
+
+
+@router.delete("/cache")
+async def clear_cache():
+    """
+    Removes every entry from the detection cache.
+    """
+    removed = detection_cache.invalidate()
+    return {"message": "Detection cache cleared.", "removed": removed}
+
+
+@router.get("/near-duplicates/stats")
+async def near_duplicate_stats():
+    """
+    Returns the number of images in the near-duplicate index and how often it stood in for a detection.
+    """
+    return near_duplicate_index.stats()
+
+
+@router.delete("/near-duplicates")
+async def clear_near_duplicates():
+    """
+    Removes every image from the near-duplicate index.
+    """
+    removed = near_duplicate_index.clear()
+    return {"message": "Near-duplicate index cleared.", "removed": removed}
+
+
+@router.delete("/cache/{image_hash}")
+async def invalidate_cache(image_hash: str):
+    """
+    Removes the cached detection results of one image.
+
+    Parameters:
+        image_hash (str): The hex SHA-256 of the image bytes.
+
+    Raises:
+        HTTPException: If `image_hash` is not a hex SHA-256 digest.
+    """
+    if not re.fullmatch(r"[0-9a-fA-F]{64}", image_hash):
+        raise HTTPException(status_code=400, detail="image_hash must be a hex SHA-256 digest")
+    removed = detection_cache.invalidate(image_hash.lower())
+    return {"message": "Detection cache entries removed.", "removed": removed}
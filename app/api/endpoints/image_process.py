@@ -1,50 +1,97 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException
 from fastapi.responses import FileResponse, StreamingResponse
-from typing import List
+from typing import List, Optional
+from app.core.request_context import get_request_id
 from app.services.image_services import (
     resize_images, normalize_images, crop_images, rotate_flip_images,
-    adjust_color_images, reduce_noise_images, remove_background_images
+    adjust_color_images, reduce_noise_images, remove_background_images, ingest_images
 )
-import os
-import zipfile
-from io import BytesIO
+from app.services.output_store import output_store
+from app.utils.files_utils import is_safe_id, iter_zip
+from app.utils.responses import inline_response, validate_response_mode
+import asyncio
+import json
 
 router = APIRouter()
 
+# Every processing endpoint takes `response_mode`: "files" (default) saves the
+# outputs and returns their paths, while "multipart" and "zip" encode them
+# straight into the response body without touching the filesystem.
+
 @router.post("/resize")
-async def resize_endpoint(images: List[UploadFile] = File(...), width: int = 256, height: int = 256):
-    filepaths = await resize_images(images, width, height)
-    return {"message": "Images resized successfully", "filepaths": filepaths}
+async def resize_endpoint(images: List[UploadFile] = File(...), width: int = 256, height: int = 256, response_mode: str = "files"):
+    validate_response_mode(response_mode)
+    if response_mode != "files":
+        return inline_response(await resize_images(images, width, height, inline=True), response_mode, "resize")
+    filepaths, errors = await resize_images(images, width, height)
+    return {"message": "Images resized successfully", "request_id": get_request_id(), "filepaths": filepaths, "errors": errors}
 
 @router.post("/normalize")
-async def normalize_endpoint(images: List[UploadFile] = File(...)):
-    filepaths = await normalize_images(images)
-    return {"message": "Images normalized successfully", "filepaths": filepaths}
+async def normalize_endpoint(images: List[UploadFile] = File(...), response_mode: str = "files"):
+    validate_response_mode(response_mode)
+    if response_mode != "files":
+        return inline_response(await normalize_images(images, inline=True), response_mode, "normalize")
+    filepaths, errors = await normalize_images(images)
+    return {"message": "Images normalized successfully", "request_id": get_request_id(), "filepaths": filepaths, "errors": errors}
 
 @router.post("/crop")
-async def crop_endpoint(images: List[UploadFile] = File(...), x: int = 0, y: int = 0, width: int = 256, height: int = 256):
-    filepaths = await crop_images(images, x, y, width, height)
-    return {"message": "Images cropped successfully", "filepaths": filepaths}
+async def crop_endpoint(images: List[UploadFile] = File(...), x: int = 0, y: int = 0, width: int = 256, height: int = 256, response_mode: str = "files"):
+    validate_response_mode(response_mode)
+    if response_mode != "files":
+        return inline_response(await crop_images(images, x, y, width, height, inline=True), response_mode, "crop")
+    filepaths, errors = await crop_images(images, x, y, width, height)
+    return {"message": "Images cropped successfully", "request_id": get_request_id(), "filepaths": filepaths, "errors": errors}
 
 @router.post("/rotate-flip")
-async def rotate_flip_endpoint(images: List[UploadFile] = File(...), rotate_angle: int = 0, flip_code: int = 1):
-    filepaths = await rotate_flip_images(images, rotate_angle, flip_code)
-    return {"message": "Images rotated/flipped successfully", "filepaths": filepaths}
+async def rotate_flip_endpoint(images: List[UploadFile] = File(...), rotate_angle: int = 0, flip_code: int = 1, response_mode: str = "files"):
+    validate_response_mode(response_mode)
+    if response_mode != "files":
+        return inline_response(await rotate_flip_images(images, rotate_angle, flip_code, inline=True), response_mode, "rotate_flip")
+    filepaths, errors = await rotate_flip_images(images, rotate_angle, flip_code)
+    return {"message": "Images rotated/flipped successfully", "request_id": get_request_id(), "filepaths": filepaths, "errors": errors}
 
 @router.post("/color-adjust")
-async def color_adjust_endpoint(images: List[UploadFile] = File(...), brightness: int = 0, contrast: int = 0, saturation: int = 0):
-    filepaths = await adjust_color_images(images, brightness, contrast, saturation)
-    return {"message": "Images color-adjusted successfully", "filepaths": filepaths}
+async def color_adjust_endpoint(images: List[UploadFile] = File(...), brightness: int = 0, contrast: int = 0, saturation: int = 0, response_mode: str = "files"):
+    validate_response_mode(response_mode)
+    if response_mode != "files":
+        return inline_response(await adjust_color_images(images, brightness, contrast, saturation, inline=True), response_mode, "color_adjust")
+    filepaths, errors = await adjust_color_images(images, brightness, contrast, saturation)
+    return {"message": "Images color-adjusted successfully", "request_id": get_request_id(), "filepaths": filepaths, "errors": errors}
 
 @router.post("/noise-reduction")
-async def noise_reduction_endpoint(images: List[UploadFile] = File(...)):
-    filepaths = await reduce_noise_images(images)
-    return {"message": "Images noise-reduced successfully", "filepaths": filepaths}
+async def noise_reduction_endpoint(images: List[UploadFile] = File(...), response_mode: str = "files"):
+    validate_response_mode(response_mode)
+    if response_mode != "files":
+        return inline_response(await reduce_noise_images(images, inline=True), response_mode, "noise_reduction")
+    filepaths, errors = await reduce_noise_images(images)
+    return {"message": "Images noise-reduced successfully", "request_id": get_request_id(), "filepaths": filepaths, "errors": errors}
 
 @router.post("/background-removal")
-async def background_removal_endpoint(images: List[UploadFile] = File(...)):
-    filepaths = await remove_background_images(images)
-    return {"message": "Backgrounds removed from images successfully", "filepaths": filepaths}
+async def background_removal_endpoint(images: List[UploadFile] = File(...), response_mode: str = "files"):
+    validate_response_mode(response_mode)
+    if response_mode != "files":
+        return inline_response(await remove_background_images(images, inline=True), response_mode, "background_removal")
+    filepaths, errors = await remove_background_images(images)
+    return {"message": "Backgrounds removed from images successfully", "request_id": get_request_id(), "filepaths": filepaths, "errors": errors}
+
+@router.post("/ingest")
+async def ingest_endpoint(source: str, operation: str, params: str = "{}", response_mode: str = "files"):
+    """
+    Runs one operation on every image of a server-local directory, tar or zip archive instead of uploads.
+
+    `operation` names a processing endpoint, e.g. "resize", and `params` is a JSON object of its parameters,
+    e.g. `{"width": 512, "height": 512}`. The dataset is read and processed a chunk at a time, so memory
+    stays bounded whatever its size. With "files" only counts and the first errors are returned; download
+    the outputs with the returned `request_id`.
+    """
+    validate_response_mode(response_mode)
+    try:
+        result = await ingest_images(source, operation, json.loads(params), inline=response_mode != "files")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if response_mode != "files":
+        return inline_response(result, response_mode, f"ingest_{operation}")
+    return {"message": "Dataset processed successfully", "request_id": get_request_id(), **result.to_dict()}
 
 # @router.get("/download/{filename}")
 # async def download_file(filename: str):
@@ -54,43 +101,27 @@ async def background_removal_endpoint(images: List[UploadFile] = File(...)):
 #     return {"error": "File not found"}
 
 @router.get("/download/")
-async def download_augmented_images():
-    try:
-        output_dir = "outputs/processed_images"
-        if not os.path.exists(output_dir) or not os.listdir(output_dir):
-            raise HTTPException(status_code=404, detail="No images found to download")
-
-        # Create a BytesIO object to hold the zip file in memory
-        zip_buffer = BytesIO()
-
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            for root, _, files in os.walk(output_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    zip_file.write(file_path, os.path.relpath(file_path, output_dir))
-
-        zip_buffer.seek(0)  # Move to the beginning of the BytesIO object
-
-        return StreamingResponse(
-            zip_buffer,
-            media_type="application/zip",
-            headers={"Content-Disposition": "attachment; filename=processed_images.zip"}
-        )
-        
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))   
+async def download_augmented_images(request_id: Optional[str] = None):
+    """
+    Streams the processed images as a ZIP archive while it is being generated.
+
+    Pass the `request_id` returned by a processing endpoint to download only that request's outputs.
+    """
+    if request_id is not None and not is_safe_id(request_id):
+        raise HTTPException(status_code=400, detail="Invalid request_id")
+    if not output_store.has_files("processed", request_id):
+        raise HTTPException(status_code=404, detail="No images found to download")
+
+    filename = f"processed_images_{request_id}.zip" if request_id else "processed_images.zip"
+    return StreamingResponse(
+        iter_zip(output_store.files("processed", request_id)),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
 
 @router.get('/empty_outputdir/') 
 async def empty_outputdir():
-    try:
-        output_dir = 'outputs/processed_images'
-        images = os.listdir(output_dir)
-        if len(images) != 0:
-            for image in images: 
-                image_path = os.path.join(output_dir, image)
-                os.remove(image_path) 
-            return {"message": "All images deleted"}  
-        else:
-            return {"message": "No images found to delete"}  
-    except:
-        return {"message": "No images found to delete"}         
+    removed = await asyncio.to_thread(output_store.clear, "processed")
+    if removed:
+        return {"message": "All images deleted"}
+    return {"message": "No images found to delete"}
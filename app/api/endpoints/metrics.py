@@ -0,0 +1,25 @@
+"""
+This module contains the metrics endpoint.
+
+Endpoints:
+    - GET /metrics: Per-stage duration histograms, generated token counts, images processed and queue depths in the Prometheus text format.
+"""
+
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from app.services.metrics import registry
+
+
+# Define the API router
+router = APIRouter()
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@router.get("", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Renders every metric in the Prometheus text exposition format. Nothing is aggregated until this is called.
+    """
+    return PlainTextResponse(registry.render(), media_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,64 @@
+"""
+This module contains the endpoints for managing the detection model lifecycle.
+
+Endpoints:
+    - GET /api/v1/model/ready: Readiness probe; returns 200 once the model is loaded and 503 otherwise.
+    - GET /api/v1/model/status: Reports the model id, load state, device, dtype, idle time and inference backend.
+    - POST /api/v1/model/warmup: Loads the model if needed and runs a warmup generate.
+    - POST /api/v1/model/unload: Unloads the model and releases its memory.
+"""
+
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import JSONResponse
+from app.services.inference_backends import inference_backend, warmup as warmup_backend
+from app.services.inference_worker import inference_worker
+from app.services.model_manager import model_manager
+
+
+# Define the API router
+router = APIRouter()
+
+
+@router.get("/ready")
+async def ready():
+    """
+    Readiness probe for the detection model.
+
+    Returns:
+        JSONResponse: 200 with the model status if the model is loaded, 503 otherwise.
+    """
+    status_code = 200 if model_manager.is_ready else 503
+    return JSONResponse(content=model_manager.status(), status_code=status_code)
+
+
+@router.get("/status")
+async def status():
+    """
+    Returns the current state of the detection model and the inference backend running it.
+    """
+    return {**model_manager.status(), "backend": inference_backend.status()}
+
+
+@router.post("/warmup")
+async def warmup_endpoint():
+    """
+    Loads the detection model if needed and runs a short warmup generate.
+
+    Raises:
+        HTTPException: If the model fails to load or warm up.
+    """
+    try:
+        await inference_worker.run(warmup_backend)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"message": "Model is loaded and warmed up.", **model_manager.status()}
+
+
+@router.post("/unload")
+async def unload():
+    """
+    Unloads the detection model. It is loaded again on the next detection request.
+    """
+    await inference_worker.run(model_manager.unload)
+    return {"message": "Model unloaded.", **model_manager.status()}
@@ -0,0 +1,90 @@
+"""
+This module contains the endpoints for browsing and managing stored outputs.
+
+Every request or job that produces files has an entry in the output store, keyed by its request or job id.
+
+Endpoints:
+    - GET /api/v1/outputs: Lists stored requests, newest first, optionally filtered by kind.
+    - GET /api/v1/outputs/stats: Reports stored bytes per kind, the quota and the TTL.
+    - GET /api/v1/outputs/{request_id}: Lists the files one request produced.
+    - GET /api/v1/outputs/{request_id}/download: Streams one request's files as a ZIP archive.
+    - DELETE /api/v1/outputs/{request_id}: Deletes one request's files.
+"""
+
+
+import asyncio
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from typing import Optional
+from app.services.output_store import KIND_DIRS, output_store
+from app.utils.files_utils import iter_zip
+
+
+# Define the API router
+router = APIRouter()
+
+
+@router.get("")
+async def list_outputs(kind: Optional[str] = None):
+    """
+    Lists stored requests, newest first.
+
+    Parameters:
+        kind (Optional[str]): "processed", "augmented", "jobs" or "profiles" to list only that kind.
+    """
+    if kind is not None and kind not in KIND_DIRS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of: {', '.join(KIND_DIRS)}")
+    return output_store.list(kind)
+
+
+@router.get("/stats")
+async def output_stats():
+    """
+    Reports stored bytes per kind, the quota, the TTL and how many requests have been evicted.
+    """
+    return output_store.stats()
+
+
+@router.get("/{request_id}")
+async def get_output(request_id: str):
+    """
+    Lists the files one request produced.
+
+    Raises:
+        HTTPException: If the request has no stored outputs.
+    """
+    entry = output_store.get(request_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="No outputs found for this request")
+    return entry
+
+
+@router.get("/{request_id}/download")
+async def download_output(request_id: str):
+    """
+    Streams one request's files as a ZIP archive.
+
+    Raises:
+        HTTPException: If the request has no stored outputs.
+    """
+    entry = output_store.get(request_id)
+    if entry is None or not entry["files"]:
+        raise HTTPException(status_code=404, detail="No outputs found for this request")
+    return StreamingResponse(
+        iter_zip(output_store.files(entry["kind"], request_id)),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={request_id}.zip"}
+    )
+
+
+@router.delete("/{request_id}")
+async def delete_output(request_id: str):
+    """
+    Deletes one request's files.
+
+    Raises:
+        HTTPException: If the request has no stored outputs.
+    """
+    if not await asyncio.to_thread(output_store.delete, request_id):
+        raise HTTPException(status_code=404, detail="No outputs found for this request")
+    return {"message": "Outputs deleted."}
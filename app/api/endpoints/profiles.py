@@ -0,0 +1,96 @@
+"""
+This module contains the endpoints for retrieving request profiles.
+
+Requests are profiled when `PROFILING_ENABLED` is set and they carry the `X-Profile: 1` header or the
+`profile_request=1` query parameter. Their id is returned in the `X-Profile-ID` response header.
+
+Endpoints:
+    - GET /api/v1/profiles: Lists the stored profiles, newest first.
+    - GET /api/v1/profiles/{request_id}: Returns a profile's summary (wall time and profiled segments) and its files.
+    - GET /api/v1/profiles/{request_id}/files/{filename}: Downloads one artifact, e.g. `cpu.pstats`, `cpu.txt` or a torch trace.
+    - GET /api/v1/profiles/{request_id}/download: Streams all of a profile's artifacts as a ZIP archive.
+"""
+
+
+import json
+import os
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import FileResponse, StreamingResponse
+from app.core.config import PROFILING_ENABLED
+from app.services.output_store import output_store
+from app.services.request_profiler import PROFILE_ID_PREFIX, profile_id
+from app.utils.files_utils import is_safe_id, iter_zip
+
+
+# Define the API router
+router = APIRouter()
+
+
+def _get_entry(request_id: str) -> dict:
+    if not is_safe_id(request_id):
+        raise HTTPException(status_code=400, detail="Invalid request_id")
+    entry = output_store.get(profile_id(request_id), "profiles")
+    if entry is None or not entry["files"]:
+        raise HTTPException(status_code=404, detail="No profile found for this request")
+    return entry
+
+
+@router.get("")
+async def list_profiles():
+    """
+    Lists the stored profiles, newest first.
+    """
+    return {
+        "enabled": PROFILING_ENABLED,
+        "profiles": [
+            {**entry, "request_id": entry["request_id"][len(PROFILE_ID_PREFIX):]}
+            for entry in output_store.list("profiles")
+        ],
+    }
+
+
+@router.get("/{request_id}")
+async def get_profile(request_id: str):
+    """
+    Returns the summary of one request's profile and the names of its artifacts.
+
+    Raises:
+        HTTPException: If the request was not profiled or its profile has been evicted.
+    """
+    entry = _get_entry(request_id)
+    summary = None
+    if "summary.json" in entry["files"]:
+        with open(os.path.join(output_store.kind_dir("profiles"), entry["request_id"], "summary.json")) as f:
+            summary = json.load(f)
+    return {"request_id": request_id, "summary": summary, "files": entry["files"]}
+
+
+@router.get("/{request_id}/files/{filename}")
+async def download_profile_file(request_id: str, filename: str):
+    """
+    Downloads one profile artifact. `cpu.pstats` loads with `pstats` or snakeviz, `torch_trace_*.json` with chrome://tracing or Perfetto.
+
+    Raises:
+        HTTPException: If the profile or the file does not exist.
+    """
+    entry = _get_entry(request_id)
+    if filename not in entry["files"]:
+        raise HTTPException(status_code=404, detail="No such profile file")
+    path = os.path.join(output_store.kind_dir("profiles"), entry["request_id"], filename)
+    return FileResponse(path=path, filename=filename)
+
+
+@router.get("/{request_id}/download")
+async def download_profile(request_id: str):
+    """
+    Streams every artifact of one request's profile as a ZIP archive.
+
+    Raises:
+        HTTPException: If the request was not profiled or its profile has been evicted.
+    """
+    entry = _get_entry(request_id)
+    return StreamingResponse(
+        iter_zip(output_store.files("profiles", entry["request_id"])),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename=profile_{request_id}.zip"}
+    )
@@ -0,0 +1,118 @@
+import os
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    return os.getenv(name, str(default)).strip().lower() in ("1", "true", "yes", "on")
+
+
+# Detection micro-batching
+DETECTION_MAX_BATCH_SIZE = int(os.getenv("DETECTION_MAX_BATCH_SIZE", "8"))
+DETECTION_MAX_WAIT_MS = float(os.getenv("DETECTION_MAX_WAIT_MS", "10"))
+
+# Inference worker
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "4"))
+
+# Detection pipeline stages around the inference worker
+DETECTION_PREPROCESS_WORKERS = int(os.getenv("DETECTION_PREPROCESS_WORKERS", "2"))
+DETECTION_POSTPROCESS_WORKERS = int(os.getenv("DETECTION_POSTPROCESS_WORKERS", "1"))
+# Images between the start of decoding and the end of generation; bounds the preprocessed tensors held in memory
+DETECTION_MAX_IN_FLIGHT = int(os.getenv("DETECTION_MAX_IN_FLIGHT", "32"))
+
+# Detection model
+FLORENCE_MODEL_ID = os.getenv("FLORENCE_MODEL_ID", "microsoft/Florence-2-large-ft")
+# "auto" picks cuda:0 when available, otherwise cpu
+FLORENCE_DEVICE = os.getenv("FLORENCE_DEVICE", "auto")
+# "auto" picks float16 on cuda, otherwise float32
+FLORENCE_DTYPE = os.getenv("FLORENCE_DTYPE", "auto")
+# "module:attribute" of an object with `load_model(model_id, torch_dtype)` and `load_processor(model_id)`
+# used instead of transformers, e.g. "benchmarks.stub_model:loader"; empty loads from the Hugging Face hub
+FLORENCE_MODEL_LOADER = os.getenv("FLORENCE_MODEL_LOADER", "")
+MODEL_WARMUP_ON_STARTUP = _env_bool("MODEL_WARMUP_ON_STARTUP", False)
+# Inference backend running `generate`: "eager", "compile" (torch.compile) or "onnx" (ONNX Runtime)
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "eager")
+# torch.compile mode of the "compile" backend
+INFERENCE_COMPILE_MODE = os.getenv("INFERENCE_COMPILE_MODE", "default")
+# Where the "onnx" backend exports the model to, one subdirectory per model id; exported on first use if missing
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "models/onnx")
+# Unload the model after this many idle seconds; 0 keeps it loaded forever
+MODEL_IDLE_UNLOAD_SECONDS = float(os.getenv("MODEL_IDLE_UNLOAD_SECONDS", "0"))
+
+# Detection result cache
+DETECTION_CACHE_ENABLED = _env_bool("DETECTION_CACHE_ENABLED", True)
+DETECTION_CACHE_MAX_ENTRIES = int(os.getenv("DETECTION_CACHE_MAX_ENTRIES", "1024"))
+# Directory of the on-disk tier; empty disables it
+DETECTION_CACHE_DIR = os.getenv("DETECTION_CACHE_DIR", "outputs/cache/detections")
+# Total size of the on-disk tier above which the least recently used entries are evicted; 0 disables the limit
+DETECTION_CACHE_DISK_MAX_BYTES = int(os.getenv("DETECTION_CACHE_DISK_MAX_BYTES", str(1024 ** 3)))
+
+# Near-duplicate reuse: images whose perceptual hash is within NEAR_DUPLICATE_MAX_DISTANCE bits of an
+# already-detected image of the same aspect ratio reuse its boxes, rescaled; requests can override the default
+NEAR_DUPLICATE_ENABLED = _env_bool("NEAR_DUPLICATE_ENABLED", False)
+# "phash" (robust to re-encoding and resizing) or "dhash" (cheaper)
+NEAR_DUPLICATE_HASH = os.getenv("NEAR_DUPLICATE_HASH", "phash")
+NEAR_DUPLICATE_MAX_DISTANCE = int(os.getenv("NEAR_DUPLICATE_MAX_DISTANCE", "6"))
+NEAR_DUPLICATE_MAX_ENTRIES = int(os.getenv("NEAR_DUPLICATE_MAX_ENTRIES", "10000"))
+
+# Generation profiles
+DEFAULT_GENERATION_PROFILE = os.getenv("DEFAULT_GENERATION_PROFILE", "accurate")
+# Also build a dynamically int8-quantized copy of the model when it loads on CPU
+FLORENCE_INT8_QUANTIZE = _env_bool("FLORENCE_INT8_QUANTIZE", False)
+
+# Asynchronous detection jobs
+JOB_MAX_CONCURRENT = int(os.getenv("JOB_MAX_CONCURRENT", "2"))
+# Images of one job submitted to the batcher at a time
+JOB_MAX_IN_FLIGHT_IMAGES = int(os.getenv("JOB_MAX_IN_FLIGHT_IMAGES", "16"))
+# A job's status file is rewritten every this many images, and at least this often while it is queued or running
+JOB_STATUS_SAVE_EVERY = int(os.getenv("JOB_STATUS_SAVE_EVERY", "50"))
+JOB_STATUS_SAVE_INTERVAL_SECONDS = float(os.getenv("JOB_STATUS_SAVE_INTERVAL_SECONDS", "5"))
+
+# Bulk ingestion of server-local directories and tar/zip archives. Only paths under one of these
+# os.pathsep-separated roots can be ingested; empty disables ingestion
+INGEST_ROOTS = [os.path.realpath(root) for root in os.getenv("INGEST_ROOTS", "").split(os.pathsep) if root.strip()]
+# Images read ahead per chunk; at most two chunks are held in memory
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", "64"))
+# Larger files are reported as failed instead of being read
+INGEST_MAX_FILE_BYTES = int(os.getenv("INGEST_MAX_FILE_BYTES", str(64 * 1024 ** 2)))
+
+# Process pool for CPU-heavy image operations
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", str(os.cpu_count() or 1)))
+CPU_POOL_START_METHOD = os.getenv("CPU_POOL_START_METHOD", "spawn")
+
+# Output store
+OUTPUT_ROOT = os.getenv("OUTPUT_ROOT", "outputs")
+# Outputs older than this are evicted; 0 keeps them until the quota forces them out
+OUTPUT_TTL_SECONDS = float(os.getenv("OUTPUT_TTL_SECONDS", str(24 * 3600)))
+# Total size above which the oldest outputs are evicted; 0 disables the quota
+OUTPUT_QUOTA_BYTES = int(os.getenv("OUTPUT_QUOTA_BYTES", str(10 * 1024 ** 3)))
+OUTPUT_SWEEP_INTERVAL_SECONDS = float(os.getenv("OUTPUT_SWEEP_INTERVAL_SECONDS", "60"))
+
+# Decode JPEGs at 1/2, 1/4 or 1/8 scale when the output (or model input) is that much smaller
+REDUCED_DECODE_ENABLED = _env_bool("REDUCED_DECODE_ENABLED", True)
+# Side length Florence-2's processor resizes every image to
+FLORENCE_INPUT_SIZE = int(os.getenv("FLORENCE_INPUT_SIZE", "768"))
+
+# Multi-variant augmentation
+AUGMENT_MAX_VARIANTS = int(os.getenv("AUGMENT_MAX_VARIANTS", "1000"))
+# Pixels per vectorized chunk of variants; each pixel costs 12 bytes of float32 working memory
+AUGMENT_VARIANT_BATCH_PIXELS = int(os.getenv("AUGMENT_VARIANT_BATCH_PIXELS", str(16 * 1024 * 1024)))
+
+# Per-stage timings, counters and queue depths exposed on /metrics
+METRICS_ENABLED = _env_bool("METRICS_ENABLED", True)
+
+# Opt-in per-request profiling with the X-Profile header or the profile_request query parameter
+PROFILING_ENABLED = _env_bool("PROFILING_ENABLED", False)
+# Also run detection batches of profiled requests under the torch profiler
+PROFILING_TORCH = _env_bool("PROFILING_TORCH", True)
+
+# Admission control: concurrent requests and queued requests per endpoint class
+ADMISSION_ENABLED = _env_bool("ADMISSION_ENABLED", True)
+ADMISSION_DETECTION_CONCURRENCY = int(os.getenv("ADMISSION_DETECTION_CONCURRENCY", "4"))
+ADMISSION_DETECTION_QUEUE = int(os.getenv("ADMISSION_DETECTION_QUEUE", "16"))
+ADMISSION_HEAVY_CONCURRENCY = int(os.getenv("ADMISSION_HEAVY_CONCURRENCY", "2"))
+ADMISSION_HEAVY_QUEUE = int(os.getenv("ADMISSION_HEAVY_QUEUE", "8"))
+ADMISSION_LIGHT_CONCURRENCY = int(os.getenv("ADMISSION_LIGHT_CONCURRENCY", "16"))
+ADMISSION_LIGHT_QUEUE = int(os.getenv("ADMISSION_LIGHT_QUEUE", "64"))
+# Requests one client (X-Client-ID header, else its address) may have queued per class
+ADMISSION_MAX_QUEUED_PER_CLIENT = int(os.getenv("ADMISSION_MAX_QUEUED_PER_CLIENT", "4"))
+# Queued requests are rejected with 503 after this long; 0 waits indefinitely
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "30"))
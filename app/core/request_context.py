@@ -0,0 +1,38 @@
+"""
+Per-request identifiers.
+
+Every HTTP request gets a server-generated id, exposed to handlers and
+services through a context variable and returned in the `X-Request-ID`
+response header. Services use it to group the outputs a request produces.
+"""
+
+from contextvars import ContextVar
+from typing import Optional
+from uuid import uuid4
+
+from fastapi import Request
+
+
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+
+def get_request_id() -> str:
+    """
+    Returns the id of the current request, assigning a fresh one outside of HTTP requests.
+    """
+    request_id = request_id_var.get()
+    if request_id is None:
+        request_id = uuid4().hex
+        request_id_var.set(request_id)
+    return request_id
+
+
+async def request_id_middleware(request: Request, call_next):
+    request_id = uuid4().hex
+    token = request_id_var.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        request_id_var.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
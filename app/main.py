@@ -1,13 +1,60 @@
+import asyncio
 from fastapi import FastAPI
 from app.api.endpoints import (
-    augment, boxes, image_process
+    augment, boxes, image_process, metrics, model, outputs, profiles
 )
+from app.core.config import MODEL_WARMUP_ON_STARTUP, FLORENCE_INT8_QUANTIZE
+from app.core.request_context import request_id_middleware
+from app.services.admission import AdmissionMiddleware
+from app.services.cpu_pool import cpu_pool
+from app.services.detection_jobs import job_manager
+from app.services.inference_backends import warmup
+from app.services.inference_worker import inference_worker, postprocess_worker, preprocess_worker
+from app.services.model_manager import model_manager
+from app.services.output_store import output_store
+from app.services.request_profiler import request_profiling_middleware
 
 
 app = FastAPI()
+# The middleware added last runs first: request ids, then profiling, then admission control,
+# which holds each admitted request's slot until its response body has been sent
+app.add_middleware(AdmissionMiddleware)
+app.middleware("http")(request_profiling_middleware)
+app.middleware("http")(request_id_middleware)
 
 
+@app.on_event("startup")
+async def start_model_manager():
+    # The int8 variant is quantized at load time, which is too slow to do on a first request
+    if MODEL_WARMUP_ON_STARTUP or FLORENCE_INT8_QUANTIZE:
+        # Warm up in the background so the app accepts requests while the model loads
+        asyncio.create_task(inference_worker.run(warmup))
+    asyncio.create_task(model_manager.idle_unload_loop(inference_worker))
+
+
+@app.on_event("startup")
+async def start_output_eviction():
+    asyncio.create_task(output_store.sweep_loop())
+
+
+@app.on_event("startup")
+async def fail_interrupted_jobs():
+    # Jobs cut off by a restart would otherwise report "queued" or "running" forever
+    await asyncio.to_thread(job_manager.fail_interrupted)
+
+
+@app.on_event("shutdown")
+def shutdown_workers():
+    preprocess_worker.shutdown()
+    inference_worker.shutdown()
+    postprocess_worker.shutdown()
+    cpu_pool.shutdown()
+
 
 app.include_router(boxes.router, prefix="/api/v1/boxes", tags=["Bounding Boxes"])
 app.include_router(image_process.router, prefix="/api/v1/image-process", tags=["Image Processing"])
-app.include_router(augment.router, prefix="/api/v1/augment", tags=["Augmentation"])
\ No newline at end of file
+app.include_router(augment.router, prefix="/api/v1/augment", tags=["Augmentation"])
+app.include_router(model.router, prefix="/api/v1/model", tags=["Model"])
+app.include_router(outputs.router, prefix="/api/v1/outputs", tags=["Outputs"])
+app.include_router(profiles.router, prefix="/api/v1/profiles", tags=["Profiles"])
+app.include_router(metrics.router, prefix="/metrics", tags=["Metrics"])
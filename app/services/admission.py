@@ -0,0 +1,235 @@
+"""
+Admission control and backpressure per endpoint class.
+
+POST requests are classified as "detection" (anything reaching the model),
+"heavy" (seconds-per-image OpenCV operations) or "light" (other transforms
+and uploads). Each class admits a bounded number of concurrent requests and
+queues a bounded number more. Queued requests are served round-robin across
+clients, so one client's burst cannot starve the others. A request over its
+client's share gets 429, and one that finds the queue full or waits longer
+than `ADMISSION_QUEUE_TIMEOUT_SECONDS` gets 503. Both carry a `Retry-After`
+estimated from recent service times. Requests are rejected before their body
+is read, and hold their slot until the response body has been sent.
+"""
+
+import asyncio
+import json
+import math
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional
+
+from app.core.config import (
+    ADMISSION_ENABLED, ADMISSION_QUEUE_TIMEOUT_SECONDS, ADMISSION_MAX_QUEUED_PER_CLIENT,
+    ADMISSION_DETECTION_CONCURRENCY, ADMISSION_DETECTION_QUEUE,
+    ADMISSION_HEAVY_CONCURRENCY, ADMISSION_HEAVY_QUEUE,
+    ADMISSION_LIGHT_CONCURRENCY, ADMISSION_LIGHT_QUEUE
+)
+from app.services.metrics import queue_depth, requests_rejected
+
+
+CLIENT_HEADER = "x-client-id"
+
+# (method, path prefix, endpoint class); the first match wins, unmatched requests are not limited
+ADMISSION_RULES = [
+    ("POST", "/api/v1/boxes/jobs", "light"),
+    ("POST", "/api/v1/boxes/", "detection"),
+    # Dataset ingestion holds its slot for the whole dataset
+    ("POST", "/api/v1/image-process/ingest", "heavy"),
+    ("POST", "/api/v1/augment/ingest", "heavy"),
+    ("POST", "/api/v1/image-process/noise-reduction", "heavy"),
+    ("POST", "/api/v1/image-process/background-removal", "heavy"),
+    ("POST", "/api/v1/image-process/", "light"),
+    ("POST", "/api/v1/augment/", "light"),
+]
+
+MAX_RETRY_AFTER_SECONDS = 300
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request cannot be admitted.
+
+    Args:
+        status_code (int): 429 when the client exceeded its share, 503 when the service is overloaded.
+        detail (str): The reason.
+        retry_after (int): Seconds after which a retry is likely to be admitted.
+    """
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Concurrency limit with a bounded, per-client fair queue.
+
+    Args:
+        name (str): The endpoint class, used in messages and metrics.
+        max_concurrent (int): Requests processed at once.
+        max_queued (int): Requests waiting at once, across all clients.
+        max_queued_per_client (int): Requests one client may have waiting at once.
+        queue_timeout (float): Seconds a request may wait before it is rejected.
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_queued: int, max_queued_per_client: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queued = max(0, max_queued)
+        self.max_queued_per_client = max(1, max_queued_per_client)
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queued = 0
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._average_seconds: Optional[float] = None
+
+    def retry_after(self) -> int:
+        """Estimates when a retry would be admitted, from the average service time and the queue ahead of it."""
+        if self._average_seconds is None:
+            return 1
+        seconds = self._average_seconds * (self.queued + 1) / self.max_concurrent
+        return max(1, min(MAX_RETRY_AFTER_SECONDS, math.ceil(seconds)))
+
+    def _reject(self, status_code: int, reason: str, detail: str):
+        requests_rejected.inc(self.name, reason)
+        raise AdmissionRejected(status_code, detail, self.retry_after())
+
+    def _remove(self, client: str, future: asyncio.Future):
+        queue = self._queues.get(client)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            self.queued -= 1
+            if not queue:
+                del self._queues[client]
+
+    def _grant_next(self):
+        # Serves the client at the head of the rotation, then moves it to the back
+        while self.active < self.max_concurrent and self._queues:
+            client, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            self.queued -= 1
+            if queue:
+                self._queues.move_to_end(client)
+            else:
+                del self._queues[client]
+            if future.done():
+                continue
+            self.active += 1
+            future.set_result(None)
+
+    async def acquire(self, client: str):
+        """
+        Waits for a slot.
+
+        Raises:
+            AdmissionRejected: If the client's queue share or the whole queue is full, or the wait times out.
+        """
+        if self.active < self.max_concurrent and not self.queued:
+            self.active += 1
+            return
+        if len(self._queues.get(client, ())) >= self.max_queued_per_client:
+            self._reject(429, "client_limit", f"Too many queued {self.name} requests from this client")
+        if self.queued >= self.max_queued:
+            self._reject(503, "queue_full", f"The {self.name} queue is full")
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(client, deque()).append(future)
+        self.queued += 1
+        try:
+            await asyncio.wait({future}, timeout=self.queue_timeout if self.queue_timeout > 0 else None)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+                self._remove(client, future)
+            raise
+        if not future.done():
+            future.cancel()
+            self._remove(client, future)
+            self._reject(503, "queue_timeout", f"Timed out waiting in the {self.name} queue")
+
+    def release(self, seconds: float = None):
+        """Frees a slot and hands it to the next queued request; `seconds` feeds the service time average."""
+        self.active -= 1
+        if seconds is not None:
+            self._average_seconds = seconds if self._average_seconds is None else 0.8 * self._average_seconds + 0.2 * seconds
+        self._grant_next()
+
+    def status(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "max_concurrent": self.max_concurrent,
+            "max_queued": self.max_queued,
+            "clients_waiting": len(self._queues),
+            "average_seconds": round(self._average_seconds, 4) if self._average_seconds is not None else None,
+        }
+
+
+controllers: Dict[str, AdmissionController] = {
+    "detection": AdmissionController("detection", ADMISSION_DETECTION_CONCURRENCY, ADMISSION_DETECTION_QUEUE,
+                                     ADMISSION_MAX_QUEUED_PER_CLIENT, ADMISSION_QUEUE_TIMEOUT_SECONDS),
+    "heavy": AdmissionController("heavy", ADMISSION_HEAVY_CONCURRENCY, ADMISSION_HEAVY_QUEUE,
+                                 ADMISSION_MAX_QUEUED_PER_CLIENT, ADMISSION_QUEUE_TIMEOUT_SECONDS),
+    "light": AdmissionController("light", ADMISSION_LIGHT_CONCURRENCY, ADMISSION_LIGHT_QUEUE,
+                                 ADMISSION_MAX_QUEUED_PER_CLIENT, ADMISSION_QUEUE_TIMEOUT_SECONDS),
+}
+
+for _name, _controller in controllers.items():
+    queue_depth.set_function(lambda c=_controller: c.active, f"admission_{_name}_active")
+    queue_depth.set_function(lambda c=_controller: c.queued, f"admission_{_name}_queued")
+
+
+def endpoint_class(method: str, path: str) -> Optional[str]:
+    """Returns the endpoint class a request is limited under, or None if it is not limited."""
+    for rule_method, prefix, name in ADMISSION_RULES:
+        if method == rule_method and path.startswith(prefix):
+            return name
+    return None
+
+
+def _client_key(scope) -> str:
+    for name, value in scope.get("headers", ()):
+        if name.decode("latin-1").lower() == CLIENT_HEADER:
+            return value.decode("latin-1")
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware applying the endpoint class limits.
+
+    The slot is held until the app has sent the whole response, streamed bodies included.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        name = endpoint_class(scope.get("method", ""), scope.get("path", "")) if scope["type"] == "http" else None
+        if not ADMISSION_ENABLED or name is None:
+            await self.app(scope, receive, send)
+            return
+
+        controller = controllers[name]
+        try:
+            await controller.acquire(_client_key(scope))
+        except AdmissionRejected as e:
+            await send({
+                "type": "http.response.start",
+                "status": e.status_code,
+                "headers": [(b"content-type", b"application/json"), (b"retry-after", str(e.retry_after).encode("latin-1"))],
+            })
+            await send({"type": "http.response.body", "body": json.dumps({"detail": e.detail}).encode("utf-8")})
+            return
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            controller.release(loop.time() - start)
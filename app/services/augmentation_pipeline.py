@@ -0,0 +1,269 @@
+"""
+Fused single-decode augmentation pipeline.
+
+A pipeline is an ordered list of operations such as
+`[{"op": "rotate", "angle": 15}, {"op": "brightness", "factor": 1.2}]`.
+Each image is decoded once into a BGR uint8 buffer, every operation runs on
+that buffer with OpenCV (in place where OpenCV allows it), and the result is
+encoded once. There are no PIL/NumPy round trips between steps.
+"""
+
+import asyncio
+import os
+from typing import AsyncIterator, Callable, Dict, List, Tuple, Union
+
+import cv2
+import numpy as np
+from fastapi import UploadFile
+
+from app.services.metrics import images_processed, stage_seconds
+from app.services.request_profiler import profiled
+
+
+# Extensions OpenCV can encode; anything else is written as PNG
+ENCODABLE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff"}
+
+
+def _rotate(img: np.ndarray, angle: float) -> np.ndarray:
+    # Counter-clockwise around the centre on a canvas of the same size, like PIL's Image.rotate
+    (h, w) = img.shape[:2]
+    M = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    return cv2.warpAffine(img, M, (w, h))
+
+
+def _flip_horizontal(img: np.ndarray) -> np.ndarray:
+    return cv2.flip(img, 1)
+
+
+def _flip_vertical(img: np.ndarray) -> np.ndarray:
+    return cv2.flip(img, 0)
+
+
+def _crop(img: np.ndarray, x: float, y: float, width: float, height: float) -> np.ndarray:
+    x, y, width, height = int(x), int(y), int(width), int(height)
+    if x < 0 or y < 0 or width <= 0 or height <= 0:
+        raise ValueError("crop needs a non-negative x and y and a positive width and height")
+    cropped = img[y:y + height, x:x + width]
+    if cropped.size == 0:
+        raise ValueError("Crop region lies outside the image")
+    return cropped
+
+
+def _resize(img: np.ndarray, width: float, height: float) -> np.ndarray:
+    if int(width) <= 0 or int(height) <= 0:
+        raise ValueError("resize needs a positive width and height")
+    return cv2.resize(img, (int(width), int(height)))
+
+
+def _brightness(img: np.ndarray, factor: float) -> np.ndarray:
+    # Blend with black, like ImageEnhance.Brightness
+    return cv2.convertScaleAbs(img, dst=img, alpha=factor)
+
+
+def _contrast(img: np.ndarray, factor: float) -> np.ndarray:
+    # Blend with the mean grey level, like ImageEnhance.Contrast
+    mean = cv2.mean(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))[0]
+    return cv2.addWeighted(img, factor, img, 0, mean * (1 - factor), dst=img)
+
+
+def _saturation(img: np.ndarray, factor: float) -> np.ndarray:
+    # Blend with the greyscale image, like ImageEnhance.Color
+    grey = cv2.cvtColor(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR)
+    return cv2.addWeighted(img, factor, grey, 1 - factor, 0, dst=img)
+
+
+def _hue(img: np.ndarray, shift: float) -> np.ndarray:
+    # `shift` is a fraction of a full turn of the hue circle; OpenCV stores hue as 0-179
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    lut = ((np.arange(256) + int(round(shift * 180))) % 180).astype(np.uint8)
+    hsv[..., 0] = lut[hsv[..., 0]]
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR, dst=img)
+
+
+def _gaussian_noise(img: np.ndarray, level: float) -> np.ndarray:
+    noise = np.empty(img.shape, np.int16)
+    cv2.randn(noise, 0, level)
+    return cv2.add(img, noise, dtype=cv2.CV_8U)
+
+
+def _blur(img: np.ndarray, radius: float) -> np.ndarray:
+    return cv2.GaussianBlur(img, (0, 0), sigmaX=radius, dst=img)
+
+
+# name -> (function, {parameter: default}); a default of None marks a required parameter
+OPERATIONS: Dict[str, Tuple[Callable, Dict[str, float]]] = {
+    "rotate": (_rotate, {"angle": None}),
+    "flip_horizontal": (_flip_horizontal, {}),
+    "flip_vertical": (_flip_vertical, {}),
+    "crop": (_crop, {"x": None, "y": None, "width": None, "height": None}),
+    "resize": (_resize, {"width": None, "height": None}),
+    "brightness": (_brightness, {"factor": None}),
+    "contrast": (_contrast, {"factor": None}),
+    "saturation": (_saturation, {"factor": None}),
+    "hue": (_hue, {"shift": None}),
+    "gaussian_noise": (_gaussian_noise, {"level": 25.0}),
+    "blur": (_blur, {"radius": 2.0}),
+}
+
+
+def parse_operations(operations: List[dict]) -> List[Tuple[str, dict]]:
+    """
+    Validates a pipeline description.
+
+    Args:
+        operations (List[dict]): Ordered operations, each a dict with an "op" name and its parameters.
+
+    Returns:
+        List[Tuple[str, dict]]: (operation name, parameters) pairs with defaults filled in.
+
+    Raises:
+        ValueError: If an operation is unknown or its parameters are missing or invalid.
+    """
+    if not isinstance(operations, list):
+        raise ValueError("operations must be a list")
+    parsed = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or "op" not in operation:
+            raise ValueError(f"operation {index} must be an object with an 'op' field")
+        name = operation["op"]
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation '{name}'. Supported operations: {', '.join(OPERATIONS)}")
+        _, defaults = OPERATIONS[name]
+        unknown = set(operation) - set(defaults) - {"op"}
+        if unknown:
+            raise ValueError(f"Unknown parameters for '{name}': {', '.join(sorted(unknown))}")
+        params = {}
+        for param, default in defaults.items():
+            value = operation.get(param, default)
+            if value is None:
+                raise ValueError(f"Operation '{name}' requires '{param}'")
+            try:
+                params[param] = float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Parameter '{param}' of '{name}' must be a number")
+        parsed.append((name, params))
+    return parsed
+
+
+def decode_image(contents: bytes) -> np.ndarray:
+    img = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not decode image")
+    return img
+
+
+def apply_operations(img: np.ndarray, operations: List[Tuple[str, dict]]) -> np.ndarray:
+    """
+    Runs parsed operations, in order, on a decoded BGR image.
+    """
+    for name, params in operations:
+        img = OPERATIONS[name][0](img, **params)
+    return img
+
+
+def output_filename(filename: str) -> str:
+    """
+    Returns `filename`, with its extension replaced by .png if OpenCV cannot encode it.
+    """
+    root, ext = os.path.splitext(filename or "image.png")
+    if ext.lower() not in ENCODABLE_EXTENSIONS:
+        ext = ".png"
+    return f"{root}{ext}"
+
+
+def encode_image(img: np.ndarray, filename: str) -> bytes:
+    ok, buffer = cv2.imencode(os.path.splitext(filename)[1], img)
+    if not ok:
+        raise ValueError(f"Could not encode {filename}")
+    return buffer.tobytes()
+
+
+def run_pipeline(contents: bytes, operations: List[Tuple[str, dict]], filename: str) -> Tuple[bytes, str]:
+    """
+    Decodes an image once, applies every operation and encodes the result once.
+
+    Args:
+        contents (bytes): The encoded input image.
+        operations (List[Tuple[str, dict]]): Operations as returned by `parse_operations`.
+        filename (str): The input filename, which selects the output format.
+
+    Returns:
+        Tuple[bytes, str]: The encoded output image and its filename.
+    """
+    filename = output_filename(filename)
+    with stage_seconds.time("augmentation", "decode"):
+        img = decode_image(contents)
+    with stage_seconds.time("augmentation", "operations"):
+        img = apply_operations(img, operations)
+    with stage_seconds.time("augmentation", "encode"):
+        data = encode_image(img, filename)
+    images_processed.inc("augmentation", "ok")
+    return data, filename
+
+
+async def augment_files(files: List[UploadFile], operations: List[Tuple[str, dict]], save: Callable[[bytes, str], str]) -> List[str]:
+    """
+    Runs a pipeline on every uploaded image and saves the results.
+
+    The pipeline runs in a worker thread (OpenCV releases the GIL) so the event loop stays responsive.
+
+    Args:
+        files (List[UploadFile]): A list of uploaded image files.
+        operations (List[Tuple[str, dict]]): Operations as returned by `parse_operations`.
+        save (Callable[[bytes, str], str]): Persists one encoded output under a filename and returns the saved name.
+
+    Returns:
+        List[str]: The saved output names, in input order.
+    """
+    output_filenames = []
+    for file in files:
+        with stage_seconds.time("augmentation", "read"):
+            contents = await file.read()
+        data, filename = await asyncio.to_thread(profiled(run_pipeline), contents, operations, file.filename)
+        with stage_seconds.time("augmentation", "save"):
+            output_filenames.append(await asyncio.to_thread(save, data, filename))
+    return output_filenames
+
+
+async def stream_augmented_files(files: List[UploadFile], operations: List[Tuple[str, dict]], prefix: str) -> AsyncIterator[Tuple[str, Union[bytes, Exception]]]:
+    """
+    Runs a pipeline on every uploaded image and hands back the encoded results without writing anything to disk.
+
+    The uploads are read before returning, since they are closed once the handler returns.
+
+    Returns:
+        AsyncIterator[Tuple[str, Union[bytes, Exception]]]: The output filename and the encoded image, or the exception that failed the image, in input order.
+    """
+    with stage_seconds.time("augmentation", "read"):
+        uploads = [(file.filename, await file.read()) for file in files]
+
+    async def chunks():
+        yield uploads
+
+    return augment_chunks(chunks(), operations, prefix)
+
+
+async def augment_chunks(chunks: AsyncIterator[List[Tuple[str, Union[bytes, Exception]]]], operations: List[Tuple[str, dict]],
+                         prefix: str) -> AsyncIterator[Tuple[str, Union[bytes, Exception]]]:
+    """
+    Runs a pipeline on every image of every chunk, e.g. of a dataset read by `dataset_ingest.aiter_chunks`.
+
+    Args:
+        chunks (AsyncIterator[List[Tuple[str, Union[bytes, Exception]]]]): Lists of filenames and their encoded images,
+            or the exception that kept an image from being read.
+        operations (List[Tuple[str, dict]]): Operations as returned by `parse_operations`.
+        prefix (str): The prefix of the output filenames.
+
+    Returns:
+        AsyncIterator[Tuple[str, Union[bytes, Exception]]]: The output filename and the encoded image, or the exception that failed the image, in input order.
+    """
+    async for uploads in chunks:
+        for filename, contents in uploads:
+            try:
+                if isinstance(contents, Exception):
+                    raise contents
+                data, output_name = await asyncio.to_thread(profiled(run_pipeline), contents, operations, filename)
+                yield f"{prefix}_{output_name}", data
+            except Exception as e:
+                images_processed.inc("augmentation", "failed")
+                yield f"{prefix}_{filename}", e
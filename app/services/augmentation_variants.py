@@ -0,0 +1,233 @@
+"""
+Seeded multi-variant augmentation.
+
+Each upload is decoded once and expanded into `count` randomized variants.
+Parameters are drawn uniformly from caller-given ranges by a generator
+seeded with `(seed, image index)`. The same seed and uploads therefore
+always give the same variants. Geometry and blur run per variant with
+OpenCV. Brightness, contrast, saturation, hue and Gaussian noise run as
+float32 array ops over a whole chunk of variants at once, shaped
+(variants, height, width, channels). Chunks are sized so that a chunk
+stays under `AUGMENT_VARIANT_BATCH_PIXELS`, and each chunk is encoded and
+handed out before the next one starts.
+"""
+
+import asyncio
+import os
+from typing import AsyncIterator, Dict, List, Tuple, Union
+
+import cv2
+import numpy as np
+from fastapi import UploadFile
+
+from app.core.config import AUGMENT_MAX_VARIANTS, AUGMENT_VARIANT_BATCH_PIXELS
+from app.services.augmentation_pipeline import _rotate, decode_image, encode_image, output_filename
+from app.services.metrics import images_processed, stage_seconds
+from app.services.request_profiler import profiled
+
+
+# name -> (lowest allowed value, highest allowed value, neutral value)
+VARIANT_RANGES: Dict[str, Tuple[float, float, float]] = {
+    "rotate": (-360.0, 360.0, 0.0),
+    "brightness": (0.0, 10.0, 1.0),
+    "contrast": (0.0, 10.0, 1.0),
+    "saturation": (0.0, 10.0, 1.0),
+    "hue": (-0.5, 0.5, 0.0),
+    "noise": (0.0, 255.0, 0.0),
+    "blur": (0.0, 50.0, 0.0),
+}
+
+# Operations applied with a probability rather than drawn from a range
+VARIANT_PROBABILITIES = ("flip_horizontal", "flip_vertical")
+
+# BGR weights of the ITU-R 601 luma, as used by ImageEnhance and cv2.COLOR_BGR2GRAY
+_BGR_TO_GREY = np.array([0.114, 0.587, 0.299], np.float32)
+
+# BGR <-> YIQ, for hue rotation as a linear map that applies to the whole batch at once
+_BGR_TO_YIQ = np.array([
+    [0.114, 0.587, 0.299],
+    [-0.322, -0.274, 0.596],
+    [0.312, -0.523, 0.211],
+], np.float32)
+_YIQ_TO_BGR = np.linalg.inv(_BGR_TO_YIQ).astype(np.float32)
+
+
+def parse_ranges(ranges: dict) -> dict:
+    """
+    Validates the parameter ranges of a variant request.
+
+    Args:
+        ranges (dict): Maps each operation in `VARIANT_RANGES` to a [low, high] pair, and
+            each operation in `VARIANT_PROBABILITIES` to a probability between 0 and 1.
+
+    Returns:
+        dict: The validated ranges as (low, high) float tuples and probabilities as floats.
+
+    Raises:
+        ValueError: If an operation is unknown or its range is invalid.
+    """
+    if not isinstance(ranges, dict):
+        raise ValueError("ranges must be an object")
+    parsed = {}
+    for name, value in ranges.items():
+        if name in VARIANT_PROBABILITIES:
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value <= 1:
+                raise ValueError(f"'{name}' must be a probability between 0 and 1")
+            parsed[name] = float(value)
+            continue
+        if name not in VARIANT_RANGES:
+            supported = ", ".join(list(VARIANT_RANGES) + list(VARIANT_PROBABILITIES))
+            raise ValueError(f"Unknown operation '{name}'. Supported operations: {supported}")
+        lowest, highest, _ = VARIANT_RANGES[name]
+        if (not isinstance(value, (list, tuple)) or len(value) != 2
+                or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in value)):
+            raise ValueError(f"'{name}' must be a [low, high] pair of numbers")
+        low, high = float(value[0]), float(value[1])
+        if not lowest <= low <= high <= highest:
+            raise ValueError(f"'{name}' must satisfy {lowest} <= low <= high <= {highest}")
+        parsed[name] = (low, high)
+    return parsed
+
+
+def validate_count(count: int):
+    if not 1 <= count <= AUGMENT_MAX_VARIANTS:
+        raise ValueError(f"count must be between 1 and {AUGMENT_MAX_VARIANTS}")
+
+
+def sample_parameters(ranges: dict, count: int, rng: np.random.Generator) -> Dict[str, np.ndarray]:
+    """
+    Draws the parameters of `count` variants, one array of length `count` per operation.
+    """
+    params = {}
+    for name in VARIANT_RANGES:
+        if name in ranges:
+            params[name] = rng.uniform(*ranges[name], size=count).astype(np.float32)
+    for name in VARIANT_PROBABILITIES:
+        if name in ranges:
+            params[name] = rng.random(count) < ranges[name]
+    return params
+
+
+def chunk_size(img: np.ndarray) -> int:
+    """The number of variants of `img` rendered together within the pixel budget."""
+    return max(1, AUGMENT_VARIANT_BATCH_PIXELS // (img.shape[0] * img.shape[1]))
+
+
+def _column(values: np.ndarray) -> np.ndarray:
+    # One value per variant, broadcastable against a (variants, height, width, channels) batch
+    return values[:, None, None, None]
+
+
+def render_variants(img: np.ndarray, params: Dict[str, np.ndarray], start: int, stop: int, seed: int, image_index: int, filename: str) -> List[bytes]:
+    """
+    Renders and encodes variants `start` to `stop` (exclusive) of one decoded BGR image.
+
+    Noise is drawn from a generator seeded with (seed, image index, variant index), so a variant
+    does not depend on which chunk it was rendered in.
+    """
+    frames = []
+    for i in range(start, stop):
+        frame = img
+        if "rotate" in params and params["rotate"][i]:
+            frame = _rotate(frame, float(params["rotate"][i]))
+        if "flip_horizontal" in params and params["flip_horizontal"][i]:
+            frame = cv2.flip(frame, 1)
+        if "flip_vertical" in params and params["flip_vertical"][i]:
+            frame = cv2.flip(frame, 0)
+        frames.append(frame)
+    batch = np.stack(frames).astype(np.float32)
+
+    if "brightness" in params:
+        batch *= _column(params["brightness"][start:stop])
+        np.clip(batch, 0, 255, out=batch)
+    if "contrast" in params:
+        factor = _column(params["contrast"][start:stop])
+        mean = _column((batch @ _BGR_TO_GREY).mean(axis=(1, 2)))
+        batch *= factor
+        batch += mean * (1 - factor)
+        np.clip(batch, 0, 255, out=batch)
+    if "saturation" in params:
+        factor = _column(params["saturation"][start:stop])
+        grey = (batch @ _BGR_TO_GREY)[..., None]
+        batch *= factor
+        batch += grey * (1 - factor)
+        np.clip(batch, 0, 255, out=batch)
+    if "hue" in params:
+        # Rotates the chroma plane of YIQ by the shift's fraction of a full turn
+        angle = params["hue"][start:stop] * 2 * np.pi
+        cos, sin = np.cos(angle), np.sin(angle)
+        rotation = np.zeros((stop - start, 3, 3), np.float32)
+        rotation[:, 0, 0] = 1
+        rotation[:, 1, 1], rotation[:, 1, 2] = cos, -sin
+        rotation[:, 2, 1], rotation[:, 2, 2] = sin, cos
+        transform = _YIQ_TO_BGR @ rotation @ _BGR_TO_YIQ
+        batch = np.einsum("nhwc,ndc->nhwd", batch, transform, optimize=True)
+        np.clip(batch, 0, 255, out=batch)
+    if "noise" in params:
+        noise = np.empty(batch.shape, np.float32)
+        for k, i in enumerate(range(start, stop)):
+            np.random.default_rng([seed, image_index, i]).standard_normal(out=noise[k], dtype=np.float32)
+        noise *= _column(params["noise"][start:stop])
+        batch += noise
+        np.clip(batch, 0, 255, out=batch)
+
+    encoded = []
+    for k, frame in enumerate(batch.astype(np.uint8)):
+        radius = params["blur"][start + k] if "blur" in params else 0
+        if radius > 0:
+            frame = cv2.GaussianBlur(frame, (0, 0), sigmaX=float(radius))
+        encoded.append(encode_image(frame, filename))
+    return encoded
+
+
+def variant_filename(filename: str, index: int, prefix: str) -> str:
+    root, ext = os.path.splitext(output_filename(os.path.basename(filename or "image.png")))
+    return f"{prefix}_{root}_{index:04d}{ext}"
+
+
+async def stream_variants(files: List[UploadFile], count: int, ranges: dict, seed: int, prefix: str = "variant") -> AsyncIterator[Tuple[str, Union[bytes, Exception]]]:
+    """
+    Generates `count` randomized variants of every upload, decoding each upload once.
+
+    The uploads are read before returning, since they are closed once the handler returns.
+
+    Args:
+        files (List[UploadFile]): A list of uploaded image files.
+        count (int): The number of variants per image.
+        ranges (dict): Parameter ranges as returned by `parse_ranges`.
+        seed (int): The seed that makes the variants reproducible.
+        prefix (str): The prefix of the output filenames.
+
+    Returns:
+        AsyncIterator[Tuple[str, Union[bytes, Exception]]]: The output filename and the encoded variant,
+        or the exception that failed it, image by image and chunk by chunk as they are rendered.
+    """
+    with stage_seconds.time("augmentation", "read"):
+        uploads = [(file.filename, await file.read()) for file in files]
+
+    async def results():
+        for image_index, (filename, contents) in enumerate(uploads):
+            names = [variant_filename(filename, i, prefix) for i in range(count)]
+            try:
+                with stage_seconds.time("augmentation", "decode"):
+                    img = await asyncio.to_thread(profiled(decode_image), contents)
+            except Exception as e:
+                images_processed.inc("augmentation", "failed")
+                yield names[0], e
+                continue
+            params = sample_parameters(ranges, count, np.random.default_rng([seed, image_index]))
+            step = chunk_size(img)
+            for start in range(0, count, step):
+                stop = min(count, start + step)
+                try:
+                    with stage_seconds.time("augmentation", "render_variants"):
+                        encoded = await asyncio.to_thread(profiled(render_variants), img, params, start, stop, seed, image_index, names[start])
+                except Exception as e:
+                    images_processed.inc("augmentation", "failed", amount=stop - start)
+                    yield names[start], e
+                    continue
+                images_processed.inc("augmentation", "ok", amount=len(encoded))
+                for name, data in zip(names[start:stop], encoded):
+                    yield name, data
+
+    return results()
@@ -1,25 +1,39 @@
+import asyncio
 import os
-import pandas as pd
+import shutil
+import tempfile
+import time
 import torch
-from PIL import Image
-from transformers import AutoProcessor, AutoModelForCausalLM
 from fastapi import UploadFile
-from io import BytesIO
-from typing import List
+from typing import AsyncIterator, List, Tuple, Union
+from app.core.config import (
+    DETECTION_MAX_BATCH_SIZE, DETECTION_MAX_WAIT_MS, DETECTION_MAX_IN_FLIGHT, DEFAULT_GENERATION_PROFILE, FLORENCE_INPUT_SIZE,
+    NEAR_DUPLICATE_ENABLED, NEAR_DUPLICATE_MAX_DISTANCE
+)
+from app.services.detection_batcher import DetectionBatcher
+from app.services.detection_cache import detection_cache
+from app.services.exporters import XlsxResultWriter, ResultWriter
+from app.services.generation_profiles import (
+    BASELINE_PROFILE, available_profiles, detection_agreement, get_profile, profile_latency
+)
+from app.services.inference_backends import inference_backend
+from app.services.inference_worker import inference_worker, postprocess_worker, preprocess_worker
+from app.services.metrics import detection_batch_size, generated_tokens, images_processed, queue_depth, stage_seconds
+from app.services.model_manager import model_manager
+from app.services.near_duplicates import BKTree, near_duplicate_index, perceptual_hash, rescale_answer, same_aspect
+from app.services.request_profiler import current_session, profiled, run_profiled
+from app.utils.image_utils import open_reduced
 
 
-# Device and dtype setup
-device = "cuda:0" if torch.cuda.is_available() else "cpu"
-torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
-
-
-# Model and Processor initialization
-model = AutoModelForCausalLM.from_pretrained("microsoft/Florence-2-large-ft", torch_dtype=torch_dtype, trust_remote_code=True).to(device)
-processor = AutoProcessor.from_pretrained("microsoft/Florence-2-large-ft", trust_remote_code=True)
-
 # Define the prompt
 prompt = "<OD>"
 
+# Florence-2 tasks that take no text input besides the task token, accepted by `process_tasks`
+TASK_PROMPTS = (
+    "<OD>", "<CAPTION>", "<DETAILED_CAPTION>", "<MORE_DETAILED_CAPTION>",
+    "<DENSE_REGION_CAPTION>", "<REGION_PROPOSAL>", "<OCR>", "<OCR_WITH_REGION>",
+)
+
 
 def save_bounding_boxes_to_excel(data, excel_filename):
     """
@@ -33,83 +47,558 @@ def save_bounding_boxes_to_excel(data, excel_filename):
         None
 
     This function takes a list of dictionaries containing data and saves it to an Excel file.
-    The data is converted into a pandas DataFrame and then saved to the specified Excel file.
-    The index is not included in the Excel file.
+    The rows are streamed through a write-only workbook, so no DataFrame is built.
+    """
+    with XlsxResultWriter(excel_filename) as writer:
+        writer.write_rows(data)
+
+
+def _prepare(contents: bytes) -> Tuple[dict, Tuple[int, int]]:
+    """
+    Decode and preprocessing stage: turns an encoded image into model inputs on a preprocess worker thread.
+
+    The processor resizes every image to the model input size, so large JPEGs are decoded no larger than needed.
+
+    Returns:
+        Tuple[dict, Tuple[int, int]]: The processor outputs (`input_ids` and `pixel_values`, batch of one)
+        and the size of the original upload, which the boxes are scaled to since the decode may have been reduced.
     """
-    df = pd.DataFrame(data)
-    df.to_excel(excel_filename, index=False)
+    with stage_seconds.time("detection", "decode"):
+        image, original_size = open_reduced(contents, (FLORENCE_INPUT_SIZE, FLORENCE_INPUT_SIZE))
+    with stage_seconds.time("detection", "processor"):
+        inputs = model_manager.get_processor()(text=prompt, images=image, return_tensors="pt")
+    return inputs, original_size
+
 
+def _generate(profile_name: str, prepared: List[Tuple[dict, Tuple[int, int]]]) -> List[torch.Tensor]:
+    """
+    Runs a batch of preprocessed images in a single `generate` call on the inference backend, loading the model first if needed.
 
-async def process_images(files: List[UploadFile]):
-        """
-        Asynchronously processes a list of uploaded image files and generates bounding box data.
+    Every image carries the same prompt, so the inputs stack without padding.
+
+    Args:
+        profile_name (str): The generation profile selecting the model variant and `generate` arguments.
+        prepared (List[Tuple[dict, Tuple[int, int]]]): Outputs of `_prepare`.
 
-        Args:
-            files (List[UploadFile]): A list of uploaded image files.
+    Returns:
+        List[torch.Tensor]: The generated token ids of each image, on the CPU, in input order.
+    """
+    profile = get_profile(profile_name)
+    start = time.perf_counter()
+    with stage_seconds.time("detection", "model_load"):
+        model, _ = model_manager.get(profile["model"])
+    input_ids = torch.cat([inputs["input_ids"] for inputs, _ in prepared]).to(model_manager.device)
+    pixel_values = torch.cat([inputs["pixel_values"] for inputs, _ in prepared]).to(model_manager.device, model_manager.torch_dtype)
+    with stage_seconds.time("detection", "generate"), torch.inference_mode():
+        generated_ids = inference_backend.generate(
+            model, input_ids, pixel_values, variant=profile["model"], **profile["generate"]
+        )
+    profile_latency.record(profile_name, len(prepared), time.perf_counter() - start)
+    generated_ids = generated_ids.cpu()
+    detection_batch_size.observe(len(prepared), profile_name)
+    pad_token_id = getattr(getattr(model, "generation_config", None), "pad_token_id", None)
+    for sequence in generated_ids:
+        tokens = int((sequence != pad_token_id).sum()) if pad_token_id is not None else sequence.numel()
+        generated_tokens.observe(tokens, profile_name)
+    return list(generated_ids)
 
-        Returns:
-            List[Dict[str, Union[str, int, float]]]: A list of dictionaries containing image name, class name, X, Y, Width, and Height values for each bounding box.
 
-        This function iterates over each uploaded image file and performs the following steps:
-        1. Opens the image using the PIL library.
-        2. Retrieves the image name from the file.
-        3. Preprocesses the image using the `processor` object and generates text using the `model` object.
-        4. Parses the generated text using the `processor` object to extract bounding box and label information.
-        5. Zips the bounding box and label information together and appends it to the `data` list.
-        6. Returns the `data` list.
+def _generate_batch(profile_name: str, items: List[tuple]) -> List[torch.Tensor]:
+    """
+    Generation stage: runs a batch on the inference thread, under the profiler when any of its images
+    belongs to a profiled request.
 
-        Note: This function assumes that the necessary dependencies, such as the `Image` and `BytesIO` modules from the PIL library, the `AutoProcessor` and `AutoModelForCausalLM` classes from the `transformers` library, and the `torch` library, are imported at the top of the file.
-        """
-        data = []
+    Args:
+        profile_name (str): The generation profile.
+        items (List[tuple]): (output of `_prepare`, profiling session or None) pairs.
+    """
+    sessions = {session for _, session in items if session is not None}
+    return run_profiled(sessions, "generate", _generate, profile_name, [prepared for prepared, _ in items], use_torch=True)
 
+
+def _postprocess(generated_ids: torch.Tensor, original_size: Tuple[int, int]) -> dict:
+    """
+    Post-processing stage: decodes one image's generated tokens into its parsed `<OD>` answer on a postprocess worker thread.
+    """
+    with stage_seconds.time("detection", "postprocess"):
+        processor = model_manager.get_processor()
+        generated_text = processor.batch_decode(generated_ids[None], skip_special_tokens=False)[0]
+        return processor.post_process_generation(generated_text, task="<OD>", image_size=original_size)
+
+
+# Batches images from concurrent requests into shared model calls, one batch per generation profile
+batcher = DetectionBatcher(_generate_batch, DETECTION_MAX_BATCH_SIZE, DETECTION_MAX_WAIT_MS, inference_worker)
+
+# Images between the start of decoding and the end of generation, which caps the preprocessed tensors in memory
+_in_flight = asyncio.Semaphore(DETECTION_MAX_IN_FLIGHT)
+
+queue_depth.set_function(lambda: batcher.queued, "detection_batcher")
+queue_depth.set_function(lambda: preprocess_worker.pending, "detection_preprocess")
+queue_depth.set_function(lambda: inference_worker.pending, "detection_inference")
+queue_depth.set_function(lambda: postprocess_worker.pending, "detection_postprocess")
+
+
+async def _run_stages(contents: bytes, profile_name: str) -> dict:
+    # Each stage runs on its own workers, so while one batch generates the next images are decoded
+    # and preprocessed and the previous batch is post-processed
+    async with _in_flight:
+        prepared = await preprocess_worker.run(profiled(_prepare), contents)
+        generated_ids = await batcher.submit((prepared, current_session()), profile_name)
+    return await postprocess_worker.run(profiled(_postprocess), generated_ids, prepared[1])
+
+
+def _cache_key(contents: bytes, task: str, profile: dict) -> str:
+    return detection_cache.make_key(contents, task, model_manager.model_id, {**profile, "backend": inference_backend.name})
+
+
+async def detect_image(contents: bytes, profile_name: str = None, use_cache: bool = True) -> dict:
+    """
+    Returns the parsed `<OD>` answer for one image, from the detection cache when possible.
+
+    Args:
+        contents (bytes): The encoded image.
+        profile_name (str): The generation profile to use. Defaults to the configured default profile.
+        use_cache (bool): Whether to read and write the detection cache.
+
+    Returns:
+        dict: The parsed `<OD>` answer.
+    """
+    profile = get_profile(profile_name)
+    profile_name = profile_name or DEFAULT_GENERATION_PROFILE
+    if not use_cache:
+        parsed_answer = await _run_stages(contents, profile_name)
+        images_processed.inc("detection", "inferred")
+        return parsed_answer
+
+    parsed_answer, inferred = await detection_cache.get_or_compute(
+        _cache_key(contents, prompt, profile), lambda: _run_stages(contents, profile_name)
+    )
+    images_processed.inc("detection", "inferred" if inferred else "cached")
+    return parsed_answer
+
+
+def _prepare_tasks(contents: bytes, tasks: List[str]) -> Tuple[torch.Tensor, dict, Tuple[int, int]]:
+    """
+    Decode and preprocessing stage of `process_tasks`: one image's pixel values and the prompt ids of each task.
+    """
+    with stage_seconds.time("detection", "decode"):
+        image, original_size = open_reduced(contents, (FLORENCE_INPUT_SIZE, FLORENCE_INPUT_SIZE))
+    with stage_seconds.time("detection", "processor"):
+        processor = model_manager.get_processor()
+        inputs = {task: processor(text=task, images=image, return_tensors="pt") for task in tasks}
+    return inputs[tasks[0]]["pixel_values"], {task: task_inputs["input_ids"] for task, task_inputs in inputs.items()}, original_size
+
+
+def _generate_tasks(profile_name: str, prepared: List[tuple]) -> List[dict]:
+    """
+    Encodes a batch of images once and decodes every task prompt against that encoding, on the inference thread.
+
+    Each task is decoded in one call for all images that need it, so prompts of different lengths never share a batch.
+
+    Args:
+        profile_name (str): The generation profile selecting the model variant and `generate` arguments.
+        prepared (List[tuple]): Outputs of `_prepare_tasks`.
+
+    Returns:
+        List[dict]: Per image, the generated token ids of each of its tasks, on the CPU.
+    """
+    profile = get_profile(profile_name)
+    variant = profile["model"]
+    with stage_seconds.time("detection", "model_load"):
+        model, _ = model_manager.get(variant)
+    pixel_values = torch.cat([pixels for pixels, _, _ in prepared]).to(model_manager.device, model_manager.torch_dtype)
+    generated = [{} for _ in prepared]
+    with torch.inference_mode():
+        with stage_seconds.time("detection", "encode_image"):
+            image_features = inference_backend.encode_image(model, pixel_values, variant=variant)
+        tasks = list(dict.fromkeys(task for _, task_ids, _ in prepared for task in task_ids))
+        for task in tasks:
+            rows = [i for i, (_, task_ids, _) in enumerate(prepared) if task in task_ids]
+            input_ids = torch.cat([prepared[i][1][task] for i in rows]).to(model_manager.device)
+            with stage_seconds.time("detection", "generate_task"):
+                generated_ids = inference_backend.generate_from_features(
+                    model, image_features[rows], input_ids, variant=variant, **profile["generate"]
+                ).cpu()
+            for i, sequence in zip(rows, generated_ids):
+                generated[i][task] = sequence
+    detection_batch_size.observe(len(prepared), profile_name)
+    return generated
+
+
+def _postprocess_tasks(generated: dict, original_size: Tuple[int, int]) -> dict:
+    """
+    Post-processing stage of `process_tasks`: parses each task's generated tokens for one image.
+    """
+    with stage_seconds.time("detection", "postprocess"):
+        processor = model_manager.get_processor()
+        answers = {}
+        for task, generated_ids in generated.items():
+            generated_text = processor.batch_decode(generated_ids[None], skip_special_tokens=False)[0]
+            answers[task] = processor.post_process_generation(generated_text, task=task, image_size=original_size)
+        return answers
+
+
+async def process_tasks(files: List[UploadFile], tasks: List[str], profile_name: str = None) -> List[dict]:
+    """
+    Runs several Florence-2 tasks on each uploaded image, encoding every image only once.
+
+    Args:
+        files (List[UploadFile]): A list of uploaded image files.
+        tasks (List[str]): Task prompts from `TASK_PROMPTS`, e.g. `["<OD>", "<CAPTION>"]`.
+        profile_name (str): The generation profile to use. Defaults to the configured default profile.
+
+    Returns:
+        List[dict]: Per image, its name and the parsed answer of each task, keyed by task prompt.
+
+    Raises:
+        ValueError: If no task is given, a task is not supported or the profile is unknown.
+
+    Each task's answer is cached on its own under the same key `detect_image` uses for `<OD>`, so only the
+    missing tasks of an image are run. Images needing any task are processed in batches of up to
+    `DETECTION_MAX_BATCH_SIZE`: the vision encoder runs once per batch and the language model once per task,
+    while the next batch is decoded and preprocessed.
+    """
+    tasks = list(dict.fromkeys(tasks))
+    if not tasks:
+        raise ValueError("At least one task is required")
+    unsupported = [task for task in tasks if task not in TASK_PROMPTS]
+    if unsupported:
+        raise ValueError(f"Unsupported tasks {unsupported}. Supported tasks: {', '.join(TASK_PROMPTS)}")
+    profile = get_profile(profile_name)
+    profile_name = profile_name or DEFAULT_GENERATION_PROFILE
+
+    uploads = []
+    with stage_seconds.time("detection", "read"):
         for file in files:
-            image = Image.open(BytesIO(await file.read()))
-            image_name = file.filename
-
-            inputs = processor(text=prompt, images=image, return_tensors="pt").to(device, torch_dtype)
-            generated_ids = model.generate(
-                input_ids=inputs["input_ids"],
-                pixel_values=inputs["pixel_values"],
-                max_new_tokens=1024,
-                do_sample=False,
-                num_beams=3
-            )
-            generated_text = processor.batch_decode(generated_ids, skip_special_tokens=False)[0]
-            parsed_answer = processor.post_process_generation(generated_text, task="<OD>", image_size=(image.width, image.height))
-
-            bboxes = parsed_answer['<OD>']['bboxes']
-            labels = parsed_answer['<OD>']['labels']
-
-            for bbox, label in zip(bboxes, labels):
-                x, y, width, height = bbox
-                data.append({
-                    "Image Name": image_name,
-                    "Class Name": label,
-                    "X": x,
-                    "Y": y,
-                    "Width": width,
-                    "Height": height
-                })
-
-        return  data 
-
-
-async def generate_excel(files: List[UploadFile], excel_filename: str):
+            uploads.append((file.filename, await file.read()))
+
+    answers = [{} for _ in uploads]
+    keys = [{task: _cache_key(contents, task, profile) for task in tasks} for _, contents in uploads]
+    for i, image_keys in enumerate(keys):
+        for task, key in image_keys.items():
+            cached = await detection_cache.lookup(key)
+            if cached is not None:
+                answers[i][task] = cached[task]
+                images_processed.inc("detection_tasks", "cached")
+
+    pending = [i for i in range(len(uploads)) if len(answers[i]) < len(tasks)]
+    chunks = [pending[start:start + DETECTION_MAX_BATCH_SIZE] for start in range(0, len(pending), DETECTION_MAX_BATCH_SIZE)]
+
+    async def prepare(chunk):
+        return await asyncio.gather(*(
+            preprocess_worker.run(profiled(_prepare_tasks), uploads[i][1], [task for task in tasks if task not in answers[i]])
+            for i in chunk
+        ))
+
+    next_prepared = asyncio.ensure_future(prepare(chunks[0])) if chunks else None
+    try:
+        for index, chunk in enumerate(chunks):
+            prepared = await next_prepared
+            # Preprocessing of the next batch overlaps generation of this one; at most two batches are held
+            next_prepared = asyncio.ensure_future(prepare(chunks[index + 1])) if index + 1 < len(chunks) else None
+            generated = await inference_worker.run(profiled(_generate_tasks), profile_name, prepared)
+            parsed = await asyncio.gather(*(
+                postprocess_worker.run(profiled(_postprocess_tasks), task_ids, size)
+                for task_ids, (_, _, size) in zip(generated, prepared)
+            ))
+            for i, image_answers in zip(chunk, parsed):
+                for task, answer in image_answers.items():
+                    answers[i][task] = answer[task]
+                    await asyncio.to_thread(detection_cache.put, keys[i][task], answer)
+                    images_processed.inc("detection_tasks", "inferred")
+    finally:
+        if next_prepared is not None and not next_prepared.done():
+            next_prepared.cancel()
+
+    return [
+        {"image_name": image_name, "results": {task: answers[i][task] for task in tasks}}
+        for i, (image_name, _) in enumerate(uploads)
+    ]
+
+
+def answer_to_rows(image_name: str, parsed_answer: dict) -> List[dict]:
+    """
+    Converts one parsed `<OD>` answer into bounding box rows.
+
+    Args:
+        image_name (str): The name of the image the answer belongs to.
+        parsed_answer (dict): The parsed `<OD>` answer.
+
+    Returns:
+        List[dict]: One row with image name, class name, X, Y, Width and Height per bounding box.
+    """
+    rows = []
+    bboxes = parsed_answer['<OD>']['bboxes']
+    labels = parsed_answer['<OD>']['labels']
+
+    for bbox, label in zip(bboxes, labels):
+        x, y, width, height = bbox
+        rows.append({
+            "Image Name": image_name,
+            "Class Name": label,
+            "X": x,
+            "Y": y,
+            "Width": width,
+            "Height": height
+        })
+    return rows
+
+
+def _hash_image(contents: bytes) -> Tuple[int, Tuple[int, int]]:
+    with stage_seconds.time("detection", "hash"):
+        return perceptual_hash(contents)
+
+
+async def detect_near_duplicates(uploads: List[tuple], profile_name: str = None, max_distance: int = NEAR_DUPLICATE_MAX_DISTANCE) -> Tuple[List[dict], List[dict]]:
+    """
+    Detects bounding boxes for a list of images, running the model only once per group of near-duplicates.
+
+    Every image is hashed perceptually first. An image close to one detected earlier, in this or a previous
+    request with the same settings, reuses that detection; otherwise an image close to one earlier in this
+    batch waits for and reuses that image's detection. Only the remaining images are detected, and they are
+    added to `near_duplicate_index`. Reused boxes are rescaled to the size of the image they are reused for.
+
+    Args:
+        uploads (List[tuple]): (image name, encoded image) pairs.
+        profile_name (str): The generation profile to use. Defaults to the configured default profile.
+        max_distance (int): The largest Hamming distance between the hashes of near-duplicates.
+
+    Returns:
+        Tuple[List[dict], List[dict]]: The parsed `<OD>` answer of each image, in input order, and one entry per
+        deduplicated image naming its source: `duplicate_of` for an image of this batch, `source_hash` (the
+        SHA-256 of the image bytes) for one indexed earlier.
+    """
+    profile = get_profile(profile_name)
+    # The parameters half of a cache key identifies the settings detections were made with
+    settings_key = _cache_key(b"", prompt, profile).split("-", 1)[1]
+    hashes = await asyncio.gather(*(preprocess_worker.run(_hash_image, contents) for _, contents in uploads))
+
+    answers: List[dict] = [None] * len(uploads)
+    deduplicated = []
+    duplicates = []
+    batch_tree = BKTree()
+    representatives = []
+    for i, ((image_name, _), (value, size)) in enumerate(zip(uploads, hashes)):
+        match = near_duplicate_index.find(settings_key, value, size, max_distance)
+        if match is not None:
+            answers[i] = match["answer"]
+            deduplicated.append({"image_name": image_name, "source_hash": match["source"], "distance": match["distance"]})
+            continue
+        candidates = [(d, j) for d, j in batch_tree.search(value, max_distance) if same_aspect(hashes[j][1], size)]
+        if candidates:
+            duplicates.append((i, candidates[0][1], candidates[0][0]))
+        else:
+            representatives.append(i)
+            batch_tree.add(value, i)
+
+    async def detect(i: int):
+        contents = uploads[i][1]
+        answers[i] = await detect_image(contents, profile_name)
+        value, size = hashes[i]
+        near_duplicate_index.add(settings_key, value, size, answers[i], detection_cache.image_hash(contents))
+
+    await asyncio.gather(*(detect(i) for i in representatives))
+
+    for i, source, distance in duplicates:
+        answers[i] = rescale_answer(answers[source], hashes[source][1], hashes[i][1])
+        deduplicated.append({"image_name": uploads[i][0], "duplicate_of": uploads[source][0], "distance": distance})
+    if deduplicated:
+        images_processed.inc("detection", "near_duplicate", amount=len(deduplicated))
+    return answers, deduplicated
+
+
+async def process_images(files: List[UploadFile], profile_name: str = None, dedupe: bool = None) -> Tuple[List[dict], List[dict]]:
+    """
+    Asynchronously processes a list of uploaded image files and generates bounding box data.
+
+    Args:
+        files (List[UploadFile]): A list of uploaded image files.
+        profile_name (str): The generation profile to use. Defaults to the configured default profile.
+        dedupe (bool): Whether near-duplicate images reuse each other's detections. Defaults to `NEAR_DUPLICATE_ENABLED`.
+
+    Returns:
+        Tuple[List[dict], List[dict]]: A list of dictionaries containing image name, class name, X, Y, Width, and Height
+        values for each bounding box, and the images whose detections were reused from a near-duplicate (empty unless `dedupe`).
+
+    This function performs the following steps:
+    1. Reads every uploaded image.
+    2. With `dedupe`, groups near-duplicate images by perceptual hash with `detect_near_duplicates`, so only one image per group goes on.
+    3. Looks each image up in the detection cache, keyed by its content, the prompt, the model id and the generation profile.
+    4. Runs each cache miss through the detection stages: decoding and preprocessing on the preprocess workers, generation through the shared `batcher`, which groups it with images from other in-flight requests into one batch on the inference worker thread, and post-processing on the postprocess worker. The stages overlap across images and the event loop stays free.
+    5. Converts the bounding box and label information of each image into rows and appends them to the `data` list.
+    6. Returns the `data` list and the deduplicated images.
+    """
+    get_profile(profile_name)
+    uploads = []
+    with stage_seconds.time("detection", "read"):
+        for file in files:
+            uploads.append((file.filename, await file.read()))
+
+    deduplicated = []
+    if NEAR_DUPLICATE_ENABLED if dedupe is None else dedupe:
+        parsed_answers, deduplicated = await detect_near_duplicates(uploads, profile_name)
+    else:
+        parsed_answers = await asyncio.gather(*(detect_image(contents, profile_name) for _, contents in uploads))
+
+    data = []
+    for (image_name, _), parsed_answer in zip(uploads, parsed_answers):
+        data.extend(answer_to_rows(image_name, parsed_answer))
+
+    return data, deduplicated
+
+
+def _spool_upload(file: UploadFile, path: str):
+    file.file.seek(0)
+    with open(path, "wb") as out_file:
+        shutil.copyfileobj(file.file, out_file, 1024 * 1024)
+
+
+def _read_spooled(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def _stream_detections(uploads: List[Tuple[str, str]], spool_dir: str, profile_name: str) -> AsyncIterator[Tuple[int, str, Union[dict, Exception]]]:
+    async def detect(index: int, filename: str, path: str):
+        try:
+            with stage_seconds.time("detection", "read"):
+                contents = await asyncio.to_thread(_read_spooled, path)
+            return index, filename, await detect_image(contents, profile_name)
+        except Exception as e:
+            images_processed.inc("detection", "failed")
+            return index, filename, e
+
+    # At most DETECTION_MAX_IN_FLIGHT detections are started at once, so the batcher is never handed more than that
+    # and no more than that many images are read back into memory
+    images = iter(enumerate(uploads))
+    pending = set()
+    try:
+        while True:
+            for index, (filename, path) in images:
+                pending.add(asyncio.ensure_future(detect(index, filename, path)))
+                if len(pending) >= DETECTION_MAX_IN_FLIGHT:
+                    break
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        # The client may disconnect mid-stream; its remaining detections are abandoned
+        for task in pending:
+            task.cancel()
+        await asyncio.to_thread(shutil.rmtree, spool_dir, True)
+
+
+async def stream_detections(files: List[UploadFile], profile_name: str = None) -> AsyncIterator[Tuple[int, str, Union[dict, Exception]]]:
+    """
+    Detects bounding boxes for a list of uploaded images and yields each image's answer as soon as it is parsed.
+
+    The uploads are closed once the handler returns, so they are spooled to a temporary directory first; the
+    stream reads each one back only when its detection starts and removes the directory when it ends.
+
+    Args:
+        files (List[UploadFile]): A list of uploaded image files.
+        profile_name (str): The generation profile to use. Defaults to the configured default profile.
+
+    Returns:
+        AsyncIterator[Tuple[int, str, Union[dict, Exception]]]: (upload index, image name, parsed `<OD>` answer
+        or the exception that failed the image) in completion order.
+
+    Raises:
+        ValueError: If the generation profile is unknown; raised here rather than once the stream has started.
+    """
+    get_profile(profile_name)
+    spool_dir = tempfile.mkdtemp(prefix="detections-")
+    uploads = []
+    try:
+        with stage_seconds.time("detection", "spool"):
+            for index, file in enumerate(files):
+                path = os.path.join(spool_dir, str(index))
+                await asyncio.to_thread(_spool_upload, file, path)
+                uploads.append((file.filename, path))
+    except BaseException:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        raise
+    return _stream_detections(uploads, spool_dir, profile_name)
+
+
+async def evaluate_profiles(files: List[UploadFile], profile_names: List[str] = None) -> dict:
+    """
+    Measures the latency of each generation profile and its agreement with the baseline profile.
+
+    Every image is run through every profile without the detection cache. Agreement
+    is the mean per-image F1 of IoU-matched boxes against the `accurate` baseline.
+
+    Args:
+        files (List[UploadFile]): A list of uploaded image files.
+        profile_names (List[str]): The profiles to evaluate. Defaults to every available profile.
+
+    Returns:
+        dict: Per-profile seconds per image and agreement with the baseline.
+    """
+    profile_names = profile_names or available_profiles()
+    for name in profile_names:
+        get_profile(name)
+    if BASELINE_PROFILE not in profile_names:
+        profile_names = [BASELINE_PROFILE] + list(profile_names)
+
+    contents = [await file.read() for file in files]
+    answers = {}
+    report = {}
+    for name in profile_names:
+        start = time.perf_counter()
+        answers[name] = await asyncio.gather(*(detect_image(c, name, use_cache=False) for c in contents))
+        elapsed = time.perf_counter() - start
+        report[name] = {"seconds_per_image": round(elapsed / max(1, len(contents)), 4)}
+
+    for name in profile_names:
+        scores = [detection_agreement(b, a) for b, a in zip(answers[BASELINE_PROFILE], answers[name])]
+        report[name]["agreement"] = round(sum(scores) / len(scores), 4) if scores else None
+
+    return {"baseline": BASELINE_PROFILE, "images": len(contents), "profiles": report}
+
+
+async def export_detections(uploads: List[tuple], writer: ResultWriter, profile_name: str = None):
+    """
+    Detects bounding boxes for a list of images and appends each image's rows to `writer` as soon as they are ready.
+
+    Args:
+        uploads (List[tuple]): (image name, encoded image) pairs.
+        writer (ResultWriter): The streaming writer receiving the rows.
+        profile_name (str): The generation profile to use. Defaults to the configured default profile.
+    """
+    async def detect(image_name, contents):
+        return image_name, await detect_image(contents, profile_name)
+
+    for next_done in asyncio.as_completed([detect(name, contents) for name, contents in uploads]):
+        image_name, parsed_answer = await next_done
+        with stage_seconds.time("detection", "export"):
+            writer.write_rows(answer_to_rows(image_name, parsed_answer))
+
+
+async def generate_excel(files: List[UploadFile], excel_filename: str, profile_name: str = None):
     """
     Generate an Excel file containing bounding boxes data from a list of uploaded images.
 
     Args:
         files (List[UploadFile]): A list of uploaded image files.
         excel_filename (str): The name of the Excel file to be generated.
+        profile_name (str): The generation profile to use. Defaults to the configured default profile.
 
     Returns:
         str: The name of the generated Excel file.
 
-    This function takes a list of uploaded image files and processes them using the `process_images` function.
-    The resulting bounding boxes data is then saved to an Excel file using the `save_bounding_boxes_to_excel` function.
+    This function reads the uploaded image files and detects their bounding boxes with `export_detections`,
+    which appends every image's rows to a write-only workbook as soon as its detection completes.
     The name of the generated Excel file is returned.
     """
-    data = await process_images(files)
-    save_bounding_boxes_to_excel(data, excel_filename)
+    get_profile(profile_name)
+    with stage_seconds.time("detection", "read"):
+        uploads = [(file.filename, await file.read()) for file in files]
+    writer = await asyncio.to_thread(XlsxResultWriter, excel_filename)
+    try:
+        await export_detections(uploads, writer, profile_name)
+    finally:
+        await asyncio.to_thread(writer.close)
     return excel_filename
-
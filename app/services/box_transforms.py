@@ -0,0 +1,99 @@
+"""
+Analytic propagation of bounding boxes through geometric augmentations.
+
+Boxes are Florence-2 corner boxes `[x1, y1, x2, y2]` in pixels, the values
+stored in the X, Y, Width and Height columns. Each transform takes the boxes
+and the (width, height) of the image before the operation. It returns the
+boxes and the image size after it, following the same conventions as the
+OpenCV implementations in `augmentation_pipeline`. A rotated box becomes the
+axis-aligned bounds of its rotated corners. Boxes are clipped to the image,
+and a box that ends up (almost) empty is dropped, together with its label.
+"""
+
+import math
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+Box = List[float]
+Size = Tuple[int, int]
+
+# Boxes narrower or shorter than this many pixels after clipping are dropped
+MIN_BOX_SIDE = 1.0
+
+
+def _clip(box: Box, size: Size) -> Optional[Box]:
+    width, height = size
+    x1, y1, x2, y2 = max(0.0, box[0]), max(0.0, box[1]), min(float(width), box[2]), min(float(height), box[3])
+    if x2 - x1 < MIN_BOX_SIDE or y2 - y1 < MIN_BOX_SIDE:
+        return None
+    return [x1, y1, x2, y2]
+
+
+def rotate(boxes: List[Box], size: Size, angle: float) -> Tuple[List[Optional[Box]], Size]:
+    # Counter-clockwise around the image centre, matching cv2.getRotationMatrix2D at scale 1
+    width, height = size
+    cx, cy = width / 2, height / 2
+    a, b = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+    rotated = []
+    for x1, y1, x2, y2 in boxes:
+        corners = [(x1, y1), (x2, y1), (x1, y2), (x2, y2)]
+        xs = [a * (x - cx) + b * (y - cy) + cx for x, y in corners]
+        ys = [-b * (x - cx) + a * (y - cy) + cy for x, y in corners]
+        rotated.append([min(xs), min(ys), max(xs), max(ys)])
+    return rotated, size
+
+
+def flip_horizontal(boxes: List[Box], size: Size) -> Tuple[List[Optional[Box]], Size]:
+    width = size[0]
+    return [[width - x2, y1, width - x1, y2] for x1, y1, x2, y2 in boxes], size
+
+
+def flip_vertical(boxes: List[Box], size: Size) -> Tuple[List[Optional[Box]], Size]:
+    height = size[1]
+    return [[x1, height - y2, x2, height - y1] for x1, y1, x2, y2 in boxes], size
+
+
+def crop(boxes: List[Box], size: Size, x: float, y: float, width: float, height: float) -> Tuple[List[Optional[Box]], Size]:
+    # Slicing stops at the image edge, so the cropped image may be smaller than requested
+    x, y = int(x), int(y)
+    new_size = (min(x + int(width), size[0]) - x, min(y + int(height), size[1]) - y)
+    return [[x1 - x, y1 - y, x2 - x, y2 - y] for x1, y1, x2, y2 in boxes], new_size
+
+
+def resize(boxes: List[Box], size: Size, width: float, height: float) -> Tuple[List[Optional[Box]], Size]:
+    sx, sy = int(width) / size[0], int(height) / size[1]
+    return [[x1 * sx, y1 * sy, x2 * sx, y2 * sy] for x1, y1, x2, y2 in boxes], (int(width), int(height))
+
+
+# Pipeline operation -> box transform; operations missing here leave boxes untouched
+GEOMETRIC_TRANSFORMS: Dict[str, Callable] = {
+    "rotate": rotate,
+    "flip_horizontal": flip_horizontal,
+    "flip_vertical": flip_vertical,
+    "crop": crop,
+    "resize": resize,
+}
+
+
+def transform_answer(parsed_answer: dict, size: Size, operations: List[Tuple[str, dict]]) -> dict:
+    """
+    Maps a parsed `<OD>` answer through a pipeline's geometric operations.
+
+    Args:
+        parsed_answer (dict): The `<OD>` answer on the original image.
+        size (Size): The (width, height) of the original image.
+        operations (List[Tuple[str, dict]]): Operations as returned by `augmentation_pipeline.parse_operations`.
+
+    Returns:
+        dict: An `<OD>` answer for the augmented image, without the boxes that left it.
+    """
+    boxes = [list(map(float, box)) for box in parsed_answer["<OD>"]["bboxes"]]
+    labels = list(parsed_answer["<OD>"]["labels"])
+    for name, params in operations:
+        if name not in GEOMETRIC_TRANSFORMS:
+            continue
+        boxes, size = GEOMETRIC_TRANSFORMS[name](boxes, size, **params)
+        # Clip after every step, so a later rotation starts from what is still visible
+        kept = [(box, label) for box, label in ((_clip(box, size), label) for box, label in zip(boxes, labels)) if box is not None]
+        boxes, labels = [box for box, _ in kept], [label for _, label in kept]
+    return {"<OD>": {"bboxes": [[round(v, 2) for v in box] for box in boxes], "labels": labels}}
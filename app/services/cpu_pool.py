@@ -0,0 +1,96 @@
+"""
+Process pool for CPU-heavy per-image work.
+
+OpenCV operations such as `fastNlMeansDenoisingColored` and `grabCut` take
+seconds per image and mostly run single-threaded. Dispatching each image to
+its own pool process uses every core and keeps the event loop free. Workers
+limit OpenCV to one internal thread each so the pool does not oversubscribe
+the machine.
+"""
+
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, AsyncIterator, Callable, List, Optional
+
+from app.core.config import CPU_POOL_WORKERS, CPU_POOL_START_METHOD
+
+
+def _init_worker():
+    import cv2
+
+    cv2.setNumThreads(1)
+
+
+class CpuPool:
+    """
+    Lazily started process pool with per-item result collection.
+
+    Args:
+        workers (int): The number of worker processes.
+        start_method (str): The multiprocessing start method, "spawn" by default so workers do not inherit model state.
+    """
+
+    def __init__(self, workers: int, start_method: str):
+        self.workers = max(1, workers)
+        self.start_method = start_method
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        """The number of calls currently queued or running."""
+        return self._pending
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context(self.start_method),
+                initializer=_init_worker
+            )
+        return self._executor
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        """
+        Runs `fn(*args)` in a pool process. `fn` and its arguments must be picklable.
+        """
+        loop = asyncio.get_running_loop()
+        self._pending += 1
+        try:
+            return await loop.run_in_executor(self.executor, fn, *args)
+        finally:
+            self._pending -= 1
+
+    async def map(self, fn: Callable[..., Any], items: List[Any], *args) -> List[Any]:
+        """
+        Runs `fn(item, *args)` for every item in parallel.
+
+        Returns:
+            List[Any]: One entry per item, in input order: the return value, or the exception the call raised.
+        """
+        return await asyncio.gather(*(self.run(fn, item, *args) for item in items), return_exceptions=True)
+
+    async def imap(self, fn: Callable[..., Any], items: List[Any], *args) -> AsyncIterator[Any]:
+        """
+        Like `map`, but yields each result, in input order, as soon as it and all earlier ones are ready.
+        """
+        futures = [asyncio.ensure_future(self.run(fn, item, *args)) for item in items]
+        try:
+            for future in futures:
+                try:
+                    yield await future
+                except Exception as e:
+                    yield e
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+
+cpu_pool = CpuPool(CPU_POOL_WORKERS, CPU_POOL_START_METHOD)
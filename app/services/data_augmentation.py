@@ -1,193 +1,157 @@
-from PIL import Image, ImageOps, ImageEnhance, ImageFilter
-import aiofiles
-import io
-import os
-import numpy as np
+import asyncio
+import secrets
+from functools import partial
 from fastapi import UploadFile
+from app.core.request_context import get_request_id
+from app.services.augmentation_pipeline import augment_chunks, augment_files, parse_operations, stream_augmented_files
+from app.services.augmentation_variants import parse_ranges, stream_variants, validate_count
+from app.services.dataset_ingest import IngestSummary, aiter_chunks, resolve_source
+from app.services.metrics import stage_seconds
+from app.services.output_store import output_store
 
 
-# Directory to save processed images
-PROCESSED_IMAGES_DIR = "outputs/augemented_images"
-
-if not os.path.exists(PROCESSED_IMAGES_DIR):
-    os.makedirs(PROCESSED_IMAGES_DIR)
-
-async def save_image(image: Image.Image, file: UploadFile, prefix: str) -> str:
-    output_filename = f"{prefix}_{file.filename}"
-    output_path = os.path.join("output", output_filename)
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    async with aiofiles.open(output_path, 'wb') as out_file:
-        image.save(out_file, format=image.format)
+def save_image(data: bytes, filename: str, prefix: str, request_id: str) -> str:
+    output_filename = f"{prefix}_{filename}"
+    output_store.save_bytes("augmented", request_id, output_filename, data)
     return output_filename
 
+async def run_augmentation_pipeline(files: list[UploadFile], operations: list[dict], prefix: str = "augmented", inline: bool = False):
+    """
+    Applies an ordered list of operations to every image, decoding and encoding each image only once.
+
+    Returns the saved filenames, or with inline=True an async iterator of
+    (filename, encoded image or error) that never touches the disk.
+
+    Raises:
+        ValueError: If the operations are invalid.
+    """
+    parsed = parse_operations(operations)
+    if inline:
+        return await stream_augmented_files(files, parsed, prefix)
+    request_id = get_request_id()
+    output_store.mark_active(request_id)
+    try:
+        return await augment_files(files, parsed, partial(save_image, prefix=prefix, request_id=request_id))
+    finally:
+        output_store.mark_done(request_id)
+
+async def augment_dataset(source: str, operations: list[dict], prefix: str = "augmented", inline: bool = False):
+    """
+    Applies an ordered list of operations to every image of a server-local directory, tar or zip archive.
+
+    The dataset is read a chunk at a time. Returns an `IngestSummary` after saving the outputs under the
+    current request id, or with inline=True an async iterator of (filename, encoded image or error).
+
+    Raises:
+        ValueError: If the source may not be ingested or the operations are invalid.
+    """
+    parsed = parse_operations(operations)
+    results = augment_chunks(aiter_chunks(resolve_source(source), flatten=True), parsed, prefix)
+    if inline:
+        return results
+
+    request_id = get_request_id()
+    summary = IngestSummary()
+    output_store.mark_active(request_id)
+    try:
+        async for filename, data in results:
+            if isinstance(data, Exception):
+                summary.add_error(filename, data)
+                continue
+            with stage_seconds.time("augmentation", "save"):
+                await asyncio.to_thread(output_store.save_bytes, "augmented", request_id, filename, data)
+            summary.processed += 1
+    finally:
+        output_store.mark_done(request_id)
+    return summary
+
 async def augment_images(files: list[UploadFile], rotate: int = 0, flip_horizontal: bool = False, flip_vertical: bool = False,
                         brightness: float = 1.0, contrast: float = 1.0, saturation: float = 1.0, hue: float = 0.0,
-                        noise_level: float = 0.0, blur_radius: float = 0.0) -> list[str]:
-    output_filenames = []
-    try:
-        for file in files:
-            contents = await file.read()
-            image = Image.open(io.BytesIO(contents))
-
-            if rotate:
-                image = image.rotate(rotate)
-            if flip_horizontal:
-                image = ImageOps.mirror(image)
-            if flip_vertical:
-                image = ImageOps.flip(image)
-            if brightness != 1.0:
-                enhancer = ImageEnhance.Brightness(image)
-                image = enhancer.enhance(brightness)
-            if contrast != 1.0:
-                enhancer = ImageEnhance.Contrast(image)
-                image = enhancer.enhance(contrast)
-            if saturation != 1.0:
-                enhancer = ImageEnhance.Color(image)
-                image = enhancer.enhance(saturation)
-            if hue != 0.0:
-                image = image.convert('HSV')
-                np_img = np.array(image)
-                np_img[..., 0] = (np_img[..., 0].astype(int) + int(hue * 255)) % 255
-                image = Image.fromarray(np_img, 'HSV').convert('RGB')
-            if noise_level > 0.0:
-                np_img = np.array(image)
-                noise = np.random.normal(0, noise_level, np_img.shape).astype(np.uint8)
-                np_img = np.clip(np_img + noise, 0, 255)
-                image = Image.fromarray(np_img)
-            if blur_radius > 0.0:
-                image = image.filter(ImageFilter.GaussianBlur(radius=blur_radius))
-
-            output_filename = await save_image(image, file, "augmented")
-            output_filenames.append(output_filename)
-        
-        return output_filenames
-    except Exception as e:
-        raise e
+                        noise_level: float = 0.0, blur_radius: float = 0.0, inline: bool = False):
+    operations = []
+    if rotate:
+        operations.append({"op": "rotate", "angle": rotate})
+    if flip_horizontal:
+        operations.append({"op": "flip_horizontal"})
+    if flip_vertical:
+        operations.append({"op": "flip_vertical"})
+    if brightness != 1.0:
+        operations.append({"op": "brightness", "factor": brightness})
+    if contrast != 1.0:
+        operations.append({"op": "contrast", "factor": contrast})
+    if saturation != 1.0:
+        operations.append({"op": "saturation", "factor": saturation})
+    if hue != 0.0:
+        operations.append({"op": "hue", "shift": hue})
+    if noise_level > 0.0:
+        operations.append({"op": "gaussian_noise", "level": noise_level})
+    if blur_radius > 0.0:
+        operations.append({"op": "blur", "radius": blur_radius})
+    return await run_augmentation_pipeline(files, operations, "augmented", inline)
 
 # Functions for individual augmentations with level control
 
-async def rotate_images(files: list[UploadFile], rotate: int) -> list[str]:
-    output_filenames = []
-    try:
-        for file in files:
-            contents = await file.read()
-            image = Image.open(io.BytesIO(contents))
-            image = image.rotate(rotate)
-            output_filename = await save_image(image, file, "rotated")
-            output_filenames.append(output_filename)
-        
-        return output_filenames
-    except Exception as e:
-        raise e
-
-async def flip_images(files: list[UploadFile], flip_horizontal: bool, flip_vertical: bool) -> list[str]:
-    output_filenames = []
-    try:
-        for file in files:
-            contents = await file.read()
-            image = Image.open(io.BytesIO(contents))
-            if flip_horizontal:
-                image = ImageOps.mirror(image)
-            if flip_vertical:
-                image = ImageOps.flip(image)
-            output_filename = await save_image(image, file, "flipped")
-            output_filenames.append(output_filename)
-        
-        return output_filenames
-    except Exception as e:
-        raise e
-
-async def adjust_brightness(files: list[UploadFile], brightness: float) -> list[str]:
-    output_filenames = []
-    try:
-        for file in files:
-            contents = await file.read()
-            image = Image.open(io.BytesIO(contents))
-            enhancer = ImageEnhance.Brightness(image)
-            image = enhancer.enhance(brightness)
-            output_filename = await save_image(image, file, "brightness_adjusted")
-            output_filenames.append(output_filename)
-        
-        return output_filenames
-    except Exception as e:
-        raise e
-
-async def adjust_contrast(files: list[UploadFile], contrast: float) -> list[str]:
-    output_filenames = []
-    try:
-        for file in files:
-            contents = await file.read()
-            image = Image.open(io.BytesIO(contents))
-            enhancer = ImageEnhance.Contrast(image)
-            image = enhancer.enhance(contrast)
-            output_filename = await save_image(image, file, "contrast_adjusted")
-            output_filenames.append(output_filename)
-        
-        return output_filenames
-    except Exception as e:
-        raise e
-
-async def adjust_saturation(files: list[UploadFile], saturation: float) -> list[str]:
-    output_filenames = []
-    try:
-        for file in files:
-            contents = await file.read()
-            image = Image.open(io.BytesIO(contents))
-            enhancer = ImageEnhance.Color(image)
-            image = enhancer.enhance(saturation)
-            output_filename = await save_image(image, file, "saturation_adjusted")
-            output_filenames.append(output_filename)
-        
-        return output_filenames
-    except Exception as e:
-        raise e
-
-async def adjust_hue(files: list[UploadFile], hue: float) -> list[str]:
-    output_filenames = []
-    try:
-        for file in files:
-            contents = await file.read()
-            image = Image.open(io.BytesIO(contents))
-            image = image.convert('HSV')
-            np_img = np.array(image)
-            np_img[..., 0] = (np_img[..., 0].astype(int) + int(hue * 255)) % 255
-            image = Image.fromarray(np_img, 'HSV').convert('RGB')
-            output_filename = await save_image(image, file, "hue_adjusted")
-            output_filenames.append(output_filename)
-        
-        return output_filenames
-    except Exception as e:
-        raise e
-
-async def add_gaussian_noise(files: list[UploadFile], noise_level: float) -> list[str]:
-    output_filenames = []
-    try:
-        for file in files:
-            contents = await file.read()
-            image = Image.open(io.BytesIO(contents))
-            if noise_level > 0.0:
-                np_img = np.array(image)
-                noise = np.random.normal(0, noise_level, np_img.shape).astype(np.uint8)
-                np_img = np.clip(np_img + noise, 0, 255)
-                image = Image.fromarray(np_img)
-            output_filename = await save_image(image, file, "gaussian_noise_added")
-            output_filenames.append(output_filename)
-        
-        return output_filenames
-    except Exception as e:
-        raise e
-
-async def apply_blur(files: list[UploadFile], blur_radius: float) -> list[str]:
-    output_filenames = []
+async def rotate_images(files: list[UploadFile], rotate: int, inline: bool = False):
+    return await run_augmentation_pipeline(files, [{"op": "rotate", "angle": rotate}], "rotated", inline)
+
+async def flip_images(files: list[UploadFile], flip_horizontal: bool, flip_vertical: bool, inline: bool = False):
+    operations = []
+    if flip_horizontal:
+        operations.append({"op": "flip_horizontal"})
+    if flip_vertical:
+        operations.append({"op": "flip_vertical"})
+    return await run_augmentation_pipeline(files, operations, "flipped", inline)
+
+async def adjust_brightness(files: list[UploadFile], brightness: float, inline: bool = False):
+    return await run_augmentation_pipeline(files, [{"op": "brightness", "factor": brightness}], "brightness_adjusted", inline)
+
+async def adjust_contrast(files: list[UploadFile], contrast: float, inline: bool = False):
+    return await run_augmentation_pipeline(files, [{"op": "contrast", "factor": contrast}], "contrast_adjusted", inline)
+
+async def adjust_saturation(files: list[UploadFile], saturation: float, inline: bool = False):
+    return await run_augmentation_pipeline(files, [{"op": "saturation", "factor": saturation}], "saturation_adjusted", inline)
+
+async def adjust_hue(files: list[UploadFile], hue: float, inline: bool = False):
+    return await run_augmentation_pipeline(files, [{"op": "hue", "shift": hue}], "hue_adjusted", inline)
+
+async def add_gaussian_noise(files: list[UploadFile], noise_level: float, inline: bool = False):
+    operations = [{"op": "gaussian_noise", "level": noise_level}] if noise_level > 0.0 else []
+    return await run_augmentation_pipeline(files, operations, "gaussian_noise_added", inline)
+
+async def apply_blur(files: list[UploadFile], blur_radius: float, inline: bool = False):
+    operations = [{"op": "blur", "radius": blur_radius}] if blur_radius > 0.0 else []
+    return await run_augmentation_pipeline(files, operations, "blur_applied", inline)
+
+async def generate_variants(files: list[UploadFile], count: int, ranges: dict, seed: int = None, inline: bool = False):
+    """
+    Generates `count` randomized variants of every image from a single decode.
+
+    Returns (seed, result), where the seed is the given one or a freshly drawn one that reproduces the
+    variants, and the result is (saved filenames, errors), or with inline=True an async iterator of
+    (filename, encoded image or error) that never touches the disk.
+
+    Raises:
+        ValueError: If the count or the ranges are invalid.
+    """
+    validate_count(count)
+    parsed = parse_ranges(ranges)
+    if seed is None:
+        seed = secrets.randbits(32)
+    results = await stream_variants(files, count, parsed, seed)
+    if inline:
+        return seed, results
+
+    request_id = get_request_id()
+    output_store.mark_active(request_id)
     try:
-        for file in files:
-            contents = await file.read()
-            image = Image.open(io.BytesIO(contents))
-            if blur_radius > 0.0:
-                image = image.filter(ImageFilter.GaussianBlur(radius=blur_radius))
-            output_filename = await save_image(image, file, "blur_applied")
-            output_filenames.append(output_filename)
-        
-        return output_filenames
-    except Exception as e:
-        raise e
+        filenames, errors = [], []
+        async for filename, data in results:
+            if isinstance(data, Exception):
+                errors.append({"filename": filename, "error": str(data)})
+            else:
+                with stage_seconds.time("augmentation", "save"):
+                    await asyncio.to_thread(output_store.save_bytes, "augmented", request_id, filename, data)
+                filenames.append(filename)
+    finally:
+        output_store.mark_done(request_id)
+    return seed, (filenames, errors)
@@ -0,0 +1,267 @@
+"""
+Lazy reading of server-local image datasets for bulk ingestion.
+
+Instead of uploading every file, a request can name a directory, a tar archive
+(plain, gzip, bzip2 or xz) or a zip archive on the server, as long as it lies
+under one of `INGEST_ROOTS`. `iter_images` enumerates it lazily: directories
+are walked one directory at a time, tar archives are read as a stream in
+member order without seeking, and zip archives are memory-mapped so reading a
+member only touches its own pages. `aiter_chunks` runs that enumeration in a
+worker thread and hands out `INGEST_CHUNK_SIZE` images at a time, reading the
+next chunk while the consumer works on the current one, so at most two chunks
+are in memory whatever the size of the dataset.
+
+Files that cannot be read, or are larger than `INGEST_MAX_FILE_BYTES`, come
+out as an exception in place of their bytes, the way the inline result
+iterators report per-image failures, so one bad file never stops a dataset.
+"""
+
+import asyncio
+import mmap
+import os
+import posixpath
+import tarfile
+import zipfile
+import zlib
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Iterator, List, Tuple, Union
+
+from app.core.config import INGEST_CHUNK_SIZE, INGEST_MAX_FILE_BYTES, INGEST_ROOTS
+from app.services.metrics import stage_seconds
+
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff"}
+TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+# Per-image errors kept in an ingestion summary
+MAX_REPORTED_ERRORS = 100
+
+Image = Tuple[str, Union[bytes, Exception]]
+
+
+@dataclass
+class IngestSummary:
+    processed: int = 0
+    failed: int = 0
+    errors: List[dict] = field(default_factory=list)
+
+    def add_error(self, filename: str, error: Union[str, Exception]):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"filename": filename, "error": str(error)})
+
+    def to_dict(self) -> dict:
+        return {"processed": self.processed, "failed": self.failed, "errors": self.errors}
+
+
+def _within_roots(path: str) -> bool:
+    return any(os.path.commonpath([path, root]) == root for root in INGEST_ROOTS)
+
+
+def source_kind(path: str) -> str:
+    """
+    Returns "directory", "tar" or "zip" for an existing dataset path.
+
+    Raises:
+        ValueError: If the path is neither a directory nor a file with a supported archive extension.
+    """
+    if os.path.isdir(path):
+        return "directory"
+    lowered = path.lower()
+    if os.path.isfile(path) and lowered.endswith(".zip"):
+        return "zip"
+    if os.path.isfile(path) and lowered.endswith(TAR_SUFFIXES):
+        return "tar"
+    raise ValueError("Dataset source must be an existing directory, tar archive or zip archive")
+
+
+def resolve_source(path: str) -> str:
+    """
+    Resolves a requested dataset path, following symlinks, and checks that it may be ingested.
+
+    Returns:
+        str: The resolved path.
+
+    Raises:
+        ValueError: If ingestion is disabled, the path lies outside every allowed root, or it is not a directory
+            or a supported archive.
+    """
+    if not INGEST_ROOTS:
+        raise ValueError("Dataset ingestion is disabled; set INGEST_ROOTS to allow it")
+    resolved = os.path.realpath(path)
+    # Checked before anything else, so nothing is revealed about paths outside the roots
+    if not _within_roots(resolved):
+        raise ValueError("Dataset source is outside the allowed ingestion roots")
+    source_kind(resolved)
+    return resolved
+
+
+def _is_image(name: str) -> bool:
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+
+def _clean_name(name: str) -> str:
+    # Archive member names are untrusted: keep them relative and free of ".." so they are safe in ZIP responses
+    parts = [part for part in posixpath.normpath(name.replace("\\", "/")).split("/") if part not in ("", ".", "..")]
+    return "/".join(parts)
+
+
+def flat_name(name: str) -> str:
+    """Turns a dataset-relative path into a single filename, so same-named images in different folders stay apart."""
+    return name.replace("/", "_")
+
+
+def _too_large() -> ValueError:
+    return ValueError(f"File is larger than the {INGEST_MAX_FILE_BYTES} bytes allowed")
+
+
+def _iter_directory(directory: str) -> Iterator[Image]:
+    # Depth-first in name order, listing one directory at a time
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as scan:
+                entries = sorted(scan, key=lambda entry: entry.name)
+        except OSError as e:
+            yield os.path.relpath(current, directory).replace(os.sep, "/"), e
+            continue
+        subdirectories = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+                continue
+            if not _is_image(entry.name) or not entry.is_file():
+                continue
+            name = os.path.relpath(entry.path, directory).replace(os.sep, "/")
+            # A symlink may point anywhere; only follow it to files under an allowed root
+            if entry.is_symlink() and not _within_roots(os.path.realpath(entry.path)):
+                yield name, ValueError("Symlink points outside the allowed ingestion roots")
+                continue
+            try:
+                size = entry.stat().st_size
+                if size > INGEST_MAX_FILE_BYTES:
+                    yield name, _too_large()
+                    continue
+                with open(entry.path, "rb") as f:
+                    yield name, f.read()
+            except OSError as e:
+                yield name, e
+        stack.extend(reversed(subdirectories))
+
+
+def _iter_tar(path: str) -> Iterator[Image]:
+    # "r|*" reads the archive strictly front to back, decompressing on the fly, so members are never seeked to
+    try:
+        with tarfile.open(path, mode="r|*") as archive:
+            for member in archive:
+                if not member.isfile() or not _is_image(member.name):
+                    continue
+                name = _clean_name(member.name)
+                if member.size > INGEST_MAX_FILE_BYTES:
+                    yield name, _too_large()
+                    continue
+                # A member's data must be read before the stream moves on to the next one
+                yield name, archive.extractfile(member).read()
+    except (tarfile.TarError, EOFError, zlib.error) as e:
+        # A stream cannot skip past damage, so the rest of the archive is lost
+        raise ValueError(f"Invalid tar archive: {e}")
+
+
+class _MappedFile:
+    # zipfile wants `seekable`, which mmap objects only have from Python 3.13
+    def __init__(self, mapped: mmap.mmap):
+        self._mapped = mapped
+
+    def __getattr__(self, name):
+        return getattr(self._mapped, name)
+
+    def seekable(self) -> bool:
+        return True
+
+
+def _iter_zip(path: str) -> Iterator[Image]:
+    with open(path, "rb") as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError("Zip archive is empty")
+        with mapped:
+            try:
+                archive = zipfile.ZipFile(_MappedFile(mapped))
+            except (zipfile.BadZipFile, ValueError):
+                raise ValueError("Invalid zip archive")
+            with archive:
+                for info in archive.infolist():
+                    if info.is_dir() or not _is_image(info.filename):
+                        continue
+                    name = _clean_name(info.filename)
+                    if info.file_size > INGEST_MAX_FILE_BYTES:
+                        yield name, _too_large()
+                        continue
+                    try:
+                        with archive.open(info) as member:
+                            # The declared size cannot be trusted, so never decompress more than the limit
+                            contents = member.read(INGEST_MAX_FILE_BYTES + 1)
+                    except Exception as e:
+                        yield name, e
+                        continue
+                    yield name, _too_large() if len(contents) > INGEST_MAX_FILE_BYTES else contents
+
+
+def iter_images(source: str) -> Iterator[Image]:
+    """
+    Lazily yields every image of a resolved dataset source.
+
+    Args:
+        source (str): A path returned by `resolve_source`.
+
+    Returns:
+        Iterator[Tuple[str, Union[bytes, Exception]]]: The image's path relative to the source, with "/" separators,
+            and its bytes, or the exception that kept it from being read.
+    """
+    kind = source_kind(source)
+    if kind == "directory":
+        return _iter_directory(source)
+    if kind == "tar":
+        return _iter_tar(source)
+    return _iter_zip(source)
+
+
+def _take(images: Iterator[Image], count: int, flatten: bool) -> List[Image]:
+    chunk = []
+    with stage_seconds.time("ingest", "read"):
+        for name, contents in images:
+            chunk.append((flat_name(name) if flatten else name, contents))
+            if len(chunk) == count:
+                break
+    return chunk
+
+
+async def aiter_chunks(source: str, chunk_size: int = INGEST_CHUNK_SIZE, flatten: bool = False) -> AsyncIterator[List[Image]]:
+    """
+    Reads a resolved dataset source in chunks from a worker thread, one chunk ahead of the consumer.
+
+    Args:
+        source (str): A path returned by `resolve_source`.
+        chunk_size (int): The images per chunk.
+        flatten (bool): Whether to name images with `flat_name` instead of their relative path.
+
+    Returns:
+        AsyncIterator[List[Tuple[str, Union[bytes, Exception]]]]: Non-empty chunks of images as yielded by `iter_images`.
+    """
+    images = iter_images(source)
+    chunk_size = max(1, chunk_size)
+    pending = asyncio.ensure_future(asyncio.to_thread(_take, images, chunk_size, flatten))
+    try:
+        while True:
+            chunk = await pending
+            if not chunk:
+                return
+            pending = asyncio.ensure_future(asyncio.to_thread(_take, images, chunk_size, flatten))
+            yield chunk
+    finally:
+        pending.cancel()
+        # A read still running in its thread cannot be interrupted; the generator is then closed when collected
+        if not images.gi_running:
+            images.close()
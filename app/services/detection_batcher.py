@@ -0,0 +1,116 @@
+"""
+Cross-request dynamic micro-batching for the detection model.
+
+Every call to `DetectionBatcher.submit` enqueues a single image under a batch
+key (the generation profile). A background task gathers pending images with
+the same key from all in-flight requests until either `max_batch_size` images
+are queued or `max_wait_ms` has passed since the first one arrived, runs the
+whole batch through the model in one call on the inference worker thread and
+resolves each caller's future with its own result.
+"""
+
+import asyncio
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from app.services.inference_worker import InferenceWorker
+
+
+class DetectionBatcher:
+    """
+    Groups concurrent single-image detection requests into padded batches.
+
+    Images are only batched with images submitted under the same key. When
+    several keys are pending, the one whose oldest image has waited longest
+    is served first.
+
+    Args:
+        run_batch (Callable[[Hashable, List[Any]], List[Any]]): Runs the model on a batch key and a list of images and returns one result per image, in order.
+        max_batch_size (int): The maximum number of images per model call.
+        max_wait_ms (float): How long the first queued image may wait for others to join its batch.
+        worker (InferenceWorker): The executor the blocking `run_batch` call is dispatched to.
+    """
+
+    def __init__(self, run_batch: Callable[[Hashable, List[Any]], List[Any]], max_batch_size: int, max_wait_ms: float, worker: InferenceWorker):
+        self._run_batch = run_batch
+        self._worker = worker
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._pending: Dict[Hashable, Deque[Tuple[float, Any, asyncio.Future]]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def queued(self) -> int:
+        """The number of images waiting to be batched."""
+        return sum(len(queue) for queue in self._pending.values())
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._pending = {}
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._batch_loop())
+
+    async def submit(self, image: Any, key: Hashable = None) -> Any:
+        """
+        Queues one image for detection and waits for its result.
+
+        Args:
+            image (Any): The image to run through the model.
+            key (Hashable): The batch key; only images with equal keys share a model call.
+
+        Returns:
+            Any: The result produced by `run_batch` for this image.
+        """
+        self._ensure_started()
+        future = self._loop.create_future()
+        self._pending.setdefault(key, deque()).append((self._loop.time(), image, future))
+        self._wakeup.set()
+        return await future
+
+    async def _collect(self) -> Tuple[Hashable, List[Tuple[Any, asyncio.Future]]]:
+        while not self._pending:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+        key = min(self._pending, key=lambda k: self._pending[k][0][0])
+        queue = self._pending[key]
+        deadline = queue[0][0] + self.max_wait
+        while len(queue) < self.max_batch_size:
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                break
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+
+        batch = [queue.popleft() for _ in range(min(len(queue), self.max_batch_size))]
+        if not queue:
+            del self._pending[key]
+        return key, [(image, future) for _, image, future in batch]
+
+    async def _batch_loop(self):
+        while True:
+            key, batch = await self._collect()
+            batch = [(image, future) for image, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+            await self._dispatch(key, batch)
+
+    async def _dispatch(self, key: Hashable, batch: List[Tuple[Any, asyncio.Future]]):
+        try:
+            results = await self._worker.run(self._run_batch, key, [image for image, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,315 @@
+"""
+Content-addressed cache for parsed detection results.
+
+Entries are keyed by the SHA-256 of the image bytes plus a digest of the
+prompt, model id and generation parameters, so the same image uploaded again
+with the same settings skips the model entirely. Results live in a bounded
+in-memory LRU tier backed by a persistent on-disk tier of JSON files, which
+evicts its least recently used files beyond `DETECTION_CACHE_DISK_MAX_BYTES`.
+Concurrent misses of one key share a single computation, so identical images
+arriving together run the model once.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from app.core.config import (
+    DETECTION_CACHE_ENABLED, DETECTION_CACHE_MAX_ENTRIES, DETECTION_CACHE_DIR, DETECTION_CACHE_DISK_MAX_BYTES
+)
+
+
+class DetectionCache:
+    """
+    Two-tier (memory LRU + disk) cache of detection results.
+
+    Keys have the form `<image sha256>-<params sha256>`, which lets every entry
+    of one image be invalidated by its image hash alone.
+
+    The disk tier's files are indexed in memory, least recently used first, so the size limit is enforced
+    without scanning the directory. Each process indexes the files it has seen, so several workers sharing
+    a directory each keep their own share of it within the limit.
+
+    Args:
+        max_entries (int): The maximum number of entries kept in memory.
+        cache_dir (str): The directory of the on-disk tier, or an empty string to disable it.
+        enabled (bool): Whether lookups and stores do anything at all.
+        max_disk_bytes (int): Total size of the disk tier above which its least recently used files are evicted; 0 disables the limit.
+    """
+
+    def __init__(self, max_entries: int, cache_dir: str, enabled: bool = True, max_disk_bytes: int = 0):
+        self.max_entries = max(0, max_entries)
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.max_disk_bytes = max(0, max_disk_bytes)
+        self._memory: "OrderedDict[str, Any]" = OrderedDict()
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_bytes = 0
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.disk_evictions = 0
+        if enabled and cache_dir:
+            self._index_disk()
+
+    def _index_disk(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+        files = []
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.name[:-len(".json")], stat.st_size))
+        for _, key, size in sorted(files):
+            self._disk[key] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    @staticmethod
+    def image_hash(image_bytes: bytes) -> str:
+        return hashlib.sha256(image_bytes).hexdigest()
+
+    @staticmethod
+    def make_key(image_bytes: bytes, prompt: str, model_id: str, generation_params: dict) -> str:
+        """
+        Builds the cache key of an image under the given prompt, model and generation parameters.
+        """
+        params = json.dumps(
+            {"prompt": prompt, "model_id": model_id, "generation": generation_params},
+            sort_keys=True, default=str
+        )
+        params_hash = hashlib.sha256(params.encode("utf-8")).hexdigest()
+        return f"{DetectionCache.image_hash(image_bytes)}-{params_hash}"
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _touch_disk(self, key: str, size: Optional[int] = None):
+        # Marks a disk entry as most recently used, indexing it with its size if it is new or was rewritten
+        with self._lock:
+            if size is not None:
+                self._disk_bytes += size - self._disk.get(key, 0)
+                self._disk[key] = size
+            if key in self._disk:
+                self._disk.move_to_end(key)
+
+    def _evict_disk(self):
+        if self.max_disk_bytes == 0:
+            return
+        evicted = []
+        with self._lock:
+            while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+                key, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                evicted.append(key)
+            self.disk_evictions += len(evicted)
+        for key in evicted:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def _remember(self, key: str, value: Any):
+        if self.max_entries == 0:
+            return
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def get_memory(self, key: str) -> Optional[Any]:
+        """
+        Looks a key up in the memory tier only. Never blocks on I/O.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+        return value
+
+    def get_disk(self, key: str) -> Optional[Any]:
+        """
+        Looks a key up in the disk tier and promotes hits to memory. Counts a miss if it is absent.
+        """
+        if not self.enabled:
+            return None
+        if self.cache_dir:
+            path = self._disk_path(key)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    value = json.load(f)
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                # Files written by other workers are indexed as they are found
+                self._touch_disk(key, None if key in self._disk else os.path.getsize(path))
+                self._remember(key, value)
+                with self._lock:
+                    self.disk_hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Looks a key up in memory, then on disk.
+        """
+        value = self.get_memory(key)
+        if value is None:
+            value = self.get_disk(key)
+        return value
+
+    def put(self, key: str, value: Any):
+        """
+        Stores a value in both tiers. The disk write is atomic.
+        """
+        if not self.enabled:
+            return
+        self._remember(key, value)
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+        self._touch_disk(key, os.path.getsize(path))
+        self._evict_disk()
+
+    async def lookup(self, key: str) -> Optional[Any]:
+        """
+        Looks a key up in memory, then waits for a computation of it already in flight, then looks on disk.
+
+        A failed in-flight computation counts as a miss, leaving the caller to compute the value itself.
+        """
+        value = self.get_memory(key)
+        if value is not None or not self.enabled:
+            return value
+        task = self._in_flight.get(key)
+        if task is not None:
+            with self._lock:
+                self.coalesced += 1
+            try:
+                value, _ = await asyncio.shield(task)
+                return value
+            except Exception:
+                return None
+        return await asyncio.to_thread(self.get_disk, key)
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Returns the cached value of a key, computing and storing it on a miss.
+
+        Concurrent calls with the same key share one lookup and one computation. The computation runs as a task
+        of its own, so a caller that goes away never cancels it for the others.
+
+        Returns:
+            Tuple[Any, bool]: The value, and whether it was computed rather than found in the cache.
+        """
+        if not self.enabled:
+            return await compute(), True
+        value = self.get_memory(key)
+        if value is not None:
+            return value, False
+        task = self._in_flight.get(key)
+        if task is not None:
+            with self._lock:
+                self.coalesced += 1
+            value, _ = await asyncio.shield(task)
+            return value, False
+        task = self._in_flight[key] = asyncio.ensure_future(self._load_or_compute(key, compute))
+        task.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(task)
+
+    async def _load_or_compute(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        value = await asyncio.to_thread(self.get_disk, key)
+        if value is not None:
+            return value, False
+        value = await compute()
+        await asyncio.to_thread(self.put, key, value)
+        return value, True
+
+    def _finish(self, key: str, task: asyncio.Future):
+        self._in_flight.pop(key, None)
+        # Retrieved so a failure nobody waited for is not logged as never retrieved
+        if not task.cancelled():
+            task.exception()
+
+    def invalidate(self, image_hash: Optional[str] = None) -> int:
+        """
+        Removes cached entries.
+
+        Args:
+            image_hash (Optional[str]): The SHA-256 of an image whose entries should be removed. Removes everything if None.
+
+        Returns:
+            int: The number of distinct entries removed.
+        """
+        removed = set()
+        with self._lock:
+            keys = [k for k in self._memory if image_hash is None or k.startswith(f"{image_hash}-")]
+            for key in keys:
+                del self._memory[key]
+            removed.update(keys)
+
+        if self.cache_dir and os.path.isdir(self.cache_dir):
+            shards = [image_hash[:2]] if image_hash else os.listdir(self.cache_dir)
+            for shard in shards:
+                shard_dir = os.path.join(self.cache_dir, shard)
+                if not os.path.isdir(shard_dir):
+                    continue
+                for entry in os.scandir(shard_dir):
+                    # Skips the temporary files of writes in progress; `put` renames them into place when done
+                    if not entry.name.endswith(".json"):
+                        continue
+                    if image_hash is None or entry.name.startswith(f"{image_hash}-"):
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            # Removed concurrently, e.g. by eviction or another invalidation
+                            continue
+                        removed.add(entry.name[:-len(".json")])
+        with self._lock:
+            for key in [k for k in self._disk if image_hash is None or k.startswith(f"{image_hash}-")]:
+                self._disk_bytes -= self._disk.pop(key)
+        return len(removed)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "memory_entries": len(self._memory),
+                "max_memory_entries": self.max_entries,
+                "disk_dir": self.cache_dir or None,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "max_disk_bytes": self.max_disk_bytes or None,
+                "disk_evictions": self.disk_evictions,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else None,
+            }
+
+
+detection_cache = DetectionCache(
+    DETECTION_CACHE_MAX_ENTRIES, DETECTION_CACHE_DIR, DETECTION_CACHE_ENABLED, DETECTION_CACHE_DISK_MAX_BYTES
+)
@@ -0,0 +1,336 @@
+"""
+Asynchronous detection jobs.
+
+Submitting a job spools the uploads to the job's own directory and returns at
+once; detection runs in a background task that feeds the shared batcher a
+bounded number of images at a time and records progress. Every job streams its
+rows, per image as detections complete, into its own CSV, Parquet or XLSX
+file, so concurrent jobs never overwrite each other and memory stays flat.
+
+Jobs can also read a server-local directory or archive in place of uploads
+(see `dataset_ingest`). Nothing is spooled then; the job reads the dataset in
+chunks as detection frees slots, and its total grows as images are found.
+
+A job's `status.json` is rewritten when it starts running, every
+`JOB_STATUS_SAVE_EVERY` images and every `JOB_STATUS_SAVE_INTERVAL_SECONDS`, so
+other workers see its progress. A queued or running job whose status file has
+not been rewritten for several intervals was cut off by a restart, and is
+marked failed at startup by `fail_interrupted`.
+"""
+
+import asyncio
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from fastapi import UploadFile
+
+from app.core.config import (
+    JOB_MAX_CONCURRENT, JOB_MAX_IN_FLIGHT_IMAGES, JOB_STATUS_SAVE_EVERY, JOB_STATUS_SAVE_INTERVAL_SECONDS
+)
+from app.services.bounding_boxes import answer_to_rows, detect_image
+from app.services.dataset_ingest import aiter_chunks, resolve_source
+from app.services.exporters import ResultWriter, get_writer_class
+from app.services.generation_profiles import get_profile
+from app.services.output_store import OutputStore, output_store
+
+
+_JOB_ID = re.compile(r"[0-9a-f]{32}")
+
+# Per-image errors kept in the job status
+MAX_REPORTED_ERRORS = 100
+
+# Status files of unfinished jobs older than this many save intervals belong to jobs no worker is running
+STALE_STATUS_INTERVALS = 6
+
+UNFINISHED_STATUSES = ("queued", "running")
+
+
+@dataclass
+class DetectionJob:
+    job_id: str
+    total: int
+    profile: Optional[str] = None
+    export_format: str = "xlsx"
+    source: Optional[str] = None
+    status: str = "queued"
+    done: int = 0
+    failed: int = 0
+    errors: List[dict] = field(default_factory=list)
+    error: Optional[str] = None
+    result_filename: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class DetectionJobManager:
+    """
+    Runs detection jobs in the background and tracks their progress.
+
+    Args:
+        store (OutputStore): The output store holding one "jobs" entry per job.
+        max_concurrent (int): The maximum number of jobs processed at once; further jobs wait as "queued".
+        max_in_flight (int): The maximum number of images of one job awaiting detection at once.
+    """
+
+    def __init__(self, store: OutputStore, max_concurrent: int, max_in_flight: int):
+        self.store = store
+        self.max_in_flight = max(1, max_in_flight)
+        self._running = asyncio.Semaphore(max(1, max_concurrent))
+        self._jobs: Dict[str, DetectionJob] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def job_dir(self, job_id: str) -> str:
+        return self.store.request_dir("jobs", job_id)
+
+    def _save_status(self, job: DetectionJob):
+        path = os.path.join(self.job_dir(job.job_id), "status.json")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(job.to_dict(), f)
+        os.replace(f"{path}.tmp", path)
+
+    def fail_interrupted(self) -> int:
+        """
+        Marks jobs left queued or running by a worker that is gone as failed; called at startup.
+
+        A job counts as interrupted when no worker of this process runs it and its status file has not been
+        rewritten for `STALE_STATUS_INTERVALS` save intervals, so the live jobs of other workers are left alone.
+
+        Returns:
+            int: The number of jobs marked failed.
+        """
+        stale_before = time.time() - STALE_STATUS_INTERVALS * JOB_STATUS_SAVE_INTERVAL_SECONDS
+        failed = 0
+        try:
+            job_ids = os.listdir(self.store.kind_dir("jobs"))
+        except OSError:
+            return 0
+        for job_id in job_ids:
+            if job_id in self._jobs or not _JOB_ID.fullmatch(job_id):
+                continue
+            path = os.path.join(self.job_dir(job_id), "status.json")
+            try:
+                if os.path.getmtime(path) > stale_before:
+                    continue
+                with open(path, "r", encoding="utf-8") as f:
+                    job = DetectionJob(**json.load(f))
+            except (OSError, ValueError, TypeError):
+                continue
+            if job.status not in UNFINISHED_STATUSES:
+                continue
+            job.status = "failed"
+            job.error = "Interrupted by a server restart"
+            job.finished_at = time.time()
+            shutil.rmtree(os.path.join(self.job_dir(job_id), "inputs"), ignore_errors=True)
+            self._save_status(job)
+            self.store.record("jobs", job_id, path)
+            failed += 1
+        return failed
+
+    async def _report_progress(self, job: DetectionJob, progressed: asyncio.Event):
+        # Rewrites the status file whenever `progressed` is set and on every interval, until the job finishes;
+        # the only writer while the job is unfinished, so saves never overlap
+        while True:
+            try:
+                await asyncio.wait_for(progressed.wait(), JOB_STATUS_SAVE_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            progressed.clear()
+            if job.status not in UNFINISHED_STATUSES:
+                return
+            await asyncio.to_thread(self._save_status, job)
+
+    def get(self, job_id: str) -> Optional[DetectionJob]:
+        """
+        Looks a job up by id, falling back to its status file for jobs run by another worker or before a restart.
+        """
+        if not _JOB_ID.fullmatch(job_id):
+            return None
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        if self.store.get(job_id, "jobs") is None:
+            return None
+        try:
+            with open(os.path.join(self.job_dir(job_id), "status.json"), "r", encoding="utf-8") as f:
+                return DetectionJob(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def result_path(self, job: DetectionJob) -> Optional[str]:
+        if job.status != "completed" or not job.result_filename:
+            return None
+        return os.path.join(self.job_dir(job.job_id), job.result_filename)
+
+    async def submit(self, files: List[UploadFile], profile_name: Optional[str] = None, export_format: str = "xlsx") -> DetectionJob:
+        """
+        Spools the uploaded images to disk and starts processing them in the background.
+
+        Args:
+            files (List[UploadFile]): A list of uploaded image files.
+            profile_name (Optional[str]): The generation profile to use.
+            export_format (str): The results file format: "xlsx", "csv" or "parquet".
+
+        Returns:
+            DetectionJob: The queued job.
+
+        Raises:
+            ValueError: If the generation profile or export format is unknown.
+        """
+        get_profile(profile_name)
+        get_writer_class(export_format)
+        job = DetectionJob(job_id=uuid.uuid4().hex, total=len(files), profile=profile_name, export_format=export_format)
+        self.store.mark_active(job.job_id)
+        inputs = []
+        try:
+            input_dir = os.path.join(self.job_dir(job.job_id), "inputs")
+            os.makedirs(input_dir)
+            for index, file in enumerate(files):
+                path = os.path.join(input_dir, f"{index:06d}")
+                await asyncio.to_thread(_spool, file, path)
+                inputs.append((file.filename, path))
+        except BaseException:
+            # A job that never started would otherwise stay active, and so never be evicted
+            self.store.mark_done(job.job_id)
+            self.store.delete(job.job_id)
+            raise
+
+        return await self._start(job, _read_spooled(inputs))
+
+    async def submit_source(self, source: str, profile_name: Optional[str] = None, export_format: str = "xlsx") -> DetectionJob:
+        """
+        Starts processing every image of a server-local directory, tar or zip archive in the background.
+
+        Args:
+            source (str): The dataset path, under one of the allowed ingestion roots.
+            profile_name (Optional[str]): The generation profile to use.
+            export_format (str): The results file format: "xlsx", "csv" or "parquet".
+
+        Returns:
+            DetectionJob: The queued job, with a total of 0 until its images are enumerated.
+
+        Raises:
+            ValueError: If the source may not be ingested, or the generation profile or export format is unknown.
+        """
+        get_profile(profile_name)
+        get_writer_class(export_format)
+        source = resolve_source(source)
+        job = DetectionJob(job_id=uuid.uuid4().hex, total=0, profile=profile_name, export_format=export_format, source=source)
+        self.store.mark_active(job.job_id)
+        self.job_dir(job.job_id)
+        return await self._start(job, _read_source(job, source))
+
+    async def _start(self, job: DetectionJob, images: AsyncIterator[Tuple[str, Union[bytes, Exception]]]) -> DetectionJob:
+        self._jobs[job.job_id] = job
+        await asyncio.to_thread(self._save_status, job)
+        task = asyncio.create_task(self._run(job, images))
+        self._tasks[job.job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job.job_id, None))
+        return job
+
+    async def _detect(self, job: DetectionJob, image_name: str, contents: Union[bytes, Exception], slots: asyncio.Semaphore,
+                      write_rows: Callable[[List[dict]], Awaitable[None]], progressed: asyncio.Event):
+        try:
+            if isinstance(contents, Exception):
+                raise contents
+            parsed_answer = await detect_image(contents, job.profile)
+            await write_rows(answer_to_rows(image_name, parsed_answer))
+        except Exception as e:
+            job.failed += 1
+            if len(job.errors) < MAX_REPORTED_ERRORS:
+                job.errors.append({"image": image_name, "error": str(e)})
+        finally:
+            job.done += 1
+            if job.done % max(1, JOB_STATUS_SAVE_EVERY) == 0:
+                progressed.set()
+            slots.release()
+
+    async def _detect_all(self, job: DetectionJob, images: AsyncIterator[Tuple[str, Union[bytes, Exception]]], writer: ResultWriter,
+                          progressed: asyncio.Event):
+        # Takes the next image only once a slot is free, so at most `max_in_flight` images are held past the reader
+        slots = asyncio.Semaphore(self.max_in_flight)
+        write_lock = asyncio.Lock()
+
+        async def write_rows(rows: List[dict]):
+            # Encoding and file I/O run off the event loop, one image's rows at a time
+            async with write_lock:
+                await asyncio.to_thread(writer.write_rows, rows)
+
+        tasks = set()
+        try:
+            async for image_name, contents in images:
+                await slots.acquire()
+                task = asyncio.create_task(self._detect(job, image_name, contents, slots, write_rows, progressed))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _run(self, job: DetectionJob, images: AsyncIterator[Tuple[str, Union[bytes, Exception]]]):
+        writer_class = get_writer_class(job.export_format)
+        job.result_filename = f"bounding_boxes{writer_class.extension}"
+        result_path = os.path.join(self.job_dir(job.job_id), job.result_filename)
+        progressed = asyncio.Event()
+        reporter = asyncio.create_task(self._report_progress(job, progressed))
+        async with self._running:
+            job.status = "running"
+            try:
+                progressed.set()
+                writer = await asyncio.to_thread(writer_class, result_path)
+                try:
+                    await self._detect_all(job, images, writer, progressed)
+                finally:
+                    await asyncio.to_thread(writer.close)
+                job.status = "completed"
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+            finally:
+                job.finished_at = time.time()
+                # Lets a save in progress finish, so it cannot overwrite the final status below
+                progressed.set()
+                await reporter
+                shutil.rmtree(os.path.join(self.job_dir(job.job_id), "inputs"), ignore_errors=True)
+                await asyncio.to_thread(self._save_status, job)
+                if os.path.exists(result_path):
+                    self.store.record("jobs", job.job_id, result_path)
+                self.store.record("jobs", job.job_id, os.path.join(self.job_dir(job.job_id), "status.json"))
+                self.store.mark_done(job.job_id)
+                # Finished jobs are served from their status file, which goes away with the job's outputs
+                self._jobs.pop(job.job_id, None)
+
+
+def _spool(file: UploadFile, path: str):
+    file.file.seek(0)
+    with open(path, "wb") as out_file:
+        shutil.copyfileobj(file.file, out_file, 1024 * 1024)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def _read_spooled(inputs: List[tuple]) -> AsyncIterator[Tuple[str, bytes]]:
+    for image_name, path in inputs:
+        yield image_name, await asyncio.to_thread(_read_file, path)
+
+
+async def _read_source(job: DetectionJob, source: str) -> AsyncIterator[Tuple[str, Union[bytes, Exception]]]:
+    async for chunk in aiter_chunks(source):
+        job.total += len(chunk)
+        for image in chunk:
+            yield image
+
+
+job_manager = DetectionJobManager(output_store, JOB_MAX_CONCURRENT, JOB_MAX_IN_FLIGHT_IMAGES)
@@ -0,0 +1,157 @@
+"""
+Streaming writers for bounding box rows.
+
+Rows are appended per image as detections complete instead of being collected
+into a DataFrame first, so peak memory stays flat regardless of row count and
+the export is finished shortly after the last image. CSV rows go straight to
+the file, Parquet rows are flushed in row groups, and XLSX uses openpyxl's
+write-only mode, which streams rows to a temporary file.
+"""
+
+import csv
+from typing import Dict, Iterable, Type
+
+
+COLUMNS = ["Image Name", "Class Name", "X", "Y", "Width", "Height"]
+
+
+class ResultWriter:
+    """
+    Base class of the streaming row writers. Use as a context manager.
+
+    Args:
+        path (str): The file to write.
+    """
+
+    extension = ""
+    media_type = "application/octet-stream"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.rows_written = 0
+
+    def write_rows(self, rows: Iterable[dict]):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class CsvResultWriter(ResultWriter):
+    extension = ".csv"
+    media_type = "text/csv"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._file = open(path, "w", newline="", encoding="utf-8")
+        self._writer = csv.DictWriter(self._file, fieldnames=COLUMNS)
+        self._writer.writeheader()
+
+    def write_rows(self, rows: Iterable[dict]):
+        for row in rows:
+            self._writer.writerow(row)
+            self.rows_written += 1
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetResultWriter(ResultWriter):
+    """
+    Buffers up to `row_group_size` rows and writes each full buffer as one Parquet row group.
+    """
+
+    extension = ".parquet"
+    media_type = "application/vnd.apache.parquet"
+
+    def __init__(self, path: str, row_group_size: int = 10000):
+        super().__init__(path)
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ValueError("Parquet export requires the pyarrow package") from e
+        self._pa = pa
+        self._schema = pa.schema([
+            ("Image Name", pa.string()),
+            ("Class Name", pa.string()),
+            ("X", pa.float64()),
+            ("Y", pa.float64()),
+            ("Width", pa.float64()),
+            ("Height", pa.float64()),
+        ])
+        self._writer = pq.ParquetWriter(path, self._schema)
+        self.row_group_size = row_group_size
+        self._buffer: Dict[str, list] = {column: [] for column in COLUMNS}
+        self._buffered = 0
+
+    def _flush(self):
+        if not self._buffered:
+            return
+        self._writer.write_table(self._pa.table(self._buffer, schema=self._schema))
+        self._buffer = {column: [] for column in COLUMNS}
+        self._buffered = 0
+
+    def write_rows(self, rows: Iterable[dict]):
+        for row in rows:
+            for column in COLUMNS:
+                self._buffer[column].append(row[column])
+            self._buffered += 1
+            self.rows_written += 1
+        if self._buffered >= self.row_group_size:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+class XlsxResultWriter(ResultWriter):
+    """
+    Writes rows with an openpyxl write-only workbook, which never holds the sheet in memory.
+    """
+
+    extension = ".xlsx"
+    media_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        from openpyxl import Workbook
+
+        self._workbook = Workbook(write_only=True)
+        self._sheet = self._workbook.create_sheet()
+        self._sheet.append(COLUMNS)
+
+    def write_rows(self, rows: Iterable[dict]):
+        for row in rows:
+            self._sheet.append([row[column] for column in COLUMNS])
+            self.rows_written += 1
+
+    def close(self):
+        self._workbook.save(self.path)
+
+
+EXPORT_FORMATS: Dict[str, Type[ResultWriter]] = {
+    "xlsx": XlsxResultWriter,
+    "csv": CsvResultWriter,
+    "parquet": ParquetResultWriter,
+}
+
+
+def get_writer_class(export_format: str) -> Type[ResultWriter]:
+    """
+    Looks a writer up by format name.
+
+    Raises:
+        ValueError: If the format is not supported.
+    """
+    try:
+        return EXPORT_FORMATS[export_format]
+    except KeyError:
+        raise ValueError(f"Unsupported export format '{export_format}'. Supported formats: {', '.join(EXPORT_FORMATS)}")
@@ -0,0 +1,135 @@
+"""
+Named generation profiles for the detection model.
+
+A profile selects a model variant ("default" or the int8-quantized "int8") and
+the keyword arguments passed to `model.generate`. Every profile tracks the
+per-image latency it has observed, and `detection_agreement` measures how
+closely a profile's boxes match those of the baseline profile.
+"""
+
+import threading
+from typing import Dict, List
+
+from app.core.config import DEFAULT_GENERATION_PROFILE, FLORENCE_INT8_QUANTIZE
+
+
+BASELINE_PROFILE = "accurate"
+
+_ACCURATE = {"max_new_tokens": 1024, "do_sample": False, "num_beams": 3}
+_FAST = {"max_new_tokens": 256, "do_sample": False, "num_beams": 1}
+
+GENERATION_PROFILES: Dict[str, dict] = {
+    "accurate": {"model": "default", "generate": _ACCURATE},
+    "fast": {"model": "default", "generate": _FAST},
+    "accurate_int8": {"model": "int8", "generate": _ACCURATE},
+    "fast_int8": {"model": "int8", "generate": _FAST},
+}
+
+
+def available_profiles() -> List[str]:
+    """
+    Returns the names of the profiles usable with the current configuration.
+    """
+    return [
+        name for name, profile in GENERATION_PROFILES.items()
+        if profile["model"] != "int8" or FLORENCE_INT8_QUANTIZE
+    ]
+
+
+def get_profile(name: str = None) -> dict:
+    """
+    Looks a profile up by name.
+
+    Args:
+        name (str): The profile name. Defaults to `DEFAULT_GENERATION_PROFILE`.
+
+    Returns:
+        dict: The profile, with its "model" variant and "generate" keyword arguments.
+
+    Raises:
+        ValueError: If the profile does not exist or is not enabled.
+    """
+    name = name or DEFAULT_GENERATION_PROFILE
+    if name not in available_profiles():
+        raise ValueError(f"Unknown generation profile '{name}'. Available profiles: {', '.join(available_profiles())}")
+    return GENERATION_PROFILES[name]
+
+
+class ProfileLatency:
+    """
+    Thread-safe per-profile latency counters fed by the inference worker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[str, dict] = {}
+
+    def record(self, name: str, images: int, seconds: float):
+        with self._lock:
+            stats = self._stats.setdefault(name, {"images": 0, "seconds": 0.0, "batches": 0})
+            stats["images"] += images
+            stats["seconds"] += seconds
+            stats["batches"] += 1
+
+    def report(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                name: {
+                    "images": stats["images"],
+                    "batches": stats["batches"],
+                    "seconds_per_image": round(stats["seconds"] / stats["images"], 4),
+                }
+                for name, stats in self._stats.items() if stats["images"]
+            }
+
+
+profile_latency = ProfileLatency()
+
+
+def _iou(a: List[float], b: List[float]) -> float:
+    ix = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    intersection = ix * iy
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def detection_agreement(baseline: dict, candidate: dict, iou_threshold: float = 0.5) -> float:
+    """
+    Measures how well one parsed `<OD>` answer agrees with another.
+
+    Boxes are matched greedily by IoU among boxes with the same label. The
+    agreement is the F1 score of those matches, so 1.0 means both answers
+    found the same objects and 0.0 means they share none.
+
+    Args:
+        baseline (dict): The parsed `<OD>` answer of the baseline profile.
+        candidate (dict): The parsed `<OD>` answer to compare.
+        iou_threshold (float): The minimum IoU for two boxes to count as a match.
+
+    Returns:
+        float: The agreement between 0.0 and 1.0.
+    """
+    base = list(zip(baseline["<OD>"]["bboxes"], baseline["<OD>"]["labels"]))
+    cand = list(zip(candidate["<OD>"]["bboxes"], candidate["<OD>"]["labels"]))
+    if not base and not cand:
+        return 1.0
+
+    pairs = sorted(
+        ((_iou(b_box, c_box), i, j)
+         for i, (b_box, b_label) in enumerate(base)
+         for j, (c_box, c_label) in enumerate(cand)
+         if b_label == c_label),
+        reverse=True
+    )
+    matched_base, matched_cand = set(), set()
+    for iou, i, j in pairs:
+        if iou < iou_threshold:
+            break
+        if i in matched_base or j in matched_cand:
+            continue
+        matched_base.add(i)
+        matched_cand.add(j)
+
+    matches = len(matched_base)
+    return 2 * matches / (len(base) + len(cand))
@@ -1,131 +1,283 @@
 import cv2
 import numpy as np
 import os
-from typing import List
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple, Union
 from fastapi import UploadFile
 from uuid import uuid4
+from app.core.request_context import get_request_id
+from app.services.cpu_pool import cpu_pool
+from app.services.dataset_ingest import IngestSummary, aiter_chunks, resolve_source
+from app.services.metrics import images_processed, queue_depth, stage_seconds
+from app.services.output_store import output_store
+from app.services.request_profiler import ProfileSession, current_session, profile_call
+from app.utils.image_utils import decode_reduced
 
-# Directory to save processed images
-PROCESSED_IMAGES_DIR = "outputs/processed_images"
-
-if not os.path.exists(PROCESSED_IMAGES_DIR):
-    os.makedirs(PROCESSED_IMAGES_DIR)
-
-def save_image(image: np.ndarray, prefix: str) -> str:
+def save_image(image: np.ndarray, prefix: str, output_dir: str) -> str:
     filename = f"{prefix}_{uuid4().hex}.png"
-    filepath = os.path.join(PROCESSED_IMAGES_DIR, filename)
+    filepath = os.path.join(output_dir, filename)
     cv2.imwrite(filepath, image)
     return filepath
 
-async def resize_images(images: List[UploadFile], width: int, height: int) -> List[str]:
-    filepaths = []
-    for image in images:
-        try:
-            contents = await image.read()
-            np_img = np.frombuffer(contents, np.uint8)
-            img = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
-            resized_img = cv2.resize(img, (width, height))
-            filepath = save_image(resized_img, "resized")
-            filepaths.append(filepath)
-        except Exception as e:
-            print(f"Failed to resize image {image.filename}: {e}")
-    return filepaths
-
-async def normalize_images(images: List[UploadFile]) -> List[str]:
-    filepaths = []
-    for image in images:
-        try:
-            contents = await image.read()
-            np_img = np.frombuffer(contents, np.uint8)
-            img = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
-            normalized_img = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX)
-            filepath = save_image(normalized_img, "normalized")
-            filepaths.append(filepath)
-        except Exception as e:
-            print(f"Failed to normalize image {image.filename}: {e}")
-    return filepaths
-
-async def crop_images(images: List[UploadFile], x: int, y: int, width: int, height: int) -> List[str]:
-    filepaths = []
-    for image in images:
-        try:
-            contents = await image.read()
-            np_img = np.frombuffer(contents, np.uint8)
-            img = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
-            cropped_img = img[y:y+height, x:x+width]
-            filepath = save_image(cropped_img, "cropped")
-            filepaths.append(filepath)
-        except Exception as e:
-            print(f"Failed to crop image {image.filename}: {e}")
-    return filepaths
-
-async def rotate_flip_images(images: List[UploadFile], rotate_angle: int = 0, flip_code: int = 1) -> List[str]:
-    filepaths = []
-    for image in images:
-        try:
-            contents = await image.read()
-            np_img = np.frombuffer(contents, np.uint8)
-            img = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
-            if rotate_angle:
-                (h, w) = img.shape[:2]
-                center = (w // 2, h // 2)
-                M = cv2.getRotationMatrix2D(center, rotate_angle, 1.0)
-                img = cv2.warpAffine(img, M, (w, h))
-            if flip_code is not None:
-                img = cv2.flip(img, flip_code)
-            filepath = save_image(img, "rotated_flipped")
-            filepaths.append(filepath)
-        except Exception as e:
-            print(f"Failed to process image {image.filename}: {e}")
-    return filepaths
-
-async def adjust_color_images(images: List[UploadFile], brightness: int = 0, contrast: int = 0, saturation: int = 0) -> List[str]:
-    filepaths = []
-    for image in images:
-        try:
-            contents = await image.read()
-            np_img = np.frombuffer(contents, np.uint8)
-            img = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
-            img = cv2.convertScaleAbs(img, alpha=1 + contrast / 127.0, beta=brightness)
-            hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-            hsv[..., 1] = cv2.add(hsv[..., 1], saturation)
-            img = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-            filepath = save_image(img, "color_adjusted")
-            filepaths.append(filepath)
-        except Exception as e:
-            print(f"Failed to adjust color of image {image.filename}: {e}")
-    return filepaths
-
-async def reduce_noise_images(images: List[UploadFile]) -> List[str]:
-    filepaths = []
-    for image in images:
-        try:
-            contents = await image.read()
-            np_img = np.frombuffer(contents, np.uint8)
-            img = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
-            noise_reduced_img = cv2.fastNlMeansDenoisingColored(img, None, 10, 10, 7, 21)
-            filepath = save_image(noise_reduced_img, "noise_reduced")
-            filepaths.append(filepath)
-        except Exception as e:
-            print(f"Failed to reduce noise in image {image.filename}: {e}")
-    return filepaths
-
-async def remove_background_images(images: List[UploadFile]) -> List[str]:
-    filepaths = []
-    for image in images:
+def encode_image(image: np.ndarray) -> bytes:
+    ok, buffer = cv2.imencode(".png", image)
+    if not ok:
+        raise ValueError("Could not encode image")
+    return buffer.tobytes()
+
+def decode_image(contents: bytes, target_size: Optional[Tuple[int, int]] = None) -> np.ndarray:
+    # Large JPEGs are decoded at 1/2, 1/4 or 1/8 scale when the result is resized below that anyway
+    return decode_reduced(contents, target_size)
+
+# Per-image operations, from a decoded BGR image to the processed image
+
+def _resize(img: np.ndarray, width: int, height: int) -> np.ndarray:
+    return cv2.resize(img, (width, height))
+
+def _normalize(img: np.ndarray) -> np.ndarray:
+    return cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX)
+
+def _crop(img: np.ndarray, x: int, y: int, width: int, height: int) -> np.ndarray:
+    cropped_img = img[y:y+height, x:x+width]
+    if cropped_img.size == 0:
+        raise ValueError("Crop region lies outside the image")
+    return cropped_img
+
+def _rotate_flip(img: np.ndarray, rotate_angle: int, flip_code: int) -> np.ndarray:
+    if rotate_angle:
+        (h, w) = img.shape[:2]
+        center = (w // 2, h // 2)
+        M = cv2.getRotationMatrix2D(center, rotate_angle, 1.0)
+        img = cv2.warpAffine(img, M, (w, h))
+    if flip_code is not None:
+        img = cv2.flip(img, flip_code)
+    return img
+
+def _adjust_color(img: np.ndarray, brightness: int, contrast: int, saturation: int) -> np.ndarray:
+    img = cv2.convertScaleAbs(img, alpha=1 + contrast / 127.0, beta=brightness)
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    hsv[..., 1] = cv2.add(hsv[..., 1], saturation)
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+
+def _reduce_noise(img: np.ndarray) -> np.ndarray:
+    return cv2.fastNlMeansDenoisingColored(img, None, 10, 10, 7, 21)
+
+def _remove_background(img: np.ndarray) -> np.ndarray:
+    mask = np.zeros(img.shape[:2], np.uint8)
+    bgdModel = np.zeros((1, 65), np.float64)
+    fgdModel = np.zeros((1, 65), np.float64)
+    rect = (50, 50, img.shape[1] - 50, img.shape[0] - 50)
+    cv2.grabCut(img, mask, rect, bgdModel, fgdModel, 5, cv2.GC_INIT_WITH_RECT)
+    mask2 = np.where((mask == 2) | (mask == 0), 0, 1).astype('uint8')
+    return img * mask2[:, :, np.newaxis]
+
+# Operations whose output size follows from their arguments, so the decode can be reduced to match
+_OUTPUT_SIZES = {
+    _resize: lambda width, height: (width, height),
+}
+
+queue_depth.set_function(lambda: cpu_pool.pending, "cpu_pool")
+
+def _process(contents: bytes, operation: Callable, prefix: str, output_dir: Optional[str], *args) -> Tuple[Union[str, bytes], Dict[str, float]]:
+    # Runs in a CPU pool worker process, so it takes and returns only picklable values:
+    # the saved path when given an output directory, otherwise the encoded PNG, and the
+    # seconds spent per stage, which the parent records since metrics live in its process.
+    timings = {}
+    start = time.perf_counter()
+    output_size = _OUTPUT_SIZES[operation](*args) if operation in _OUTPUT_SIZES else None
+    img = decode_image(contents, output_size)
+    timings["decode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    img = operation(img, *args)
+    timings[operation.__name__.lstrip("_")] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if output_dir is None:
+        result = encode_image(img)
+        timings["encode"] = time.perf_counter() - start
+    else:
+        result = save_image(img, prefix, output_dir)
+        timings["save"] = time.perf_counter() - start
+    return result, timings
+
+def _profiled_process(contents: bytes, *args):
+    # `_process` under cProfile in the pool worker; the stats travel back with the result
+    start = time.perf_counter()
+    result, stats = profile_call(_process, contents, *args)
+    return result, stats, time.perf_counter() - start
+
+def _unwrap_profile(result, session: Optional[ProfileSession], name: str):
+    # Hands the stats of a `_profiled_process` result to the request's profile and returns the `_process` result
+    if session is None or isinstance(result, Exception):
+        return result
+    result, stats, seconds = result
+    session.add_stats(name, seconds, stats, where="cpu_pool")
+    return result
+
+def _record(result: Union[Tuple[Union[str, bytes], Dict[str, float]], Exception]) -> Union[str, bytes, Exception]:
+    # Records the stage timings of one `_process` result and returns its output, or the exception that failed it
+    if isinstance(result, Exception):
+        images_processed.inc("image_process", "failed")
+        return result
+    output, timings = result
+    for stage, seconds in timings.items():
+        stage_seconds.observe(seconds, "image_process", stage)
+    images_processed.inc("image_process", "ok")
+    return output
+
+async def _save_chunk(uploads: List[Tuple[str, Union[bytes, Exception]]], operation: Callable, prefix: str, request_id: str,
+                      session: Optional[ProfileSession], *args) -> Tuple[List[str], List[dict]]:
+    # Runs the operation on the readable images of one chunk in parallel and saves the outputs; images that
+    # could not be read are reported as failed
+    output_dir = output_store.request_dir("processed", request_id)
+    process = _profiled_process if session else _process
+    readable = [contents for _, contents in uploads if not isinstance(contents, Exception)]
+    results = iter(await cpu_pool.map(process, readable, operation, prefix, output_dir, *args))
+
+    filepaths, errors = [], []
+    for filename, contents in uploads:
+        result = contents if isinstance(contents, Exception) else next(results)
+        result = _record(_unwrap_profile(result, session, operation.__name__.lstrip("_")))
+        if isinstance(result, Exception):
+            errors.append({"filename": filename, "error": str(result)})
+        else:
+            output_store.record("processed", request_id, result)
+            filepaths.append(result)
+    return filepaths, errors
+
+async def _stream_chunks(chunks: AsyncIterator[List[Tuple[str, Union[bytes, Exception]]]], operation: Callable, prefix: str,
+                         *args) -> AsyncIterator[Tuple[str, Union[bytes, Exception]]]:
+    # Yields the output filename and encoded PNG, or the exception that failed it, of every image of every chunk
+    session = current_session()
+    process = _profiled_process if session else _process
+    index = 0
+    async for uploads in chunks:
+        readable = [contents for _, contents in uploads if not isinstance(contents, Exception)]
+        results = cpu_pool.imap(process, readable, operation, prefix, None, *args)
         try:
-            contents = await image.read()
-            np_img = np.frombuffer(contents, np.uint8)
-            img = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
-            mask = np.zeros(img.shape[:2], np.uint8)
-            bgdModel = np.zeros((1, 65), np.float64)
-            fgdModel = np.zeros((1, 65), np.float64)
-            rect = (50, 50, img.shape[1] - 50, img.shape[0] - 50)
-            cv2.grabCut(img, mask, rect, bgdModel, fgdModel, 5, cv2.GC_INIT_WITH_RECT)
-            mask2 = np.where((mask == 2) | (mask == 0), 0, 1).astype('uint8')
-            img = img * mask2[:, :, np.newaxis]
-            filepath = save_image(img, "background_removed")
-            filepaths.append(filepath)
-        except Exception as e:
-            print(f"Failed to remove background from image {image.filename}: {e}")
-    return filepaths
+            for filename, contents in uploads:
+                result = contents if isinstance(contents, Exception) else await results.__anext__()
+                stem = os.path.splitext(os.path.basename(filename or f"image_{index}"))[0]
+                yield f"{prefix}_{stem}.png", _record(_unwrap_profile(result, session, operation.__name__.lstrip("_")))
+                index += 1
+        finally:
+            await results.aclose()
+
+async def _one_chunk(uploads: List[Tuple[str, bytes]]) -> AsyncIterator[List[Tuple[str, bytes]]]:
+    yield uploads
+
+async def process_in_pool(images: List[UploadFile], operation: Callable, prefix: str, *args) -> Tuple[List[str], List[dict]]:
+    """
+    Runs a per-image operation on every upload in parallel in the CPU pool.
+
+    Outputs are saved in the output store under the current request id.
+
+    Returns:
+        Tuple[List[str], List[dict]]: The saved file paths in input order, and one error entry per failed image.
+    """
+    with stage_seconds.time("image_process", "read"):
+        uploads = [(image.filename, await image.read()) for image in images]
+    request_id = get_request_id()
+    output_store.mark_active(request_id)
+    try:
+        return await _save_chunk(uploads, operation, prefix, request_id, current_session(), *args)
+    finally:
+        output_store.mark_done(request_id)
+
+async def stream_in_pool(images: List[UploadFile], operation: Callable, prefix: str, *args) -> AsyncIterator[Tuple[str, Union[bytes, Exception]]]:
+    """
+    Runs a per-image operation on every upload in parallel in the CPU pool without writing anything to disk.
+
+    The uploads are read before returning, since they are closed once the handler returns.
+
+    Returns:
+        AsyncIterator[Tuple[str, Union[bytes, Exception]]]: The output filename and the encoded PNG, or the exception that failed the image, in input order.
+    """
+    with stage_seconds.time("image_process", "read"):
+        uploads = [(image.filename, await image.read()) for image in images]
+    return _stream_chunks(_one_chunk(uploads), operation, prefix, *args)
+
+async def _run(images: List[UploadFile], operation: Callable, prefix: str, inline: bool, *args):
+    if inline:
+        return await stream_in_pool(images, operation, prefix, *args)
+    return await process_in_pool(images, operation, prefix, *args)
+
+# Each function below returns (filepaths, errors) after saving to the output
+# store, or with inline=True an async iterator of (filename, PNG bytes or error).
+
+async def resize_images(images: List[UploadFile], width: int, height: int, inline: bool = False):
+    return await _run(images, _resize, "resized", inline, width, height)
+
+async def normalize_images(images: List[UploadFile], inline: bool = False):
+    return await _run(images, _normalize, "normalized", inline)
+
+async def crop_images(images: List[UploadFile], x: int, y: int, width: int, height: int, inline: bool = False):
+    return await _run(images, _crop, "cropped", inline, x, y, width, height)
+
+async def rotate_flip_images(images: List[UploadFile], rotate_angle: int = 0, flip_code: int = 1, inline: bool = False):
+    return await _run(images, _rotate_flip, "rotated_flipped", inline, rotate_angle, flip_code)
+
+async def adjust_color_images(images: List[UploadFile], brightness: int = 0, contrast: int = 0, saturation: int = 0, inline: bool = False):
+    return await _run(images, _adjust_color, "color_adjusted", inline, brightness, contrast, saturation)
+
+async def reduce_noise_images(images: List[UploadFile], inline: bool = False):
+    return await _run(images, _reduce_noise, "noise_reduced", inline)
+
+async def remove_background_images(images: List[UploadFile], inline: bool = False):
+    return await _run(images, _remove_background, "background_removed", inline)
+
+# Operations that can run on a server-local dataset, by the path of their endpoint:
+# (operation, output prefix, integer parameters with the endpoint's defaults)
+INGEST_OPERATIONS = {
+    "resize": (_resize, "resized", {"width": 256, "height": 256}),
+    "normalize": (_normalize, "normalized", {}),
+    "crop": (_crop, "cropped", {"x": 0, "y": 0, "width": 256, "height": 256}),
+    "rotate-flip": (_rotate_flip, "rotated_flipped", {"rotate_angle": 0, "flip_code": 1}),
+    "color-adjust": (_adjust_color, "color_adjusted", {"brightness": 0, "contrast": 0, "saturation": 0}),
+    "noise-reduction": (_reduce_noise, "noise_reduced", {}),
+    "background-removal": (_remove_background, "background_removed", {}),
+}
+
+def _ingest_operation(name: str, params: dict) -> Tuple[Callable, str, List[int]]:
+    if name not in INGEST_OPERATIONS:
+        raise ValueError(f"Unknown operation '{name}'; expected one of {sorted(INGEST_OPERATIONS)}")
+    if not isinstance(params, dict):
+        raise ValueError("Operation parameters must be a JSON object")
+    operation, prefix, defaults = INGEST_OPERATIONS[name]
+    unknown = set(params) - set(defaults)
+    if unknown:
+        raise ValueError(f"Unknown parameters for '{name}': {sorted(unknown)}")
+    try:
+        return operation, prefix, [int(params.get(param, default)) for param, default in defaults.items()]
+    except (TypeError, ValueError):
+        raise ValueError(f"Parameters of '{name}' must be integers")
+
+async def ingest_images(source: str, operation: str, params: dict, inline: bool = False):
+    """
+    Runs one operation on every image of a server-local directory, tar or zip archive, a chunk at a time.
+
+    Returns an `IngestSummary` after saving the outputs under the current request id, or with inline=True
+    an async iterator of (filename, PNG bytes or error).
+
+    Raises:
+        ValueError: If the source may not be ingested, or the operation or its parameters are invalid.
+    """
+    operation, prefix, args = _ingest_operation(operation, params)
+    source = resolve_source(source)
+    if inline:
+        return _stream_chunks(aiter_chunks(source, flatten=True), operation, prefix, *args)
+
+    request_id = get_request_id()
+    session = current_session()
+    summary = IngestSummary()
+    output_store.mark_active(request_id)
+    try:
+        async for uploads in aiter_chunks(source):
+            filepaths, errors = await _save_chunk(uploads, operation, prefix, request_id, session, *args)
+            summary.processed += len(filepaths)
+            for error in errors:
+                summary.add_error(error["filename"], error["error"])
+    finally:
+        output_store.mark_done(request_id)
+    return summary
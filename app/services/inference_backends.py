@@ -0,0 +1,248 @@
+"""
+Inference backends that run Florence-2's `generate` for the detection pipeline.
+
+`INFERENCE_BACKEND` selects one of:
+
+    eager     `model.generate` as loaded; the reference the other backends are checked against
+    compile   the same call with the image encoder and the language model's forward under `torch.compile`
+    onnx      ONNX Runtime graphs exported from the loaded model, decoded with a KV cache (see `onnx_florence`)
+
+Every backend takes the loaded model and the processor's tensors and returns
+token ids shaped like `model.generate`'s, so the pipeline and its
+post-processing do not depend on the choice. Compilation and export happen on
+first use of each model variant, which `warmup` triggers ahead of traffic.
+`encode_image` and `generate_from_features` split `generate` at the vision
+encoder, so several task prompts can share one image encoding.
+`python -m benchmarks.backend_parity` checks that the backends agree.
+"""
+
+import os
+import re
+import threading
+import weakref
+from typing import Any, Dict
+
+from app.core.config import INFERENCE_BACKEND, INFERENCE_COMPILE_MODE, ONNX_MODEL_DIR
+from app.services.model_manager import model_manager
+
+
+class InferenceBackend:
+    """
+    Runs `generate` for a loaded Florence-2 model.
+    """
+
+    name = ""
+
+    def generate(self, model, input_ids, pixel_values, variant: str = "default", **generate_kwargs):
+        """
+        Generates token ids for a batch of images.
+
+        Args:
+            model: The loaded model of the variant.
+            input_ids (torch.Tensor): The prompt token ids from the processor.
+            pixel_values (torch.Tensor): The pixel values from the processor.
+            variant (str): The model variant, "default" or "int8".
+            **generate_kwargs: Arguments of `model.generate`, such as `max_new_tokens` and `num_beams`.
+
+        Returns:
+            torch.Tensor: (batch, length) generated token ids.
+        """
+        raise NotImplementedError
+
+    def encode_image(self, model, pixel_values, variant: str = "default"):
+        """
+        Runs only the vision encoder, so several task prompts can be decoded against one encoding.
+
+        Returns:
+            The image features, indexable along the batch dimension, for `generate_from_features`.
+        """
+        raise NotImplementedError
+
+    def generate_from_features(self, model, image_features, input_ids, variant: str = "default", **generate_kwargs):
+        """
+        Generates token ids for a task prompt from image features returned by `encode_image`.
+
+        Returns:
+            torch.Tensor: (batch, length) generated token ids.
+        """
+        raise NotImplementedError
+
+    def release(self):
+        """Drops whatever was built for the loaded model; called when the model is unloaded."""
+
+    def status(self) -> dict:
+        return {"name": self.name}
+
+
+class EagerBackend(InferenceBackend):
+    """
+    Calls `model.generate` directly.
+    """
+
+    name = "eager"
+
+    def generate(self, model, input_ids, pixel_values, variant: str = "default", **generate_kwargs):
+        return model.generate(input_ids=input_ids, pixel_values=pixel_values, **generate_kwargs)
+
+    def encode_image(self, model, pixel_values, variant: str = "default"):
+        return model._encode_image(pixel_values)
+
+    def generate_from_features(self, model, image_features, input_ids, variant: str = "default", **generate_kwargs):
+        # The same merge `generate` does with freshly encoded features
+        inputs_embeds = model.get_input_embeddings()(input_ids)
+        inputs_embeds, _ = model._merge_input_ids_with_image_features(image_features, inputs_embeds)
+        return model.generate(input_ids=input_ids, inputs_embeds=inputs_embeds, **generate_kwargs)
+
+
+class CompiledBackend(EagerBackend):
+    """
+    Calls `model.generate` with the image encoder and the language model's forward compiled by `torch.compile`.
+
+    Shapes are compiled as dynamic, since the batch size and the decoded length change between calls.
+
+    Args:
+        mode (str): The `torch.compile` mode, e.g. "default", "reduce-overhead" or "max-autotune".
+    """
+
+    name = "compile"
+
+    def __init__(self, mode: str = "default"):
+        self.mode = mode
+        self._compiled = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def _compile(self, model):
+        import torch
+
+        with self._lock:
+            if model in self._compiled:
+                return
+            language_model = getattr(model, "language_model", None)
+            if hasattr(model, "_encode_image") and language_model is not None:
+                # `generate` calls these for every image and every decoding step; rebinding them on the
+                # instance leaves `generate` itself, with its Python search loop, uncompiled
+                model._encode_image = torch.compile(model._encode_image, mode=self.mode, dynamic=True)
+                language_model.forward = torch.compile(language_model.forward, mode=self.mode, dynamic=True)
+            else:
+                model.forward = torch.compile(model.forward, mode=self.mode, dynamic=True)
+            self._compiled.add(model)
+
+    def generate(self, model, input_ids, pixel_values, variant: str = "default", **generate_kwargs):
+        self._compile(model)
+        return super().generate(model, input_ids, pixel_values, variant, **generate_kwargs)
+
+    def encode_image(self, model, pixel_values, variant: str = "default"):
+        self._compile(model)
+        return super().encode_image(model, pixel_values, variant)
+
+    def generate_from_features(self, model, image_features, input_ids, variant: str = "default", **generate_kwargs):
+        self._compile(model)
+        return super().generate_from_features(model, image_features, input_ids, variant, **generate_kwargs)
+
+    def status(self) -> dict:
+        return {"name": self.name, "mode": self.mode}
+
+
+def _model_dir_name(model_id: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]+", "--", model_id.strip("/")) or "model"
+
+
+class OnnxBackend(InferenceBackend):
+    """
+    Runs the model on ONNX Runtime, exporting it to `model_dir` on first use if it is not exported yet.
+
+    The int8 variant runs a dynamically int8-quantized copy of the ONNX graphs rather than the quantized torch model.
+
+    Args:
+        model_dir (str): The export directory of the model; "default" and "int8" subdirectories are created in it.
+    """
+
+    name = "onnx"
+
+    def __init__(self, model_dir: str):
+        self.model_dir = model_dir
+        self._runtimes: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _providers(self):
+        import onnxruntime as ort
+
+        if model_manager.device.startswith("cuda") and "CUDAExecutionProvider" in ort.get_available_providers():
+            return ["CUDAExecutionProvider", "CPUExecutionProvider"]
+        return ["CPUExecutionProvider"]
+
+    def _runtime(self, model, variant: str):
+        from app.services.onnx_florence import OnnxFlorence, export_onnx, is_exported, quantize_onnx
+
+        with self._lock:
+            runtime = self._runtimes.get(variant)
+            if runtime is not None:
+                return runtime
+            directory = os.path.join(self.model_dir, "default")
+            if not is_exported(directory):
+                export_onnx(model if variant == "default" else model_manager.get("default")[0], directory)
+            if variant == "int8":
+                source, directory = directory, os.path.join(self.model_dir, "int8")
+                if not is_exported(directory):
+                    quantize_onnx(source, directory)
+            runtime = self._runtimes[variant] = OnnxFlorence(directory, self._providers())
+            return runtime
+
+    def generate(self, model, input_ids, pixel_values, variant: str = "default", **generate_kwargs):
+        import torch
+
+        runtime = self._runtime(model, variant)
+        generated_ids = runtime.generate(input_ids.cpu().numpy(), pixel_values.float().cpu().numpy(), **generate_kwargs)
+        return torch.from_numpy(generated_ids)
+
+    def encode_image(self, model, pixel_values, variant: str = "default"):
+        return self._runtime(model, variant).encode_image(pixel_values.float().cpu().numpy())
+
+    def generate_from_features(self, model, image_features, input_ids, variant: str = "default", **generate_kwargs):
+        import torch
+
+        runtime = self._runtime(model, variant)
+        return torch.from_numpy(runtime.generate_from_features(input_ids.cpu().numpy(), image_features, **generate_kwargs))
+
+    def release(self):
+        with self._lock:
+            self._runtimes.clear()
+
+    def status(self) -> dict:
+        return {"name": self.name, "model_dir": self.model_dir, "loaded_variants": sorted(self._runtimes)}
+
+
+BACKENDS = {
+    "eager": EagerBackend,
+    "compile": CompiledBackend,
+    "onnx": OnnxBackend,
+}
+
+
+def create_backend(name: str, model_id: str = None) -> InferenceBackend:
+    """
+    Builds an inference backend by name.
+
+    Args:
+        name (str): "eager", "compile" or "onnx".
+        model_id (str): The model id the onnx backend exports under; defaults to the configured model.
+
+    Raises:
+        ValueError: If the backend name is unknown.
+    """
+    if name == "compile":
+        return CompiledBackend(INFERENCE_COMPILE_MODE)
+    if name == "onnx":
+        return OnnxBackend(os.path.join(ONNX_MODEL_DIR, _model_dir_name(model_id or model_manager.model_id)))
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{name}'; expected one of {sorted(BACKENDS)}")
+    return BACKENDS[name]()
+
+
+inference_backend = create_backend(INFERENCE_BACKEND)
+model_manager.add_unload_hook(inference_backend.release)
+
+
+def warmup():
+    """Loads the model and runs a short generate through the configured backend, compiling or exporting it first."""
+    model_manager.warmup(inference_backend.generate)
@@ -0,0 +1,70 @@
+"""
+Dedicated executors for blocking model work.
+
+`model.generate` blocks for seconds at a time. Running it on a single
+background thread keeps the asyncio event loop free to serve the other
+routers while the model is busy. Image preprocessing and post-processing run
+on their own workers, so they overlap generation instead of delaying it.
+Submissions beyond `max_pending` wait for a free slot instead of piling up
+unbounded work, which makes each worker a bounded queue between stages.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from app.core.config import (
+    INFERENCE_QUEUE_SIZE, DETECTION_PREPROCESS_WORKERS, DETECTION_POSTPROCESS_WORKERS
+)
+
+
+class InferenceWorker:
+    """
+    Runs blocking callables on dedicated threads and exposes them as awaitables.
+
+    Args:
+        max_pending (int): The maximum number of submissions that may be queued or running at once.
+        workers (int): The number of threads.
+        name (str): The thread name prefix.
+    """
+
+    def __init__(self, max_pending: int, workers: int = 1, name: str = "inference"):
+        self.max_pending = max(1, max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix=name)
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        """The number of submissions currently queued or running."""
+        return self._pending
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Runs `fn(*args, **kwargs)` on a worker thread and waits for its result.
+
+        Args:
+            fn (Callable[..., Any]): The blocking callable to run.
+
+        Returns:
+            Any: The return value of `fn`.
+        """
+        async with self._slots:
+            self._pending += 1
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+            finally:
+                self._pending -= 1
+
+    def shutdown(self):
+        """Stops accepting work and waits for the running submissions to finish."""
+        self._executor.shutdown(wait=True)
+
+
+inference_worker = InferenceWorker(INFERENCE_QUEUE_SIZE)
+# Decoding and preprocessing the next images while the current batch generates
+preprocess_worker = InferenceWorker(2 * DETECTION_PREPROCESS_WORKERS, DETECTION_PREPROCESS_WORKERS, "preprocess")
+# Decoding generated tokens into boxes while the next batch generates
+postprocess_worker = InferenceWorker(2 * DETECTION_POSTPROCESS_WORKERS, DETECTION_POSTPROCESS_WORKERS, "postprocess")
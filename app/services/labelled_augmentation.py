@@ -0,0 +1,105 @@
+"""
+Detect-then-augment: labelled augmented images at augmentation speed.
+
+Every upload is run through the detector once (through the detection cache
+and batcher like any other detection). Its boxes are then mapped analytically
+through the geometric operations of the augmentation pipeline, so no
+augmented copy is ever run through the model.
+"""
+
+import asyncio
+import os
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+from fastapi import UploadFile
+
+from app.core.request_context import get_request_id
+from app.services.augmentation_pipeline import apply_operations, encode_image, output_filename, parse_operations
+from app.services.bounding_boxes import answer_to_rows, detect_image
+from app.services.box_transforms import transform_answer
+from app.services.exporters import get_writer_class
+from app.services.generation_profiles import get_profile
+from app.services.output_store import output_store
+from app.services.request_profiler import profiled
+
+
+def _augment_with_answer(contents: bytes, operations: List[Tuple[str, dict]], filename: str, parsed_answer: dict) -> Tuple[bytes, str, dict]:
+    # The detector sees the stored pixel orientation, so the EXIF orientation is ignored here too to keep boxes aligned
+    img = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if img is None:
+        raise ValueError("Could not decode image")
+    size = (img.shape[1], img.shape[0])
+    filename = output_filename(filename)
+    img = apply_operations(img, operations)
+    return encode_image(img, filename), filename, transform_answer(parsed_answer, size, operations)
+
+
+def _write_labels(writer_class, path: str, rows: List[dict]):
+    with writer_class(path) as writer:
+        writer.write_rows(rows)
+
+
+async def detect_and_augment(files: List[UploadFile], operations: List[dict], prefix: str = "augmented",
+                             profile_name: str = None, labels_format: str = "csv") -> dict:
+    """
+    Detects objects on each original image once, augments it and carries its boxes over to the augmented image.
+
+    The augmented images and a labels file are saved in the output store under the current request id,
+    so `/api/v1/outputs/{request_id}/download` returns a labelled dataset.
+
+    Args:
+        files (List[UploadFile]): A list of uploaded image files.
+        operations (List[dict]): The augmentation pipeline, as accepted by `parse_operations`.
+        prefix (str): The prefix of the augmented image filenames.
+        profile_name (str): The generation profile to detect with. Defaults to the configured default profile.
+        labels_format (str): The format of the labels file: "csv", "parquet" or "xlsx".
+
+    Returns:
+        dict: The request id, the augmented filenames, the labels filename, the box rows and per-image errors.
+
+    Raises:
+        ValueError: If the operations, the profile or the labels format are invalid.
+    """
+    parsed = parse_operations(operations)
+    get_profile(profile_name)
+    writer_class = get_writer_class(labels_format)
+    uploads = [(file.filename, await file.read()) for file in files]
+
+    request_id = get_request_id()
+    directory = output_store.request_dir("augmented", request_id)
+    labels_filename = f"labels{writer_class.extension}"
+    output_store.mark_active(request_id)
+    try:
+        async def label(filename, contents):
+            parsed_answer = await detect_image(contents, profile_name)
+            data, name, answer = await asyncio.to_thread(profiled(_augment_with_answer), contents, parsed, filename, parsed_answer)
+            name = f"{prefix}_{os.path.basename(name)}"
+            await asyncio.to_thread(output_store.save_bytes, "augmented", request_id, name, data)
+            return name, answer
+
+        results = await asyncio.gather(*(label(filename, contents) for filename, contents in uploads), return_exceptions=True)
+
+        filenames, rows, errors = [], [], []
+        for (filename, _), result in zip(uploads, results):
+            if isinstance(result, Exception):
+                errors.append({"filename": filename, "error": str(result)})
+                continue
+            name, answer = result
+            filenames.append(name)
+            rows.extend(answer_to_rows(name, answer))
+
+        labels_path = os.path.join(directory, labels_filename)
+        await asyncio.to_thread(_write_labels, writer_class, labels_path, rows)
+        output_store.record("augmented", request_id, labels_path)
+    finally:
+        output_store.mark_done(request_id)
+
+    return {
+        "request_id": request_id,
+        "filenames": filenames,
+        "labels_filename": labels_filename,
+        "rows": rows,
+        "errors": errors,
+    }
@@ -0,0 +1,278 @@
+"""
+Lifecycle management for the Florence-2 detection model.
+
+The model is no longer loaded at import time. `ModelManager.get` loads it on
+first use, `warmup` loads it ahead of traffic and runs a short generate to
+populate allocator caches, and `unload_if_idle` releases it again after
+`MODEL_IDLE_UNLOAD_SECONDS` without requests. The processor is small and is
+loaded on its own by `get_processor`, so the preprocessing stage never waits
+for the model, and it stays loaded when the model is unloaded.
+
+With `FLORENCE_INT8_QUANTIZE` on a CPU device, a dynamically int8-quantized
+copy of the model is built at load time and served as the "int8" variant.
+`FLORENCE_MODEL_LOADER` swaps transformers for another loader, such as the
+offline stub model the benchmarks use. `warmup` takes the generate function of
+the inference backend in use, and unload hooks let backends drop what they
+built for the released model. All loading, inference and unloading of the
+model is expected to run on the inference worker thread, which serialises
+them against each other.
+"""
+
+import asyncio
+import copy
+import gc
+import importlib
+import threading
+import time
+from typing import Any, Callable, List, Optional, Tuple
+
+from app.core.config import (
+    FLORENCE_MODEL_ID, FLORENCE_DEVICE, FLORENCE_DTYPE, MODEL_IDLE_UNLOAD_SECONDS,
+    FLORENCE_INT8_QUANTIZE, FLORENCE_MODEL_LOADER, FLORENCE_INPUT_SIZE
+)
+
+
+class TransformersLoader:
+    """
+    Loads Florence-2 with `trust_remote_code` from the Hugging Face hub or a local path.
+    """
+
+    def load_model(self, model_id: str, torch_dtype):
+        from transformers import AutoModelForCausalLM
+
+        return AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch_dtype, trust_remote_code=True)
+
+    def load_processor(self, model_id: str):
+        from transformers import AutoProcessor
+
+        return AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
+
+
+def resolve_loader(path: str):
+    """
+    Imports a loader from a "module:attribute" path; an empty path returns a `TransformersLoader`.
+
+    Raises:
+        ValueError: If the path is not of the form "module:attribute".
+    """
+    if not path:
+        return TransformersLoader()
+    module_name, _, attribute = path.partition(":")
+    if not module_name or not attribute:
+        raise ValueError(f"Model loader '{path}' must be of the form 'module:attribute'")
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def _input_size(processor) -> Tuple[int, int]:
+    # (width, height) the processor resizes images to: a transformers image processor's `size`, a stand-in's
+    # `input_size`, else FLORENCE_INPUT_SIZE
+    size = getattr(getattr(processor, "image_processor", None), "size", None) or getattr(processor, "input_size", None)
+    if isinstance(size, dict) and "width" in size and "height" in size:
+        return int(size["width"]), int(size["height"])
+    if isinstance(size, dict) and "shortest_edge" in size:
+        return int(size["shortest_edge"]), int(size["shortest_edge"])
+    if isinstance(size, int):
+        return size, size
+    return FLORENCE_INPUT_SIZE, FLORENCE_INPUT_SIZE
+
+
+class ModelManager:
+    """
+    Loads, warms up and unloads a Florence-2 model and its processor on demand.
+
+    Args:
+        model_id (str): The Hugging Face model id or local path to load.
+        device (str): The torch device, or "auto" to use cuda:0 when available.
+        dtype (str): The torch dtype name, or "auto" to use float16 on cuda and float32 otherwise.
+        idle_unload_seconds (float): Idle time after which the model is unloaded; 0 disables unloading.
+        quantize_int8 (bool): Whether to also build a dynamically int8-quantized CPU copy of the model.
+        loader (str): The "module:attribute" path of the model loader; empty uses transformers.
+    """
+
+    def __init__(self, model_id: str, device: str, dtype: str, idle_unload_seconds: float, quantize_int8: bool = False,
+                 loader: str = ""):
+        self.model_id = model_id
+        self.loader = loader
+        self._device = device
+        self._dtype = dtype
+        self.idle_unload_seconds = idle_unload_seconds
+        self.quantize_int8 = quantize_int8
+        self.model: Optional[Any] = None
+        self.quantized_model: Optional[Any] = None
+        self.processor: Optional[Any] = None
+        self.state = "unloaded"
+        self.error: Optional[str] = None
+        self.last_used = 0.0
+        self._lock = threading.Lock()
+        self._processor_lock = threading.Lock()
+        self._unload_hooks: List[Callable[[], None]] = []
+
+    @property
+    def device(self) -> str:
+        import torch
+
+        if self._device == "auto":
+            return "cuda:0" if torch.cuda.is_available() else "cpu"
+        return self._device
+
+    @property
+    def torch_dtype(self):
+        import torch
+
+        if self._dtype == "auto":
+            return torch.float16 if self.device.startswith("cuda") else torch.float32
+        return getattr(torch, self._dtype)
+
+    @property
+    def is_ready(self) -> bool:
+        return self.state == "ready"
+
+    def _quantize(self, model):
+        import torch
+
+        if not self.device.startswith("cpu") or self.torch_dtype != torch.float32:
+            raise ValueError("int8 quantization requires a float32 model on the cpu device")
+        return torch.ao.quantization.quantize_dynamic(
+            copy.deepcopy(model), {torch.nn.Linear}, dtype=torch.qint8
+        ).eval()
+
+    def get_processor(self) -> Any:
+        """Returns the processor, loading it first if needed. Safe to call from any thread."""
+        with self._processor_lock:
+            if self.processor is None:
+                self.processor = resolve_loader(self.loader).load_processor(self.model_id)
+            return self.processor
+
+    def load(self):
+        """Loads the model and processor, and the int8 variant if enabled, if they are not loaded yet."""
+        with self._lock:
+            if self.model is not None:
+                return
+            self.state = "loading"
+            self.error = None
+            try:
+                self.model = resolve_loader(self.loader).load_model(
+                    self.model_id, self.torch_dtype
+                ).to(self.device).eval()
+                self.get_processor()
+                if self.quantize_int8:
+                    self.quantized_model = self._quantize(self.model)
+            except Exception as e:
+                self.model = None
+                self.quantized_model = None
+                self.state = "failed"
+                self.error = str(e)
+                raise
+            self.state = "ready"
+            self.last_used = time.monotonic()
+
+    def get(self, variant: str = "default") -> Tuple[Any, Any]:
+        """
+        Returns the loaded model and processor, loading them first if needed.
+
+        Args:
+            variant (str): "default" for the model as configured, or "int8" for the quantized copy.
+
+        Returns:
+            Tuple[Any, Any]: The model and the processor.
+
+        Raises:
+            ValueError: If the int8 variant is requested but quantization is disabled.
+        """
+        if variant == "int8" and not self.quantize_int8:
+            raise ValueError("The int8 model variant is disabled; set FLORENCE_INT8_QUANTIZE to enable it")
+        self.load()
+        self.last_used = time.monotonic()
+        if variant == "int8":
+            return self.quantized_model, self.processor
+        return self.model, self.processor
+
+    def warmup(self, generate: Callable[..., Any] = None):
+        """
+        Loads the model and runs one short generate on a blank image with every loaded variant.
+
+        Args:
+            generate (Callable[..., Any]): Called as `generate(model, input_ids, pixel_values, variant=..., **kwargs)`
+                instead of `model.generate`, so backends that compile or export the model do it here.
+        """
+        import torch
+        from PIL import Image
+
+        model, processor = self.get()
+        image = Image.new("RGB", _input_size(processor))
+        inputs = processor(text="<OD>", images=image, return_tensors="pt").to(self.device, self.torch_dtype)
+        variants = [("default", model)] + ([("int8", self.quantized_model)] if self.quantized_model is not None else [])
+        with torch.inference_mode():
+            for name, variant in variants:
+                kwargs = {"max_new_tokens": 16, "do_sample": False, "num_beams": 3}
+                if generate is None:
+                    variant.generate(input_ids=inputs["input_ids"], pixel_values=inputs["pixel_values"], **kwargs)
+                else:
+                    generate(variant, inputs["input_ids"], inputs["pixel_values"], variant=name, **kwargs)
+
+    def add_unload_hook(self, hook: Callable[[], None]):
+        """Registers a callable run whenever the model is unloaded."""
+        self._unload_hooks.append(hook)
+
+    def unload(self):
+        """Releases the model and returns its memory. The processor stays loaded."""
+        with self._lock:
+            if self.model is None:
+                return
+            self.model = None
+            self.quantized_model = None
+            self.state = "unloaded"
+        for hook in self._unload_hooks:
+            hook()
+        gc.collect()
+        import torch
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def unload_if_idle(self) -> bool:
+        """
+        Unloads the model if it has not been used for `idle_unload_seconds`.
+
+        Returns:
+            bool: Whether the model was unloaded.
+        """
+        if self.model is None or self.idle_unload_seconds <= 0:
+            return False
+        if time.monotonic() - self.last_used < self.idle_unload_seconds:
+            return False
+        self.unload()
+        return True
+
+    async def idle_unload_loop(self, worker):
+        """
+        Periodically unloads the model once it has been idle long enough.
+
+        Args:
+            worker (InferenceWorker): The worker used for inference, so unloading never races a running batch.
+        """
+        if self.idle_unload_seconds <= 0:
+            return
+        interval = max(1.0, self.idle_unload_seconds / 4)
+        while True:
+            await asyncio.sleep(interval)
+            await worker.run(self.unload_if_idle)
+
+    def status(self) -> dict:
+        return {
+            "model_id": self.model_id,
+            "loader": self.loader or "transformers",
+            "state": self.state,
+            "device": self._device,
+            "dtype": self._dtype,
+            "int8_variant": self.quantize_int8,
+            "idle_unload_seconds": self.idle_unload_seconds,
+            "idle_seconds": round(time.monotonic() - self.last_used, 1) if self.model is not None else None,
+            "error": self.error,
+        }
+
+
+model_manager = ModelManager(
+    FLORENCE_MODEL_ID, FLORENCE_DEVICE, FLORENCE_DTYPE, MODEL_IDLE_UNLOAD_SECONDS, FLORENCE_INT8_QUANTIZE,
+    FLORENCE_MODEL_LOADER
+)
@@ -0,0 +1,216 @@
+"""
+Perceptual-hash index of detected images, for reusing detections on near-duplicates.
+
+Video stills and re-encoded or resized copies of an image differ byte for
+byte, so the content-addressed detection cache misses them. Their perceptual
+hashes (pHash or dHash, 64 bits each) differ in only a few bits, though.
+`NearDuplicateIndex` keeps the hash, size and parsed answer of detected images
+in BK-trees, one per set of generation settings, and finds the closest one
+within a Hamming distance. Boxes are only carried over between images of the
+same aspect ratio, rescaled to the new image size by `rescale_answer`.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from app.core.config import NEAR_DUPLICATE_HASH, NEAR_DUPLICATE_MAX_ENTRIES
+from app.utils.image_utils import open_reduced
+
+
+# Relative aspect ratio difference beyond which two images are never treated as duplicates,
+# since a crop or pad would move the boxes in ways rescaling cannot undo
+ASPECT_TOLERANCE = 0.02
+
+
+def dhash(image: Image.Image) -> int:
+    """64-bit difference hash: whether each pixel of a 9x8 grayscale thumbnail is brighter than its left neighbour."""
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    return _pack(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(image: Image.Image) -> int:
+    """64-bit perceptual hash: the signs of the lowest 8x8 DCT frequencies of a 32x32 grayscale thumbnail around their median."""
+    pixels = np.asarray(image.convert("L").resize((32, 32), Image.LANCZOS), dtype=np.float32)
+    low = cv2.dct(pixels)[:8, :8]
+    return _pack(low > np.median(low))
+
+
+def _pack(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), "big")
+
+
+HASH_FUNCTIONS = {"phash": phash, "dhash": dhash}
+
+
+def perceptual_hash(contents: bytes, method: str = NEAR_DUPLICATE_HASH) -> Tuple[int, Tuple[int, int]]:
+    """
+    Hashes an encoded image, decoding JPEGs at the smallest scale that covers the thumbnail.
+
+    Returns:
+        Tuple[int, Tuple[int, int]]: The hash and the (width, height) of the original image.
+
+    Raises:
+        ValueError: If the hash method is unknown.
+    """
+    if method not in HASH_FUNCTIONS:
+        raise ValueError(f"Unknown perceptual hash '{method}'; expected one of {sorted(HASH_FUNCTIONS)}")
+    image, original_size = open_reduced(contents, (32, 32))
+    return HASH_FUNCTIONS[method](image), original_size
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def same_aspect(size: Tuple[int, int], other: Tuple[int, int]) -> bool:
+    aspect, other_aspect = size[0] / size[1], other[0] / other[1]
+    return abs(aspect - other_aspect) <= ASPECT_TOLERANCE * aspect
+
+
+def rescale_answer(answer: dict, from_size: Tuple[int, int], to_size: Tuple[int, int]) -> dict:
+    """
+    Returns a copy of a parsed answer with every task's `bboxes` scaled from one image size to another.
+    """
+    scale_x, scale_y = to_size[0] / from_size[0], to_size[1] / from_size[1]
+    rescaled = {}
+    for task, value in answer.items():
+        if isinstance(value, dict) and "bboxes" in value:
+            value = {**value, "bboxes": [
+                [x1 * scale_x, y1 * scale_y, x2 * scale_x, y2 * scale_y] for x1, y1, x2, y2 in value["bboxes"]
+            ]}
+        rescaled[task] = value
+    return rescaled
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit hashes under the Hamming distance.
+
+    Each child edge is labelled with its distance to the parent, so by the triangle inequality a search for
+    hashes within `d` of a query only descends into edges labelled within `d` of the query's distance to the node.
+    """
+
+    def __init__(self):
+        # Node: [hash, ids with that hash, {distance: child node}]
+        self._root: Optional[list] = None
+
+    def add(self, value: int, item_id: int):
+        if self._root is None:
+            self._root = [value, [item_id], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item_id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item_id], {}]
+                return
+            node = child
+
+    def search(self, value: int, max_distance: int) -> List[Tuple[int, int]]:
+        """Returns the (distance, id) of every stored hash within `max_distance` of `value`, closest first."""
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                found.extend((distance, item_id) for item_id in node[1])
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return sorted(found)
+
+
+class NearDuplicateIndex:
+    """
+    Bounded, thread-safe index of detected images by perceptual hash.
+
+    Entries are partitioned by a key of the generation settings, since a detection only stands in for another made
+    with the same model and profile. The oldest entries are dropped beyond `max_entries`; their tree nodes are
+    skipped until the trees are rebuilt, which happens once as many entries were dropped as are live.
+
+    Args:
+        max_entries (int): The maximum number of indexed images.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self._trees: Dict[str, BKTree] = {}
+        self._next_id = 0
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def add(self, settings_key: str, value: int, size: Tuple[int, int], answer: dict, source: str):
+        """
+        Indexes one detected image.
+
+        Args:
+            settings_key (str): The key of the generation settings the answer was made with.
+            value (int): The perceptual hash of the image.
+            size (Tuple[int, int]): The (width, height) of the image.
+            answer (dict): The parsed answer.
+            source (str): An identifier of the image reported with the duplicates it stands in for.
+        """
+        with self._lock:
+            item_id = self._next_id
+            self._next_id += 1
+            self._entries[item_id] = (settings_key, value, size, answer, source)
+            self._trees.setdefault(settings_key, BKTree()).add(value, item_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._dropped += 1
+            if self._dropped > len(self._entries):
+                self._rebuild()
+
+    def _rebuild(self):
+        self._trees = {}
+        for item_id, (settings_key, value, _, _, _) in self._entries.items():
+            self._trees.setdefault(settings_key, BKTree()).add(value, item_id)
+        self._dropped = 0
+
+    def find(self, settings_key: str, value: int, size: Tuple[int, int], max_distance: int) -> Optional[dict]:
+        """
+        Looks up the closest indexed image of the same aspect ratio within `max_distance`.
+
+        Returns:
+            Optional[dict]: The match's "distance", "answer" rescaled to `size`, and "source"; None if there is none.
+        """
+        with self._lock:
+            tree = self._trees.get(settings_key)
+            if tree is None:
+                return None
+            for distance, item_id in tree.search(value, max_distance):
+                entry = self._entries.get(item_id)
+                if entry is None or not same_aspect(entry[2], size):
+                    continue
+                self._entries.move_to_end(item_id)
+                self.hits += 1
+                _, _, source_size, answer, source = entry
+                return {"distance": distance, "answer": rescale_answer(answer, source_size, size), "source": source}
+        return None
+
+    def clear(self) -> int:
+        with self._lock:
+            removed = len(self._entries)
+            self._entries.clear()
+            self._trees = {}
+            self._dropped = 0
+            return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits}
+
+
+near_duplicate_index = NearDuplicateIndex(NEAR_DUPLICATE_MAX_ENTRIES)
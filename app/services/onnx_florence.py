@@ -0,0 +1,436 @@
+"""
+Florence-2 exported to ONNX and decoded on ONNX Runtime with a KV cache.
+
+`export_onnx` writes four graphs and the generation settings they need:
+
+    vision_encoder.onnx   pixel_values -> image_features
+    text_encoder.onnx     input_ids, image_features -> encoder_hidden_states, encoder_attention_mask
+    decoder_init.onnx     the first decoder step; returns logits and the self- and cross-attention keys/values
+    decoder_step.onnx     every later step; takes the cached keys/values and returns the new self-attention ones
+    generation.json       special tokens and search settings from the model's generation config
+
+`OnnxFlorence` runs them with the same search as `generate`: greedy or beam
+search with forced BOS/EOS tokens, no-repeat n-grams, length penalty and
+early stopping. Cross-attention keys/values are computed once per image and
+self-attention keys/values once per token.
+"""
+
+import copy
+import inspect
+import json
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+GRAPHS = ("vision_encoder", "text_encoder", "decoder_init", "decoder_step")
+SETTINGS_FILE = "generation.json"
+OPSET_VERSION = 17
+
+
+def is_exported(directory: str) -> bool:
+    return all(os.path.exists(os.path.join(directory, f"{name}.onnx")) for name in GRAPHS) and \
+        os.path.exists(os.path.join(directory, SETTINGS_FILE))
+
+
+def _legacy_cache(past) -> tuple:
+    # Newer remote code returns Cache objects; the graphs exchange the per-layer tuples
+    return past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past
+
+
+def _logits(language_model, hidden_states):
+    logits = language_model.lm_head(hidden_states)
+    bias = getattr(language_model, "final_logits_bias", None)
+    return logits + bias if bias is not None else logits
+
+
+def _generation_settings(model, layers: int) -> dict:
+    language_model = model.language_model
+    config = getattr(language_model, "generation_config", None) or getattr(model, "generation_config", None)
+    text_config = language_model.config
+
+    def setting(name, default):
+        value = getattr(config, name, None) if config is not None else None
+        if value is None:
+            value = getattr(text_config, name, None)
+        return default if value is None else value
+
+    return {
+        "layers": layers,
+        "decoder_start_token_id": setting("decoder_start_token_id", 2),
+        "bos_token_id": setting("bos_token_id", 0),
+        "eos_token_id": setting("eos_token_id", 2),
+        "pad_token_id": setting("pad_token_id", 1),
+        "forced_bos_token_id": setting("forced_bos_token_id", None),
+        "forced_eos_token_id": setting("forced_eos_token_id", None),
+        "no_repeat_ngram_size": setting("no_repeat_ngram_size", 0),
+        "length_penalty": setting("length_penalty", 1.0),
+        "early_stopping": setting("early_stopping", False),
+    }
+
+
+def export_onnx(model, directory: str, image_size: int = 768, prompt_length: int = 12):
+    """
+    Exports a float32 Florence-2 model to `directory`.
+
+    Args:
+        model: The loaded Florence-2 model.
+        directory (str): The output directory; existing graphs are overwritten.
+        image_size (int): The side length of the dummy image used for tracing.
+        prompt_length (int): The length of the dummy prompt used for tracing.
+    """
+    import torch
+
+    class VisionEncoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, pixel_values):
+            return self.model._encode_image(pixel_values)
+
+    class TextEncoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, image_features):
+            inputs_embeds = self.model.get_input_embeddings()(input_ids)
+            inputs_embeds, attention_mask = self.model._merge_input_ids_with_image_features(image_features, inputs_embeds)
+            encoder = self.model.language_model.get_encoder()
+            hidden_states = encoder(inputs_embeds=inputs_embeds, attention_mask=attention_mask, return_dict=True).last_hidden_state
+            return hidden_states, attention_mask
+
+    class DecoderInit(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask):
+            language_model = self.model.language_model
+            outputs = language_model.get_decoder()(
+                input_ids=decoder_input_ids, encoder_hidden_states=encoder_hidden_states,
+                encoder_attention_mask=encoder_attention_mask, use_cache=True, return_dict=True
+            )
+            present = [tensor for layer in _legacy_cache(outputs.past_key_values) for tensor in layer]
+            return (_logits(language_model, outputs.last_hidden_state), *present)
+
+    class DecoderStep(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask, *past):
+            language_model = self.model.language_model
+            past_key_values = tuple(tuple(past[i:i + 4]) for i in range(0, len(past), 4))
+            outputs = language_model.get_decoder()(
+                input_ids=decoder_input_ids, encoder_hidden_states=encoder_hidden_states,
+                encoder_attention_mask=encoder_attention_mask, past_key_values=past_key_values,
+                use_cache=True, return_dict=True
+            )
+            present = [tensor for layer in _legacy_cache(outputs.past_key_values) for tensor in layer[:2]]
+            return (_logits(language_model, outputs.last_hidden_state), *present)
+
+    os.makedirs(directory, exist_ok=True)
+    parameter = next(model.parameters())
+    if parameter.dtype != torch.float32 or parameter.device.type != "cpu":
+        # The serving model stays where it is; the export traces a float32 CPU copy
+        model = copy.deepcopy(model).float().cpu()
+    model.eval()
+    pixel_values = torch.zeros(1, 3, image_size, image_size)
+    input_ids = torch.ones(1, prompt_length, dtype=torch.long)
+
+    # The graphs are traced with `dynamic_axes`; newer torch defaults to the dynamo exporter, which cannot use them
+    exporter = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+
+    def export(module, args, name, input_names, output_names, dynamic_axes):
+        torch.onnx.export(
+            module.eval(), args, os.path.join(directory, f"{name}.onnx"),
+            input_names=input_names, output_names=output_names, dynamic_axes=dynamic_axes,
+            opset_version=OPSET_VERSION, do_constant_folding=True, **exporter
+        )
+
+    with torch.no_grad():
+        image_features = VisionEncoder()(pixel_values)
+        export(VisionEncoder(), (pixel_values,), "vision_encoder", ["pixel_values"], ["image_features"],
+               {"pixel_values": {0: "batch"}, "image_features": {0: "batch"}})
+
+        hidden_states, attention_mask = TextEncoder()(input_ids, image_features)
+        export(TextEncoder(), (input_ids, image_features), "text_encoder",
+               ["input_ids", "image_features"], ["encoder_hidden_states", "encoder_attention_mask"],
+               {"input_ids": {0: "batch", 1: "prompt_length"}, "image_features": {0: "batch"},
+                "encoder_hidden_states": {0: "batch", 1: "encoder_length"},
+                "encoder_attention_mask": {0: "batch", 1: "encoder_length"}})
+
+        start = torch.full((1, 1), _generation_settings(model, 0)["decoder_start_token_id"], dtype=torch.long)
+        init_outputs = DecoderInit()(start, hidden_states, attention_mask)
+        layers = (len(init_outputs) - 1) // 4
+        encoder_axes = {
+            "decoder_input_ids": {0: "batch"},
+            "encoder_hidden_states": {0: "batch", 1: "encoder_length"},
+            "encoder_attention_mask": {0: "batch", 1: "encoder_length"},
+            "logits": {0: "batch"},
+        }
+
+        init_names = [f"present_{i}_{kind}" for i in range(layers) for kind in ("self_key", "self_value", "cross_key", "cross_value")]
+        init_axes = dict(encoder_axes)
+        for name in init_names:
+            init_axes[name] = {0: "batch", 2: "encoder_length" if "cross" in name else "decoder_length"}
+        export(DecoderInit(), (start, hidden_states, attention_mask), "decoder_init",
+               ["decoder_input_ids", "encoder_hidden_states", "encoder_attention_mask"], ["logits", *init_names], init_axes)
+
+        past_names = [name.replace("present_", "past_") for name in init_names]
+        step_names = [f"present_{i}_{kind}" for i in range(layers) for kind in ("self_key", "self_value")]
+        step_axes = dict(encoder_axes)
+        for name in past_names:
+            step_axes[name] = {0: "batch", 2: "encoder_length" if "cross" in name else "past_length"}
+        for name in step_names:
+            step_axes[name] = {0: "batch", 2: "decoder_length"}
+        export(DecoderStep(), (start, hidden_states, attention_mask, *init_outputs[1:]), "decoder_step",
+               ["decoder_input_ids", "encoder_hidden_states", "encoder_attention_mask", *past_names],
+               ["logits", *step_names], step_axes)
+
+    with open(os.path.join(directory, SETTINGS_FILE), "w") as f:
+        json.dump(_generation_settings(model, layers), f, indent=2)
+
+
+def quantize_onnx(source: str, directory: str):
+    """
+    Writes a dynamically int8-quantized copy of an exported model, the ONNX Runtime counterpart of the int8 variant.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    os.makedirs(directory, exist_ok=True)
+    for name in GRAPHS:
+        quantize_dynamic(
+            os.path.join(source, f"{name}.onnx"), os.path.join(directory, f"{name}.onnx"), weight_type=QuantType.QInt8
+        )
+    with open(os.path.join(source, SETTINGS_FILE)) as src, open(os.path.join(directory, SETTINGS_FILE), "w") as dst:
+        dst.write(src.read())
+
+
+def _log_softmax(logits: np.ndarray) -> np.ndarray:
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    return shifted - np.log(np.exp(shifted).sum(axis=-1, keepdims=True))
+
+
+class _Hypotheses:
+    """Finished beams of one batch entry, scored like transformers' `BeamHypotheses`."""
+
+    def __init__(self, num_beams: int, length_penalty: float, early_stopping):
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+        self.beams: List[Tuple[float, np.ndarray]] = []
+        self.worst_score = 1e9
+
+    def add(self, hypothesis: np.ndarray, sum_logprobs: float, generated_len: int):
+        score = sum_logprobs / (generated_len ** self.length_penalty)
+        if len(self.beams) < self.num_beams or score > self.worst_score:
+            self.beams.append((score, hypothesis))
+            if len(self.beams) > self.num_beams:
+                ranked = sorted((s, index) for index, (s, _) in enumerate(self.beams))
+                del self.beams[ranked[0][1]]
+                self.worst_score = ranked[1][0]
+            else:
+                self.worst_score = min(score, self.worst_score)
+
+    def is_done(self, best_sum_logprobs: float, generated_len: int) -> bool:
+        if len(self.beams) < self.num_beams:
+            return False
+        if self.early_stopping is True:
+            return True
+        return self.worst_score >= best_sum_logprobs / (generated_len ** self.length_penalty)
+
+
+class OnnxFlorence:
+    """
+    Runs an exported Florence-2 model on ONNX Runtime.
+
+    Args:
+        directory (str): A directory written by `export_onnx` or `quantize_onnx`.
+        providers (List[str]): ONNX Runtime execution providers, in order of preference.
+    """
+
+    def __init__(self, directory: str, providers: Optional[List[str]] = None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = providers or ["CPUExecutionProvider"]
+        self.sessions = {
+            name: ort.InferenceSession(os.path.join(directory, f"{name}.onnx"), options, providers=providers)
+            for name in GRAPHS
+        }
+        # The exporter drops inputs a graph does not use, e.g. the encoder states of a step that reads cached keys/values
+        self._input_names = {name: {i.name for i in session.get_inputs()} for name, session in self.sessions.items()}
+        with open(os.path.join(directory, SETTINGS_FILE)) as f:
+            self.settings = json.load(f)
+        self.layers = self.settings["layers"]
+
+    def _run(self, graph: str, feed: dict) -> list:
+        names = self._input_names[graph]
+        return self.sessions[graph].run(None, {name: value for name, value in feed.items() if name in names})
+
+    def encode_image(self, pixel_values: np.ndarray) -> np.ndarray:
+        return self.sessions["vision_encoder"].run(None, {"pixel_values": pixel_values.astype(np.float32)})[0]
+
+    def encode(self, input_ids: np.ndarray, image_features: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        hidden_states, attention_mask = self.sessions["text_encoder"].run(
+            None, {"input_ids": input_ids.astype(np.int64), "image_features": image_features}
+        )
+        return hidden_states, attention_mask
+
+    def _process_scores(self, scores: np.ndarray, sequences: np.ndarray, max_length: int) -> np.ndarray:
+        # The logits processors `generate` applies for these settings, on log-probabilities
+        cur_len = sequences.shape[1]
+        n = self.settings["no_repeat_ngram_size"]
+        if n and cur_len + 1 >= n:
+            for row, sequence in enumerate(sequences.tolist()):
+                prefix = tuple(sequence[cur_len - n + 1:])
+                banned = {
+                    sequence[i + n - 1] for i in range(cur_len - n + 1)
+                    if tuple(sequence[i:i + n - 1]) == prefix
+                }
+                if banned:
+                    scores[row, list(banned)] = -np.inf
+        forced = None
+        if cur_len == 1 and self.settings["forced_bos_token_id"] is not None:
+            forced = self.settings["forced_bos_token_id"]
+        elif cur_len == max_length - 1 and self.settings["forced_eos_token_id"] is not None:
+            forced = self.settings["forced_eos_token_id"]
+        if forced is not None:
+            scores[:] = -np.inf
+            scores[:, forced] = 0
+        return scores
+
+    def _first_step(self, start: np.ndarray, hidden_states: np.ndarray, attention_mask: np.ndarray):
+        outputs = self._run("decoder_init", {
+            "decoder_input_ids": start, "encoder_hidden_states": hidden_states, "encoder_attention_mask": attention_mask,
+        })
+        present = outputs[1:]
+        self_cache = [present[4 * i + j] for i in range(self.layers) for j in (0, 1)]
+        cross_cache = [present[4 * i + j] for i in range(self.layers) for j in (2, 3)]
+        return outputs[0][:, -1], self_cache, cross_cache
+
+    def _next_step(self, tokens: np.ndarray, hidden_states, attention_mask, self_cache, cross_cache):
+        feed = {"decoder_input_ids": tokens, "encoder_hidden_states": hidden_states, "encoder_attention_mask": attention_mask}
+        for i in range(self.layers):
+            feed[f"past_{i}_self_key"] = self_cache[2 * i]
+            feed[f"past_{i}_self_value"] = self_cache[2 * i + 1]
+            feed[f"past_{i}_cross_key"] = cross_cache[2 * i]
+            feed[f"past_{i}_cross_value"] = cross_cache[2 * i + 1]
+        outputs = self._run("decoder_step", feed)
+        return outputs[0][:, -1], outputs[1:]
+
+    def _greedy(self, hidden_states, attention_mask, max_length: int) -> np.ndarray:
+        batch_size = hidden_states.shape[0]
+        eos, pad = self.settings["eos_token_id"], self.settings["pad_token_id"]
+        sequences = np.full((batch_size, 1), self.settings["decoder_start_token_id"], np.int64)
+        logits, self_cache, cross_cache = self._first_step(sequences, hidden_states, attention_mask)
+        finished = np.zeros(batch_size, bool)
+        while True:
+            scores = self._process_scores(logits.astype(np.float32), sequences, max_length)
+            tokens = np.where(finished, pad, scores.argmax(axis=-1)).astype(np.int64)
+            sequences = np.concatenate([sequences, tokens[:, None]], axis=1)
+            finished |= tokens == eos
+            if finished.all() or sequences.shape[1] >= max_length:
+                return sequences
+            logits, self_cache = self._next_step(tokens[:, None], hidden_states, attention_mask, self_cache, cross_cache)
+
+    def _beam_search(self, hidden_states, attention_mask, max_length: int, num_beams: int) -> np.ndarray:
+        batch_size = hidden_states.shape[0]
+        eos, pad = self.settings["eos_token_id"], self.settings["pad_token_id"]
+        hidden_states = np.repeat(hidden_states, num_beams, axis=0)
+        attention_mask = np.repeat(attention_mask, num_beams, axis=0)
+        sequences = np.full((batch_size * num_beams, 1), self.settings["decoder_start_token_id"], np.int64)
+        beam_scores = np.zeros((batch_size, num_beams), np.float32)
+        beam_scores[:, 1:] = -1e9
+        hypotheses = [_Hypotheses(num_beams, self.settings["length_penalty"], self.settings["early_stopping"]) for _ in range(batch_size)]
+        done = np.zeros(batch_size, bool)
+
+        logits, self_cache, cross_cache = self._first_step(sequences, hidden_states, attention_mask)
+        while True:
+            cur_len = sequences.shape[1]
+            scores = self._process_scores(_log_softmax(logits.astype(np.float32)), sequences, max_length)
+            vocab_size = scores.shape[-1]
+            scores = (scores + beam_scores.reshape(-1, 1)).reshape(batch_size, num_beams * vocab_size)
+            top = np.argsort(-scores, axis=1, kind="stable")[:, :2 * num_beams]
+
+            next_scores = np.zeros((batch_size, num_beams), np.float32)
+            next_tokens = np.full((batch_size, num_beams), pad, np.int64)
+            next_indices = np.zeros((batch_size, num_beams), np.int64)
+            for b in range(batch_size):
+                if done[b]:
+                    next_indices[b] = b * num_beams + np.arange(num_beams)
+                    continue
+                chosen = 0
+                for rank, flat in enumerate(top[b]):
+                    beam, token = divmod(int(flat), vocab_size)
+                    score = float(scores[b, flat])
+                    if token == eos:
+                        if rank < num_beams:
+                            hypotheses[b].add(sequences[b * num_beams + beam].copy(), score, cur_len)
+                    else:
+                        next_scores[b, chosen] = score
+                        next_tokens[b, chosen] = token
+                        next_indices[b, chosen] = b * num_beams + beam
+                        chosen += 1
+                    if chosen == num_beams:
+                        break
+                done[b] = hypotheses[b].is_done(float(scores[b, top[b, 0]]), cur_len)
+
+            beam_scores = next_scores
+            order = next_indices.reshape(-1)
+            sequences = np.concatenate([sequences[order], next_tokens.reshape(-1, 1)], axis=1)
+            if done.all() or sequences.shape[1] >= max_length:
+                break
+            self_cache = [cache[order] for cache in self_cache]
+            logits, self_cache = self._next_step(next_tokens.reshape(-1, 1), hidden_states, attention_mask, self_cache, cross_cache)
+
+        best = []
+        for b in range(batch_size):
+            if not done[b]:
+                for k in range(num_beams):
+                    hypotheses[b].add(sequences[b * num_beams + k].copy(), float(beam_scores[b, k]), sequences.shape[1] - 1)
+            best.append(max(hypotheses[b].beams, key=lambda beam: beam[0])[1])
+
+        length = min(max(len(sequence) for sequence in best) + 1, max_length)
+        output = np.full((batch_size, length), pad, np.int64)
+        for b, sequence in enumerate(best):
+            output[b, :len(sequence)] = sequence
+            if len(sequence) < length:
+                output[b, len(sequence)] = eos
+        return output
+
+    def decode(self, hidden_states: np.ndarray, attention_mask: np.ndarray, max_new_tokens: int = 20, num_beams: int = 1) -> np.ndarray:
+        """
+        Generates token ids from encoder outputs.
+
+        Returns:
+            np.ndarray: (batch, length) token ids starting with the decoder start token, padded with the pad token.
+        """
+        max_length = 1 + max_new_tokens
+        if num_beams > 1:
+            return self._beam_search(hidden_states, attention_mask, max_length, num_beams)
+        return self._greedy(hidden_states, attention_mask, max_length)
+
+    def generate_from_features(self, input_ids: np.ndarray, image_features: np.ndarray, max_new_tokens: int = 20,
+                               num_beams: int = 1, do_sample: bool = False, **unused) -> np.ndarray:
+        """
+        Generates token ids for a prompt from image features returned by `encode_image`.
+
+        Raises:
+            ValueError: If sampling is requested; only greedy and beam search are supported.
+        """
+        if do_sample:
+            raise ValueError("The ONNX Runtime backend supports greedy and beam search only")
+        hidden_states, attention_mask = self.encode(input_ids, image_features)
+        return self.decode(hidden_states, attention_mask, max_new_tokens, num_beams)
+
+    def generate(self, input_ids: np.ndarray, pixel_values: np.ndarray, **generate_kwargs) -> np.ndarray:
+        """
+        The ONNX Runtime counterpart of `model.generate(input_ids=..., pixel_values=..., ...)`.
+        """
+        return self.generate_from_features(input_ids, self.encode_image(pixel_values), **generate_kwargs)
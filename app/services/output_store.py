@@ -0,0 +1,313 @@
+"""
+Single managed store for every file the services produce.
+
+Outputs live under `OUTPUT_ROOT/<kind dir>/<request id>/`, where the kind is
+"processed" (image processing), "augmented" (augmentation), "jobs"
+(detection jobs) or "profiles" (request profiles). An in-memory index records what each request produced, so
+listing and lookups never scan directories. A background sweep evicts
+requests older than `OUTPUT_TTL_SECONDS` and, past `OUTPUT_QUOTA_BYTES`, the
+least recently updated ones. Eviction removes whole request directories, and
+clearing a kind renames its directory away before deleting it.
+"""
+
+import asyncio
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from app.core.config import (
+    OUTPUT_ROOT, OUTPUT_TTL_SECONDS, OUTPUT_QUOTA_BYTES, OUTPUT_SWEEP_INTERVAL_SECONDS
+)
+from app.utils.files_utils import is_safe_id
+
+
+KIND_DIRS = {
+    "processed": "processed_images",
+    "augmented": "augmented_images",
+    "jobs": "jobs",
+    "profiles": "profiles",
+}
+
+
+class OutputStore:
+    """
+    Indexed, size-bounded store of request outputs.
+
+    Args:
+        root (str): The directory holding one subdirectory per kind.
+        ttl_seconds (float): Age after which a request's outputs are evicted; 0 disables TTL eviction.
+        quota_bytes (int): Total size above which the oldest outputs are evicted; 0 disables the quota.
+        sweep_interval (float): Seconds between background eviction sweeps.
+    """
+
+    def __init__(self, root: str, ttl_seconds: float, quota_bytes: int, sweep_interval: float):
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        self.quota_bytes = quota_bytes
+        self.sweep_interval = sweep_interval
+        self._entries: Optional[Dict[str, dict]] = None
+        self._active: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        self.evicted_requests = 0
+
+    def kind_dir(self, kind: str) -> str:
+        return os.path.join(self.root, KIND_DIRS[kind])
+
+    def load_index(self):
+        """
+        Builds the index from disk unless it is built already.
+
+        The store is created at import, and processes that import it without using it, such as CPU pool workers,
+        must not walk OUTPUT_ROOT; the index is therefore built on first use, or ahead of it by `sweep_loop`.
+        """
+        with self._lock:
+            if self._entries is None:
+                self._entries = {}
+                self._rebuild_index()
+
+    @property
+    def _index(self) -> Dict[str, dict]:
+        self.load_index()
+        return self._entries
+
+    def _rebuild_index(self):
+        for kind in KIND_DIRS:
+            kind_dir = self.kind_dir(kind)
+            if not os.path.isdir(kind_dir):
+                continue
+            for entry in os.scandir(kind_dir):
+                if entry.is_dir() and is_safe_id(entry.name):
+                    self._index_from_disk(kind, entry.name)
+
+    def _index_from_disk(self, kind: str, request_id: str) -> Optional[dict]:
+        directory = os.path.join(self.kind_dir(kind), request_id)
+        if not os.path.isdir(directory):
+            return None
+        files = {}
+        updated_at = os.stat(directory).st_mtime
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in filenames:
+                stat = os.stat(os.path.join(dirpath, filename))
+                files[os.path.relpath(os.path.join(dirpath, filename), directory)] = stat.st_size
+                updated_at = max(updated_at, stat.st_mtime)
+        entry = {
+            "request_id": request_id,
+            "kind": kind,
+            "created_at": updated_at,
+            "updated_at": updated_at,
+            "files": files,
+            "bytes": sum(files.values()),
+        }
+        with self._lock:
+            self._index[request_id] = entry
+        return entry
+
+    def _entry(self, kind: str, request_id: str) -> dict:
+        with self._lock:
+            entry = self._index.get(request_id)
+            if entry is None:
+                now = time.time()
+                entry = {
+                    "request_id": request_id, "kind": kind, "created_at": now,
+                    "updated_at": now, "files": {}, "bytes": 0,
+                }
+                self._index[request_id] = entry
+            return entry
+
+    def request_dir(self, kind: str, request_id: str) -> str:
+        """
+        Returns (and creates) the directory of one request's outputs.
+
+        Raises:
+            ValueError: If the request id is not a safe path component.
+        """
+        if not is_safe_id(request_id):
+            raise ValueError("Invalid request id")
+        directory = os.path.join(self.kind_dir(kind), request_id)
+        os.makedirs(directory, exist_ok=True)
+        self._entry(kind, request_id)
+        return directory
+
+    def record(self, kind: str, request_id: str, path: str):
+        """
+        Adds a file already written inside the request's directory to the index.
+        """
+        size = os.path.getsize(path)
+        name = os.path.relpath(path, os.path.join(self.kind_dir(kind), request_id))
+        with self._lock:
+            entry = self._entry(kind, request_id)
+            entry["bytes"] += size - entry["files"].get(name, 0)
+            entry["files"][name] = size
+            entry["updated_at"] = time.time()
+
+    def save_bytes(self, kind: str, request_id: str, filename: str, data: bytes) -> str:
+        """
+        Writes one output file and indexes it.
+
+        Returns:
+            str: The path of the written file.
+        """
+        path = os.path.join(self.request_dir(kind, request_id), os.path.basename(filename))
+        with open(path, "wb") as out_file:
+            out_file.write(data)
+        self.record(kind, request_id, path)
+        return path
+
+    def get(self, request_id: str, kind: Optional[str] = None) -> Optional[dict]:
+        """
+        Returns the index entry of a request, looking on disk if another worker produced it.
+        """
+        if not is_safe_id(request_id):
+            return None
+        with self._lock:
+            entry = self._index.get(request_id)
+        if entry is None:
+            for candidate in ([kind] if kind else KIND_DIRS):
+                entry = self._index_from_disk(candidate, request_id)
+                if entry is not None:
+                    break
+        if entry is None or (kind and entry["kind"] != kind):
+            return None
+        return entry
+
+    def list(self, kind: Optional[str] = None) -> List[dict]:
+        """
+        Lists index entries, newest first, without their file lists.
+        """
+        with self._lock:
+            entries = [e for e in self._index.values() if kind is None or e["kind"] == kind]
+            summaries = [{k: v for k, v in e.items() if k != "files"} | {"file_count": len(e["files"])} for e in entries]
+        return sorted(summaries, key=lambda e: e["updated_at"], reverse=True)
+
+    def files(self, kind: str, request_id: Optional[str] = None) -> Iterator[Tuple[str, str]]:
+        """
+        Yields (archive name, path) pairs of one request's outputs, or of every request of a kind.
+        """
+        if request_id is not None:
+            entries = [self.get(request_id, kind)]
+        else:
+            with self._lock:
+                entries = [e for e in self._index.values() if e["kind"] == kind]
+        for entry in entries:
+            if entry is None:
+                continue
+            directory = os.path.join(self.kind_dir(kind), entry["request_id"])
+            prefix = "" if request_id is not None else f"{entry['request_id']}/"
+            for name in list(entry["files"]):
+                yield f"{prefix}{name}", os.path.join(directory, name)
+
+    def has_files(self, kind: str, request_id: Optional[str] = None) -> bool:
+        if request_id is not None:
+            entry = self.get(request_id, kind)
+            return bool(entry and entry["files"])
+        with self._lock:
+            return any(e["files"] for e in self._index.values() if e["kind"] == kind)
+
+    def mark_active(self, request_id: str):
+        """
+        Protects a request's outputs from eviction while it is still being produced.
+        """
+        with self._lock:
+            self._active[request_id] = self._active.get(request_id, 0) + 1
+
+    def mark_done(self, request_id: str):
+        with self._lock:
+            count = self._active.get(request_id, 0) - 1
+            if count > 0:
+                self._active[request_id] = count
+            else:
+                self._active.pop(request_id, None)
+
+    def delete(self, request_id: str) -> bool:
+        """
+        Removes all outputs of one request.
+
+        Returns:
+            bool: Whether the request existed.
+        """
+        entry = self.get(request_id)
+        if entry is None:
+            return False
+        with self._lock:
+            self._index.pop(request_id, None)
+        shutil.rmtree(os.path.join(self.kind_dir(entry["kind"]), request_id), ignore_errors=True)
+        return True
+
+    def clear(self, kind: str) -> int:
+        """
+        Removes every output of a kind. The directory is renamed away first so new outputs are never caught by the deletion.
+
+        Returns:
+            int: The number of requests removed.
+        """
+        with self._lock:
+            request_ids = [r for r, e in self._index.items() if e["kind"] == kind and r not in self._active]
+            for request_id in request_ids:
+                del self._index[request_id]
+        # Each call has its own trash directory, so concurrent clears never delete each other's renamed outputs
+        trash_dir = os.path.join(self.root, ".trash", uuid.uuid4().hex)
+        os.makedirs(trash_dir)
+        for request_id in request_ids:
+            try:
+                os.rename(os.path.join(self.kind_dir(kind), request_id), os.path.join(trash_dir, request_id))
+            except OSError:
+                continue
+        shutil.rmtree(trash_dir, ignore_errors=True)
+        return len(request_ids)
+
+    def sweep(self) -> int:
+        """
+        Evicts expired requests, then the least recently updated ones while the store exceeds its quota.
+
+        Returns:
+            int: The number of requests evicted.
+        """
+        now = time.time()
+        with self._lock:
+            candidates = sorted(
+                (e for r, e in self._index.items() if r not in self._active),
+                key=lambda e: e["updated_at"]
+            )
+            total = sum(e["bytes"] for e in self._index.values())
+        evict = []
+        for entry in candidates:
+            expired = self.ttl_seconds > 0 and now - entry["updated_at"] > self.ttl_seconds
+            over_quota = self.quota_bytes > 0 and total > self.quota_bytes
+            if not expired and not over_quota:
+                continue
+            evict.append(entry["request_id"])
+            total -= entry["bytes"]
+        for request_id in evict:
+            self.delete(request_id)
+        self.evicted_requests += len(evict)
+        return len(evict)
+
+    async def sweep_loop(self):
+        """
+        Loads the index, then runs `sweep` every `sweep_interval` seconds, in a worker thread.
+        """
+        await asyncio.to_thread(self.load_index)
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            await asyncio.to_thread(self.sweep)
+
+    def stats(self) -> dict:
+        with self._lock:
+            by_kind = {kind: {"requests": 0, "bytes": 0} for kind in KIND_DIRS}
+            for entry in self._index.values():
+                by_kind[entry["kind"]]["requests"] += 1
+                by_kind[entry["kind"]]["bytes"] += entry["bytes"]
+            return {
+                "root": self.root,
+                "bytes": sum(k["bytes"] for k in by_kind.values()),
+                "quota_bytes": self.quota_bytes or None,
+                "ttl_seconds": self.ttl_seconds or None,
+                "evicted_requests": self.evicted_requests,
+                "kinds": by_kind,
+            }
+
+
+output_store = OutputStore(OUTPUT_ROOT, OUTPUT_TTL_SECONDS, OUTPUT_QUOTA_BYTES, OUTPUT_SWEEP_INTERVAL_SECONDS)
@@ -0,0 +1,256 @@
+"""
+On-demand profiling of individual requests.
+
+With `PROFILING_ENABLED`, a request carrying `X-Profile: 1` (or the query
+parameter `profile_request=1`) opens a profiling session. The blocking service
+calls made on the request's behalf are run under cProfile wherever they
+execute: worker threads, CPU pool processes (which send their stats back) and
+the inference thread. A detection batch that contains the request's images is
+also run under the torch profiler when `PROFILING_TORCH` is on. When the
+response has been sent, the merged profile is stored in the output store
+(kind "profiles"), where `/api/v1/profiles/{request_id}` serves it. Only one
+cProfile can be active per process, so profiled calls run one at a time.
+"""
+
+import asyncio
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import tempfile
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+from fastapi import Request
+
+from app.core.config import PROFILING_ENABLED, PROFILING_TORCH
+from app.core.request_context import get_request_id
+from app.services.output_store import output_store
+
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_QUERY = "profile_request"
+PROFILE_ID_PREFIX = "profile_"
+
+# Rows of the text summaries
+TOP_FUNCTIONS = 60
+TOP_TORCH_OPS = 40
+
+_session_var: ContextVar[Optional["ProfileSession"]] = ContextVar("profile_session", default=None)
+_profile_lock = threading.Lock()
+
+
+def profile_id(request_id: str) -> str:
+    """Returns the output store id of a request's profile."""
+    return f"{PROFILE_ID_PREFIX}{request_id}"
+
+
+class _RawStats:
+    """Adapts a collected stats dict to what `pstats.Stats` loads."""
+
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def profile_call(fn: Callable[..., Any], *args) -> Tuple[Any, dict]:
+    """
+    Runs `fn(*args)` under cProfile, for pool processes whose profiles must travel back to the parent.
+
+    Returns:
+        Tuple[Any, dict]: The return value of `fn` and the collected stats, which are picklable.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        result = fn(*args)
+    finally:
+        profiler.disable()
+    profiler.create_stats()
+    return result, profiler.stats
+
+
+class ProfileSession:
+    """
+    The profile of one request, assembled from every profiled call made on its behalf.
+
+    Args:
+        request_id (str): The id of the profiled request.
+        method (str): The HTTP method.
+        path (str): The request path.
+        torch_enabled (bool): Whether detection batches are also run under the torch profiler.
+    """
+
+    def __init__(self, request_id: str, method: str, path: str, torch_enabled: bool):
+        self.request_id = request_id
+        self.store_id = profile_id(request_id)
+        self.method = method
+        self.path = path
+        self.torch_enabled = torch_enabled
+        self.started = time.perf_counter()
+        self.segments: List[dict] = []
+        self._stats: List[dict] = []
+        self._torch_traces = 0
+        self._lock = threading.Lock()
+
+    def add_stats(self, name: str, seconds: float, stats: dict, where: str = None):
+        """Adds the cProfile stats of one call; `where` names the thread or pool it ran in."""
+        with self._lock:
+            self.segments.append({"name": name, "seconds": round(seconds, 6), "where": where or threading.current_thread().name})
+            self._stats.append(stats)
+
+    def run(self, name: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Runs one blocking call under cProfile and adds it to the profile."""
+        return run_profiled([self], name, fn, *args, **kwargs)
+
+    def save_torch(self, name: str, table: str, trace_path: str):
+        with self._lock:
+            self._torch_traces += 1
+            index = self._torch_traces
+        output_store.save_bytes("profiles", self.store_id, f"torch_ops_{index}_{name}.txt", table.encode("utf-8"))
+        with open(trace_path, "rb") as trace:
+            output_store.save_bytes("profiles", self.store_id, f"torch_trace_{index}_{name}.json", trace.read())
+
+    def finish(self, status_code: int):
+        """Merges the collected stats and writes the profile artifacts to the output store."""
+        summary = {
+            "request_id": self.request_id,
+            "method": self.method,
+            "path": self.path,
+            "status_code": status_code,
+            "wall_seconds": round(time.perf_counter() - self.started, 6),
+            "segments": self.segments,
+        }
+        output_store.mark_active(self.store_id)
+        try:
+            if self._stats:
+                # Stats shared with other sessions of the same batch are copied, since merging updates them
+                merged = pstats.Stats(_RawStats(dict(self._stats[0])))
+                for stats in self._stats[1:]:
+                    merged.add(_RawStats(stats))
+                directory = output_store.request_dir("profiles", self.store_id)
+                merged.dump_stats(os.path.join(directory, "cpu.pstats"))
+                output_store.record("profiles", self.store_id, os.path.join(directory, "cpu.pstats"))
+
+                text = io.StringIO()
+                merged.stream = text
+                merged.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+                output_store.save_bytes("profiles", self.store_id, "cpu.txt", text.getvalue().encode("utf-8"))
+            output_store.save_bytes("profiles", self.store_id, "summary.json", json.dumps(summary, indent=2).encode("utf-8"))
+        finally:
+            output_store.mark_done(self.store_id)
+
+
+def current_session() -> Optional[ProfileSession]:
+    """Returns the profiling session of the current request, if it is being profiled."""
+    return _session_var.get()
+
+
+def profiled(fn: Callable[..., Any], name: str = None) -> Callable[..., Any]:
+    """
+    Binds `fn` to the current request's profiling session, so it is profiled on whichever thread it later runs.
+
+    Returns `fn` itself when the request is not being profiled.
+    """
+    session = current_session()
+    if session is None:
+        return fn
+    return functools.partial(session.run, name or fn.__name__.lstrip("_"), fn)
+
+
+def run_profiled(sessions: Iterable[ProfileSession], name: str, fn: Callable[..., Any], *args, use_torch: bool = False, **kwargs) -> Any:
+    """
+    Runs one blocking call and adds its profile to every given session, e.g. all requests sharing a detection batch.
+
+    Args:
+        sessions (Iterable[ProfileSession]): The sessions to add the profile to; with none, `fn` just runs.
+        name (str): The segment name.
+        fn (Callable[..., Any]): The blocking callable.
+        use_torch (bool): Whether to also run the torch profiler when a session asks for it.
+    """
+    sessions = list(sessions)
+    if not sessions:
+        return fn(*args, **kwargs)
+
+    with _profile_lock:
+        torch_profiler = None
+        if use_torch and any(session.torch_enabled for session in sessions):
+            torch_profiler = _start_torch_profiler()
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.disable()
+            seconds = time.perf_counter() - start
+            profiler.create_stats()
+            for session in sessions:
+                session.add_stats(name, seconds, profiler.stats)
+            if torch_profiler is not None:
+                _save_torch_profile(torch_profiler, [s for s in sessions if s.torch_enabled], name)
+
+
+def _start_torch_profiler():
+    import torch
+    from torch.profiler import ProfilerActivity, profile
+
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    torch_profiler = profile(activities=activities, record_shapes=True)
+    torch_profiler.__enter__()
+    return torch_profiler
+
+
+def _save_torch_profile(torch_profiler, sessions: List[ProfileSession], name: str):
+    torch_profiler.__exit__(None, None, None)
+    table = torch_profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=TOP_TORCH_OPS)
+    with tempfile.TemporaryDirectory() as directory:
+        trace_path = os.path.join(directory, "trace.json")
+        torch_profiler.export_chrome_trace(trace_path)
+        for session in sessions:
+            session.save_torch(name, table, trace_path)
+
+
+def _wants_profile(request: Request) -> bool:
+    flag = request.headers.get(PROFILE_HEADER) or request.query_params.get(PROFILE_QUERY) or ""
+    return flag.strip().lower() in ("1", "true", "yes", "on")
+
+
+async def request_profiling_middleware(request: Request, call_next):
+    """
+    Opens a profiling session for flagged requests and stores the profile once the response body has been sent.
+
+    The profile id is returned in the `X-Profile-ID` response header.
+    """
+    if not PROFILING_ENABLED or not _wants_profile(request):
+        return await call_next(request)
+
+    request_id = get_request_id()
+    session = ProfileSession(request_id, request.method, request.url.path, PROFILING_TORCH)
+    token = _session_var.set(session)
+    try:
+        response = await call_next(request)
+    finally:
+        _session_var.reset(token)
+
+    body_iterator = response.body_iterator
+
+    async def body_then_finish():
+        # Streamed bodies are still being produced here, so the profile is only complete once they end
+        try:
+            async for chunk in body_iterator:
+                yield chunk
+        finally:
+            await asyncio.to_thread(session.finish, response.status_code)
+
+    response.body_iterator = body_then_finish()
+    response.headers["X-Profile-ID"] = request_id
+    return response
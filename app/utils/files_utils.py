@@ -0,0 +1,126 @@
+import os
+import re
+import zipfile
+from io import RawIOBase
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, Tuple, Union
+
+
+# Formats that are already compressed; deflating them again only burns CPU
+STORED_EXTENSIONS = {
+    ".png", ".jpg", ".jpeg", ".webp", ".gif", ".heic", ".avif",
+    ".zip", ".gz", ".bz2", ".xz", ".7z", ".parquet", ".xlsx",
+}
+
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+_SAFE_ID = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+def is_safe_id(value: str) -> bool:
+    """
+    Returns whether `value` is usable as a single path component (request and job ids).
+    """
+    return bool(_SAFE_ID.fullmatch(value or ""))
+
+
+class _ChunkSink(RawIOBase):
+    """
+    Non-seekable sink that buffers what zipfile writes until the generator drains it.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ZipStreamWriter:
+    """
+    Incremental ZIP writer whose output is drained chunk by chunk.
+
+    Because the output is not seekable, zipfile writes data descriptors after each
+    member and only one chunk of one member is held in memory at a time.
+    Already-compressed formats are stored, everything else is deflated.
+    """
+
+    def __init__(self):
+        self._sink = _ChunkSink()
+        self._zip_file = zipfile.ZipFile(self._sink, "w")
+
+    @staticmethod
+    def _compress_type(arcname: str) -> int:
+        stored = os.path.splitext(arcname)[1].lower() in STORED_EXTENSIONS
+        return zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+
+    def _drain(self) -> Iterator[bytes]:
+        data = self._sink.drain()
+        if data:
+            yield data
+
+    def add(self, arcname: str, source: Union[str, bytes]) -> Iterator[bytes]:
+        """
+        Adds one member from a file path or in-memory content and yields the archive bytes it produced.
+        """
+        if isinstance(source, (bytes, bytearray)):
+            info = zipfile.ZipInfo(arcname)
+            info.external_attr = 0o644 << 16
+            info.compress_type = self._compress_type(arcname)
+            info.file_size = len(source)
+            with self._zip_file.open(info, "w") as member:
+                member.write(source)
+        else:
+            info = zipfile.ZipInfo.from_file(source, arcname)
+            info.compress_type = self._compress_type(arcname)
+            with open(source, "rb") as src, self._zip_file.open(info, "w") as member:
+                while True:
+                    chunk = src.read(ZIP_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    member.write(chunk)
+                    yield from self._drain()
+        yield from self._drain()
+
+    def close(self) -> Iterator[bytes]:
+        """
+        Writes the central directory and yields the final archive bytes.
+        """
+        self._zip_file.close()
+        yield from self._drain()
+
+
+def iter_zip(entries: Iterable[Tuple[str, Union[str, bytes]]]) -> Iterator[bytes]:
+    """
+    Generates a ZIP archive chunk by chunk while it is being sent.
+
+    Args:
+        entries (Iterable[Tuple[str, Union[str, bytes]]]): (archive name, file path or in-memory content) pairs.
+
+    Yields:
+        bytes: Consecutive chunks of the archive.
+    """
+    writer = ZipStreamWriter()
+    for arcname, source in entries:
+        yield from writer.add(arcname, source)
+    yield from writer.close()
+
+
+async def aiter_zip(entries: AsyncIterable[Tuple[str, bytes]]) -> AsyncIterator[bytes]:
+    """
+    Like `iter_zip`, for in-memory entries that are produced asynchronously.
+    """
+    writer = ZipStreamWriter()
+    async for arcname, data in entries:
+        for chunk in writer.add(arcname, data):
+            yield chunk
+    for chunk in writer.close():
+        yield chunk
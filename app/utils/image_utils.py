@@ -0,0 +1,97 @@
+"""
+Decode-time downscaling.
+
+JPEG can be decoded directly at 1/2, 1/4 or 1/8 scale by skipping DCT
+coefficients, which is several times faster than a full decode and never
+allocates the full-resolution buffer. These helpers pick the largest such
+reduction that still leaves the decoded image at least as large as the size
+the caller is going to shrink it to.
+"""
+
+from io import BytesIO
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from app.core.config import REDUCED_DECODE_ENABLED
+
+
+# Scale factor -> OpenCV flag that decodes at 1/factor of the full size
+_REDUCED_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
+
+# EXIF orientations that swap width and height when applied
+_TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def jpeg_size(contents: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Returns the displayed (width, height) of a JPEG from its header alone, or None for any other format.
+    """
+    try:
+        with Image.open(BytesIO(contents)) as image:
+            if image.format != "JPEG":
+                return None
+            width, height = image.size
+            if image.getexif().get(0x0112) in _TRANSPOSED_ORIENTATIONS:
+                width, height = height, width
+            return width, height
+    except Exception:
+        return None
+
+
+def reduction_factor(size: Tuple[int, int], target_size: Tuple[int, int]) -> int:
+    """
+    Returns the largest of 8, 4 and 2 that keeps `size` at least `target_size` in both dimensions, or 1.
+    """
+    for factor in _REDUCED_FLAGS:
+        if size[0] // factor >= target_size[0] and size[1] // factor >= target_size[1]:
+            return factor
+    return 1
+
+
+def decode_reduced(contents: bytes, target_size: Optional[Tuple[int, int]] = None) -> np.ndarray:
+    """
+    Decodes an image to a BGR array, at reduced resolution when it is a JPEG larger than needed.
+
+    Args:
+        contents (bytes): The encoded image.
+        target_size (Optional[Tuple[int, int]]): The (width, height) the image will be resized to; None decodes at full size.
+
+    Returns:
+        np.ndarray: The decoded image, never smaller than `target_size` unless the original is.
+
+    Raises:
+        ValueError: If the image cannot be decoded.
+    """
+    flag = cv2.IMREAD_COLOR
+    if REDUCED_DECODE_ENABLED and target_size:
+        size = jpeg_size(contents)
+        if size is not None:
+            flag = _REDUCED_FLAGS.get(reduction_factor(size, target_size), cv2.IMREAD_COLOR)
+    img = cv2.imdecode(np.frombuffer(contents, np.uint8), flag)
+    if img is None:
+        raise ValueError("Could not decode image")
+    return img
+
+
+def open_reduced(contents: bytes, target_size: Tuple[int, int]) -> Tuple[Image.Image, Tuple[int, int]]:
+    """
+    Opens an image with PIL, asking the JPEG decoder for the smallest scale that still covers `target_size`.
+
+    Returns:
+        Tuple[Image.Image, Tuple[int, int]]: The decoded image and the (width, height) of the original,
+        which coordinates computed on the reduced image must be mapped back to.
+    """
+    image = Image.open(BytesIO(contents))
+    original_size = image.size
+    if REDUCED_DECODE_ENABLED:
+        # draft() only ever picks a scale whose result is at least the requested size, and is a no-op for other formats
+        image.draft("RGB", target_size)
+    image.load()
+    return image, original_size
@@ -0,0 +1,116 @@
+import json
+import mimetypes
+from typing import AsyncIterable, AsyncIterator, Tuple, Union
+from uuid import uuid4
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from app.utils.files_utils import aiter_zip
+
+
+# How processed images are returned: saved to the output store ("files"), or
+# encoded straight into the response body ("multipart" or "zip")
+RESPONSE_MODES = ("files", "multipart", "zip")
+
+# How streamed results are framed: one JSON object per line, or Server-Sent Events
+STREAM_FORMATS = ("ndjson", "sse")
+
+
+def validate_response_mode(response_mode: str):
+    if response_mode not in RESPONSE_MODES:
+        raise HTTPException(status_code=400, detail=f"response_mode must be one of: {', '.join(RESPONSE_MODES)}")
+
+
+def validate_stream_format(stream_format: str):
+    if stream_format not in STREAM_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(STREAM_FORMATS)}")
+
+
+async def _with_errors_entry(results: AsyncIterable[Tuple[str, Union[bytes, Exception]]]) -> AsyncIterator[Tuple[str, bytes]]:
+    # Passes successful results through and reports failed ones in a trailing errors.json entry
+    errors = []
+    async for filename, result in results:
+        if isinstance(result, Exception):
+            errors.append({"filename": filename, "error": str(result)})
+        else:
+            yield filename, result
+    if errors:
+        yield "errors.json", json.dumps(errors).encode("utf-8")
+
+
+async def aiter_multipart(results: AsyncIterable[Tuple[str, Union[bytes, Exception]]], boundary: str) -> AsyncIterator[bytes]:
+    """
+    Streams results as a multipart/mixed body, one part per image as soon as it is ready.
+
+    Failed images are reported in a final application/json part.
+    """
+    async for filename, data in _with_errors_entry(results):
+        content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Disposition: attachment; filename=\"{filename}\"\r\n"
+            f"Content-Length: {len(data)}\r\n\r\n"
+        ).encode("utf-8")
+        yield data
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode("utf-8")
+
+
+def inline_response(results: AsyncIterable[Tuple[str, Union[bytes, Exception]]], response_mode: str, archive_name: str) -> StreamingResponse:
+    """
+    Builds a response that streams in-memory results without touching the filesystem.
+
+    Args:
+        results (AsyncIterable[Tuple[str, Union[bytes, Exception]]]): (filename, encoded image or the exception that failed it) pairs.
+        response_mode (str): "multipart" for a multipart/mixed body, "zip" for a streamed ZIP archive.
+        archive_name (str): The download name of the ZIP archive, without extension.
+
+    Raises:
+        ValueError: If the response mode is not an inline mode.
+    """
+    if response_mode == "multipart":
+        boundary = uuid4().hex
+        return StreamingResponse(aiter_multipart(results, boundary), media_type=f"multipart/mixed; boundary={boundary}")
+    if response_mode == "zip":
+        return StreamingResponse(
+            aiter_zip(_with_errors_entry(results)),
+            media_type="application/zip",
+            headers={"Content-Disposition": f"attachment; filename={archive_name}.zip"}
+        )
+    raise ValueError(f"response_mode must be one of: {', '.join(RESPONSE_MODES)}")
+
+
+async def aiter_ndjson(events: AsyncIterable[Tuple[str, dict]]) -> AsyncIterator[bytes]:
+    """
+    Streams events as newline-delimited JSON, one object per event with its name under "event".
+    """
+    async for event, payload in events:
+        yield (json.dumps({"event": event, **payload}) + "\n").encode("utf-8")
+
+
+async def aiter_sse(events: AsyncIterable[Tuple[str, dict]]) -> AsyncIterator[bytes]:
+    """
+    Streams events as Server-Sent Events, with the payload as JSON data.
+    """
+    async for event, payload in events:
+        yield f"event: {event}\ndata: {json.dumps(payload)}\n\n".encode("utf-8")
+
+
+def stream_response(events: AsyncIterable[Tuple[str, dict]], stream_format: str) -> StreamingResponse:
+    """
+    Builds a response that sends each (event name, payload) pair as soon as it is produced.
+
+    Args:
+        events (AsyncIterable[Tuple[str, dict]]): The events, in the order they are sent.
+        stream_format (str): "ndjson" for application/x-ndjson, "sse" for text/event-stream.
+
+    Raises:
+        ValueError: If the stream format is unknown.
+    """
+    # Keeps proxies from buffering the stream, which would hold every event back until the end
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    if stream_format == "ndjson":
+        return StreamingResponse(aiter_ndjson(events), media_type="application/x-ndjson", headers=headers)
+    if stream_format == "sse":
+        return StreamingResponse(aiter_sse(events), media_type="text/event-stream", headers=headers)
+    raise ValueError(f"format must be one of: {', '.join(STREAM_FORMATS)}")
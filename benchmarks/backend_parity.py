@@ -0,0 +1,196 @@
+"""
+Parity check of the inference backends against eager `generate`.
+
+Runs `<OD>` on a fixture set of synthetic images with every backend and
+compares the generated token ids and the parsed boxes with those of the eager
+backend. By default the model is a small, randomly initialised Florence-2
+built from the configuration of `--model-id` with a fixed seed, so no weights
+are downloaded and the check runs offline once the model's configuration, code
+and tokenizer are in the Hugging Face cache (or `--model-id` is a local copy).
+`--pretrained` checks the real weights instead.
+
+    python -m benchmarks.backend_parity
+    python -m benchmarks.backend_parity --backends onnx --num-beams 3 --output parity.json
+
+Exits with status 1 when a backend's exact token match rate or its lowest box
+agreement falls below the thresholds.
+"""
+
+import argparse
+import copy
+import io
+import json
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from benchmarks.run import _parse_ints, _parse_resolution, synthetic_image
+
+
+# Small enough to build and export in seconds, with every layer type of the real model
+TINY_TEXT_CONFIG = {
+    "d_model": 64,
+    "encoder_layers": 2,
+    "decoder_layers": 2,
+    "encoder_attention_heads": 4,
+    "decoder_attention_heads": 4,
+    "encoder_ffn_dim": 128,
+    "decoder_ffn_dim": 128,
+}
+TINY_VISION_CONFIG = {
+    "dim_embed": [32, 64, 96, 128],
+    "num_heads": [2, 4, 6, 8],
+    "num_groups": [2, 4, 6, 8],
+    "depths": [1, 1, 1, 1],
+    "projection_dim": 64,
+}
+
+
+def tiny_random_model(model_id: str, seed: int, init_std: float):
+    """
+    Builds a randomly initialised Florence-2 with the architecture of `model_id` shrunk to `TINY_*_CONFIG`.
+
+    A larger `init_std` than the model's own spreads the logits, so near-ties between tokens, which float
+    differences between backends could break either way, are rare.
+    """
+    import torch
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    config = AutoConfig.from_pretrained(model_id, trust_remote_code=True)
+    for name, value in TINY_TEXT_CONFIG.items():
+        setattr(config.text_config, name, value)
+    config.text_config.init_std = init_std
+    for name, value in TINY_VISION_CONFIG.items():
+        setattr(config.vision_config, name, value)
+    config.projection_dim = TINY_TEXT_CONFIG["d_model"]
+
+    torch.manual_seed(seed)
+    return AutoModelForCausalLM.from_config(config, trust_remote_code=True).float().eval()
+
+
+def _fixtures(resolutions: List[str], count: int, seed: int):
+    from PIL import Image
+
+    fixtures = []
+    for resolution in resolutions:
+        width, height = _parse_resolution(resolution)
+        for i in range(count):
+            image = Image.open(io.BytesIO(synthetic_image(width, height, seed + i))).convert("RGB")
+            fixtures.append((f"{resolution}#{i}", image))
+    return fixtures
+
+
+def _strip(sequence, pad_token_id) -> List[int]:
+    tokens = [int(token) for token in sequence]
+    while tokens and tokens[-1] == pad_token_id:
+        tokens.pop()
+    return tokens
+
+
+def _run_backend(backend, model, processor, fixtures, generate_kwargs: dict) -> Dict[str, dict]:
+    import torch
+
+    results = {}
+    for name, image in fixtures:
+        inputs = processor(text="<OD>", images=image, return_tensors="pt")
+        start = time.perf_counter()
+        with torch.inference_mode():
+            generated_ids = backend.generate(model, inputs["input_ids"], inputs["pixel_values"].float(), **generate_kwargs)
+        seconds = time.perf_counter() - start
+        text = processor.batch_decode(generated_ids, skip_special_tokens=False)[0]
+        results[name] = {
+            "tokens": _strip(generated_ids[0], processor.tokenizer.pad_token_id),
+            "answer": processor.post_process_generation(text, task="<OD>", image_size=image.size),
+            "seconds": seconds,
+        }
+    return results
+
+
+def compare(reference: Dict[str, dict], candidate: Dict[str, dict]) -> dict:
+    """Summarises how a backend's results agree with the eager reference."""
+    from app.services.generation_profiles import detection_agreement
+
+    agreements = [detection_agreement(reference[name]["answer"], candidate[name]["answer"]) for name in reference]
+    mismatched = [name for name in reference if reference[name]["tokens"] != candidate[name]["tokens"]]
+    return {
+        "cases": len(reference),
+        "token_match_rate": round(1 - len(mismatched) / len(reference), 4),
+        "mismatched": mismatched,
+        "mean_agreement": round(sum(agreements) / len(agreements), 4),
+        "min_agreement": round(min(agreements), 4),
+        "mean_seconds": round(sum(result["seconds"] for result in candidate.values()) / len(candidate), 6),
+    }
+
+
+def _create(name: str, onnx_dir: str):
+    from app.services.inference_backends import CompiledBackend, EagerBackend, OnnxBackend
+
+    if name == "eager":
+        return EagerBackend()
+    if name == "compile":
+        return CompiledBackend()
+    if name == "onnx":
+        return OnnxBackend(onnx_dir)
+    raise ValueError(f"Unknown inference backend '{name}'")
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model-id", default="microsoft/Florence-2-base", help="Model id or local path of the configuration, code and tokenizer")
+    parser.add_argument("--pretrained", action="store_true", help="Load the real weights instead of a small random model")
+    parser.add_argument("--backends", default="compile,onnx", help="Comma-separated backends compared with eager")
+    parser.add_argument("--resolutions", default="320x240,640x480,1280x720", help="Comma-separated WIDTHxHEIGHT list")
+    parser.add_argument("--images", type=int, default=2, help="Fixture images per resolution")
+    parser.add_argument("--num-beams", default="1,3", help="Comma-separated beam counts to check")
+    parser.add_argument("--max-new-tokens", type=int, default=64, help="Tokens generated per image")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random model and the fixtures")
+    parser.add_argument("--init-std", type=float, default=0.2, help="Weight init std of the random model")
+    parser.add_argument("--min-token-match", type=float, default=1.0, help="Lowest accepted rate of exactly matching token ids")
+    parser.add_argument("--min-agreement", type=float, default=1.0, help="Lowest accepted box agreement of any image")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    from transformers import AutoModelForCausalLM, AutoProcessor
+
+    if args.pretrained:
+        model = AutoModelForCausalLM.from_pretrained(args.model_id, trust_remote_code=True).float().eval()
+    else:
+        model = tiny_random_model(args.model_id, args.seed, args.init_std)
+    processor = AutoProcessor.from_pretrained(args.model_id, trust_remote_code=True)
+    fixtures = _fixtures(args.resolutions.split(","), args.images, args.seed)
+    backends = [name.strip() for name in args.backends.split(",") if name.strip() and name.strip() != "eager"]
+
+    report = {"model_id": args.model_id, "pretrained": args.pretrained, "fixtures": len(fixtures), "runs": []}
+    failed = False
+    with tempfile.TemporaryDirectory(prefix="parity_onnx_") as onnx_dir:
+        for num_beams in _parse_ints(args.num_beams):
+            generate_kwargs = {"max_new_tokens": args.max_new_tokens, "do_sample": False, "num_beams": num_beams}
+            reference = _run_backend(_create("eager", onnx_dir), model, processor, fixtures, generate_kwargs)
+            run = {"num_beams": num_beams, "eager_mean_seconds": round(
+                sum(result["seconds"] for result in reference.values()) / len(reference), 6
+            ), "backends": {}}
+            for name in backends:
+                # Compiling rebinds methods on the model, so each backend gets a copy of its own
+                results = _run_backend(_create(name, onnx_dir), copy.deepcopy(model), processor, fixtures, generate_kwargs)
+                summary = run["backends"][name] = compare(reference, results)
+                if summary["token_match_rate"] < args.min_token_match or summary["min_agreement"] < args.min_agreement:
+                    failed = True
+                    print(
+                        f"PARITY {name} num_beams={num_beams}: token match {summary['token_match_rate']:.2%}, "
+                        f"min agreement {summary['min_agreement']:.2f}",
+                        file=sys.stderr
+                    )
+            report["runs"].append(run)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
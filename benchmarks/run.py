@@ -0,0 +1,357 @@
+"""
+Reproducible performance benchmark of the HTTP API.
+
+Drives the bounding box, image processing and augmentation routers of
+`app.main` in-process with synthetic images of several resolutions and batch
+sizes, and reports per-scenario p50/p95 latency, images per second and peak
+RSS of the server process as JSON. Unless `--real-model` is given, detection
+runs on the stub model in `benchmarks/stub_model.py`, so the suite runs
+offline on CPU. Outputs and caches go to a temporary directory.
+
+    python -m benchmarks.run --output bench.json
+    python -m benchmarks.run --endpoints boxes. --resolutions 640x480 --batch-sizes 1,8
+    python -m benchmarks.run --output new.json --compare bench.json
+
+With `--compare`, each scenario is checked against a previous report and the
+command exits with status 1 when p95 latency or throughput regressed by more
+than `--threshold`.
+"""
+
+import argparse
+import asyncio
+import fnmatch
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+REPORT_SCHEMA = 1
+
+# name -> (path, upload field, query parameters, form fields)
+SCENARIOS: Dict[str, Tuple[str, str, dict, dict]] = {
+    "boxes.generate": ("/api/v1/boxes/generate", "files", {}, {}),
+    "boxes.stream": ("/api/v1/boxes/generate/stream", "files", {"format": "ndjson"}, {}),
+    "boxes.tasks": ("/api/v1/boxes/tasks", "files", {"tasks": ["<OD>", "<CAPTION>", "<DENSE_REGION_CAPTION>"]}, {}),
+    "image_process.resize": ("/api/v1/image-process/resize", "images", {"width": 256, "height": 256}, {}),
+    "image_process.normalize": ("/api/v1/image-process/normalize", "images", {}, {}),
+    "image_process.crop": ("/api/v1/image-process/crop", "images", {"x": 16, "y": 16, "width": 128, "height": 128}, {}),
+    "image_process.rotate_flip": ("/api/v1/image-process/rotate-flip", "images", {"rotate_angle": 15, "flip_code": 1}, {}),
+    "image_process.color_adjust": ("/api/v1/image-process/color-adjust", "images", {"brightness": 10, "contrast": 10, "saturation": 10}, {}),
+    "image_process.noise_reduction": ("/api/v1/image-process/noise-reduction", "images", {}, {}),
+    "image_process.background_removal": ("/api/v1/image-process/background-removal", "images", {}, {}),
+    "augment.pipeline": ("/api/v1/augment/pipeline/", "files", {}, {
+        "operations": json.dumps([{"op": "rotate", "angle": 10}, {"op": "brightness", "factor": 1.2}, {"op": "blur", "radius": 1.5}])
+    }),
+    "augment.default": ("/api/v1/augment/default_augment/", "files", {}, {"rotate": "10", "flip_horizontal": "true", "contrast": "1.2"}),
+    "augment.variants": ("/api/v1/augment/variants/", "files", {}, {
+        "count": "4", "seed": "0", "ranges": json.dumps({"rotate": [-15, 15], "brightness": [0.8, 1.2], "flip_horizontal": 0.5})
+    }),
+}
+
+
+def _parse_resolution(value: str) -> Tuple[int, int]:
+    width, _, height = value.lower().partition("x")
+    return int(width), int(height)
+
+
+def _parse_ints(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def synthetic_image(width: int, height: int, seed: int) -> bytes:
+    """
+    Returns a deterministic JPEG with gradients, rectangles and noise, so it compresses and decodes like a photo.
+    """
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    img = np.empty((height, width, 3), np.uint8)
+    img[..., 0] = x * 0.6 + y * 0.4
+    img[..., 1] = 255 - x * 0.5
+    img[..., 2] = y * 0.8
+    for _ in range(8):
+        x1, x2 = sorted(rng.integers(0, width, 2))
+        y1, y2 = sorted(rng.integers(0, height, 2))
+        cv2.rectangle(img, (int(x1), int(y1)), (int(x2), int(y2)), tuple(int(c) for c in rng.integers(0, 256, 3)), -1)
+    noise = rng.normal(0, 8, img.shape).astype(np.int16)
+    img = np.clip(img.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+    ok, buffer = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if not ok:
+        raise RuntimeError("Could not encode synthetic image")
+    return buffer.tobytes()
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """Nearest-rank percentile; None for an empty list."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _current_rss() -> Optional[int]:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class RssSampler:
+    """
+    Samples the resident set size of this process on a background thread and tracks its peak since the last reset.
+
+    Falls back to the lifetime peak from `getrusage` where /proc is unavailable.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self._peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = _current_rss()
+            if rss is not None:
+                self._peak = max(self._peak, rss)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def reset(self):
+        self._peak = _current_rss() or 0
+
+    @property
+    def peak(self) -> int:
+        if self._peak:
+            return self._peak
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _failures(response) -> int:
+    # A stream answers 200 before any image is detected, so its per-image failures only show up as "error" events;
+    # a stream without its final "done" event was cut short
+    if response.status_code >= 400:
+        return 1
+    if not response.headers.get("content-type", "").startswith("application/x-ndjson"):
+        return 0
+    events = [json.loads(line).get("event") for line in response.text.splitlines() if line.strip()]
+    return events.count("error") + (0 if "done" in events else 1)
+
+
+async def _request(client, path: str, field: str, params: dict, data: dict, images: List[bytes]) -> Tuple[float, int]:
+    """Sends one request and returns its latency and number of failures: 1 for an error status, or per failed image of a stream."""
+    files = [(field, (f"bench_{index}.jpg", contents, "image/jpeg")) for index, contents in enumerate(images)]
+    start = time.perf_counter()
+    response = await client.post(path, params=params, data=data, files=files)
+    await response.aread()
+    return time.perf_counter() - start, _failures(response)
+
+
+async def run_scenario(client, sampler: RssSampler, name: str, images: List[bytes], iterations: int,
+                       concurrency: int, warmup: int) -> dict:
+    """
+    Sends `warmup` unrecorded requests, then `iterations` requests with at most `concurrency` in flight.
+
+    Returns:
+        dict: Latency percentiles in milliseconds, throughput, error count and peak RSS for the scenario.
+    """
+    path, field, params, data = SCENARIOS[name]
+    for _ in range(warmup):
+        await _request(client, path, field, params, data, images)
+
+    sampler.reset()
+    slots = asyncio.Semaphore(max(1, concurrency))
+    latencies, errors = [], []
+
+    async def one():
+        async with slots:
+            seconds, failures = await _request(client, path, field, params, data, images)
+        latencies.append(seconds)
+        if failures:
+            errors.append(failures)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(iterations)))
+    wall = time.perf_counter() - start
+
+    return {
+        "requests": iterations,
+        "errors": sum(errors),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "images_per_second": round(iterations * len(images) / wall, 3) if wall > 0 else None,
+        "peak_rss_mb": round(sampler.peak / 1024 ** 2, 1),
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _configure_environment(args, output_root: str):
+    # Must run before anything under `app` is imported, since app.core.config reads the environment at import time
+    if not args.real_model:
+        os.environ["FLORENCE_MODEL_LOADER"] = "benchmarks.stub_model:loader"
+        os.environ["FLORENCE_MODEL_ID"] = "stub-florence"
+    os.environ["OUTPUT_ROOT"] = output_root
+    os.environ["DETECTION_CACHE_ENABLED"] = "true" if args.cache else "false"
+    os.environ["DETECTION_CACHE_DIR"] = os.path.join(output_root, "cache") if args.cache else ""
+    os.environ["MODEL_WARMUP_ON_STARTUP"] = "false"
+
+
+async def run(args) -> dict:
+    import httpx
+    from app.main import app
+
+    selected = [
+        name for name in SCENARIOS
+        if not args.endpoints or any(name.startswith(p) or fnmatch.fnmatch(name, p) for p in args.endpoints)
+    ]
+    resolutions = [_parse_resolution(value) for value in args.resolutions.split(",")]
+    batch_sizes = _parse_ints(args.batch_sizes)
+
+    sampler = RssSampler()
+    sampler.start()
+    results = []
+    try:
+        # The app's startup and shutdown hooks run through its ASGI lifespan, as under a server
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+                for width, height in resolutions:
+                    # Distinct images per batch slot, so caches and de-duplication never collapse a batch
+                    pool = [synthetic_image(width, height, args.seed + index) for index in range(max(batch_sizes))]
+                    for batch_size in batch_sizes:
+                        for name in selected:
+                            stats = await run_scenario(
+                                client, sampler, name, pool[:batch_size], args.iterations, args.concurrency, args.warmup
+                            )
+                            result = {"endpoint": name, "resolution": f"{width}x{height}", "batch_size": batch_size, **stats}
+                            results.append(result)
+                            print(
+                                f"{name:36} {width}x{height:<6} batch={batch_size:<3} p50={stats['p50_ms']:>9.1f}ms "
+                                f"p95={stats['p95_ms']:>9.1f}ms {stats['images_per_second']:>8.2f} img/s "
+                                f"rss={stats['peak_rss_mb']:.0f}MB errors={stats['errors']}",
+                                file=sys.stderr
+                            )
+    finally:
+        sampler.stop()
+
+    return {
+        "schema": REPORT_SCHEMA,
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "model": "real" if args.real_model else "stub",
+            "cache": args.cache,
+            "iterations": args.iterations,
+            "concurrency": args.concurrency,
+            "warmup": args.warmup,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[dict]:
+    """
+    Matches scenarios of two reports and lists the ones whose p95 latency rose or throughput fell by more than `threshold`.
+    """
+    def key(result):
+        return result["endpoint"], result["resolution"], result["batch_size"]
+
+    previous = {key(result): result for result in baseline.get("results", [])}
+    regressions = []
+    for result in current["results"]:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        p95_change = result["p95_ms"] / before["p95_ms"] - 1 if before["p95_ms"] else 0.0
+        throughput_change = (
+            result["images_per_second"] / before["images_per_second"] - 1 if before["images_per_second"] else 0.0
+        )
+        if p95_change > threshold or throughput_change < -threshold:
+            regressions.append({
+                "endpoint": result["endpoint"],
+                "resolution": result["resolution"],
+                "batch_size": result["batch_size"],
+                "p95_change": round(p95_change, 4),
+                "throughput_change": round(throughput_change, 4),
+            })
+    return regressions
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--endpoints", nargs="*", help=f"Scenario names, prefixes or globs. Available: {', '.join(SCENARIOS)}")
+    parser.add_argument("--resolutions", default="320x240,1280x720,1920x1080", help="Comma-separated WIDTHxHEIGHT list")
+    parser.add_argument("--batch-sizes", default="1,4", help="Comma-separated images per request")
+    parser.add_argument("--iterations", type=int, default=10, help="Recorded requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=2, help="Requests in flight at once")
+    parser.add_argument("--warmup", type=int, default=1, help="Unrecorded requests per scenario")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic images")
+    parser.add_argument("--cache", action="store_true", help="Keep the detection cache enabled")
+    parser.add_argument("--real-model", action="store_true", help="Use the configured Florence-2 model instead of the stub")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="A previous JSON report to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Relative change counted as a regression")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="bench_outputs_") as output_root:
+        _configure_environment(args, output_root)
+        report = asyncio.run(run(args))
+
+    if args.compare:
+        with open(args.compare) as f:
+            report["regressions"] = compare(json.load(f), report, args.threshold)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    for regression in report.get("regressions", []):
+        print(
+            f"REGRESSION {regression['endpoint']} {regression['resolution']} batch={regression['batch_size']}: "
+            f"p95 {regression['p95_change']:+.1%}, throughput {regression['throughput_change']:+.1%}",
+            file=sys.stderr
+        )
+    return 1 if report.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
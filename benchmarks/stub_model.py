@@ -0,0 +1,180 @@
+"""
+Lightweight stand-in for Florence-2, for running the service offline on CPU.
+
+`loader` plugs into the model manager through
+`FLORENCE_MODEL_LOADER=benchmarks.stub_model:loader`. The processor resizes
+images to the model input size and tokenizes prompts like the real one, the
+model is a small randomly initialised torch module whose `generate` turns a
+pooled view of the image into `<OD>`-style label and location tokens, and
+`post_process_generation` parses those tokens back into boxes. Like the real
+model, it can encode images once and generate from the merged embeddings, so
+the multi-task path runs on it too. Outputs are
+deterministic for a given image, so cache and batching behave as they do in
+production. Real decoding cost is modelled by sleeping in `generate`:
+
+    STUB_MODEL_BATCH_MS   fixed milliseconds per `generate` call (default 20)
+    STUB_MODEL_IMAGE_MS   extra milliseconds per image per beam (default 5)
+    STUB_MODEL_BOXES      boxes produced per image (default 3)
+"""
+
+import os
+import re
+import time
+from typing import List
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+INPUT_SIZE = 768
+LABELS = ["person", "car", "dog", "cat", "bicycle", "chair", "bottle", "tree"]
+
+PAD_ID, BOS_ID, EOS_ID = 0, 1, 2
+LOC_OFFSET = 3
+LOC_BINS = 1000
+LABEL_OFFSET = LOC_OFFSET + LOC_BINS
+PROMPT_OFFSET = LABEL_OFFSET + len(LABELS)
+
+_BOX_PATTERN = re.compile(r"([a-z ]+)((?:<loc_\d+>){4})")
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+class StubInputs(dict):
+    """Processor outputs that move to a device like a transformers `BatchFeature`."""
+
+    def to(self, device, dtype=None):
+        return StubInputs({
+            key: value.to(device, dtype) if dtype is not None and value.is_floating_point() else value.to(device)
+            for key, value in self.items()
+        })
+
+
+class StubProcessor:
+    """
+    Mimics the parts of the Florence-2 processor the service uses.
+    """
+
+    def __init__(self, input_size: int = INPUT_SIZE):
+        self.input_size = input_size
+        self._prompts = {}
+
+    def _prompt_id(self, prompt: str) -> int:
+        return PROMPT_OFFSET + self._prompts.setdefault(prompt, len(self._prompts))
+
+    def __call__(self, text: str, images: Image.Image, return_tensors: str = "pt") -> StubInputs:
+        image = images.convert("RGB").resize((self.input_size, self.input_size), Image.BILINEAR)
+        pixels = np.asarray(image, dtype=np.float32).transpose(2, 0, 1) / 255.0
+        return StubInputs({
+            "input_ids": torch.tensor([[BOS_ID, self._prompt_id(text), EOS_ID]]),
+            "pixel_values": torch.from_numpy(np.ascontiguousarray(pixels))[None],
+        })
+
+    def _token(self, token_id: int) -> str:
+        if token_id == BOS_ID:
+            return "<s>"
+        if token_id == EOS_ID:
+            return "</s>"
+        if LOC_OFFSET <= token_id < LABEL_OFFSET:
+            return f"<loc_{token_id - LOC_OFFSET}>"
+        if LABEL_OFFSET <= token_id < PROMPT_OFFSET:
+            return LABELS[token_id - LABEL_OFFSET]
+        return "<pad>"
+
+    def batch_decode(self, sequences, skip_special_tokens: bool = False) -> List[str]:
+        texts = []
+        for sequence in sequences:
+            tokens = [self._token(int(token_id)) for token_id in sequence]
+            if skip_special_tokens:
+                tokens = [token for token in tokens if token not in ("<s>", "</s>", "<pad>")]
+            texts.append("".join(tokens))
+        return texts
+
+    def post_process_generation(self, text: str, task: str, image_size) -> dict:
+        width, height = image_size
+        bboxes, labels = [], []
+        for label, locations in _BOX_PATTERN.findall(text):
+            x1, y1, x2, y2 = (int(value) for value in re.findall(r"\d+", locations))
+            bboxes.append([
+                (x1 + 0.5) / LOC_BINS * width, (y1 + 0.5) / LOC_BINS * height,
+                (x2 + 0.5) / LOC_BINS * width, (y2 + 0.5) / LOC_BINS * height,
+            ])
+            labels.append(label)
+        return {task: {"bboxes": bboxes, "labels": labels}}
+
+
+class _ZeroEmbedding(torch.nn.Module):
+    """Prompt embeddings; the stub's answers depend on the image only."""
+
+    def __init__(self, dim: int):
+        super().__init__()
+        self.dim = dim
+
+    def forward(self, input_ids: torch.Tensor) -> torch.Tensor:
+        return torch.zeros(*input_ids.shape, self.dim)
+
+
+class StubFlorence(torch.nn.Module):
+    """
+    Tiny randomly initialised detector with a `generate` that emits label and location tokens.
+    """
+
+    def __init__(self, boxes: int = 3, seed: int = 0):
+        super().__init__()
+        self.boxes = boxes
+        generator = torch.Generator().manual_seed(seed)
+        self.encoder = torch.nn.Linear(3 * 8 * 8, 64)
+        self.head = torch.nn.Linear(64, boxes * (4 + len(LABELS)))
+        with torch.no_grad():
+            for layer in (self.encoder, self.head):
+                layer.weight.copy_(torch.randn(layer.weight.shape, generator=generator) * 0.5)
+                layer.bias.zero_()
+        self.embeddings = _ZeroEmbedding(64)
+
+    def _encode_image(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        pooled = torch.nn.functional.adaptive_avg_pool2d(pixel_values.float(), 8).flatten(1)
+        return torch.tanh(self.encoder(pooled - 0.5))[:, None]
+
+    def get_input_embeddings(self) -> torch.nn.Module:
+        return self.embeddings
+
+    def _merge_input_ids_with_image_features(self, image_features: torch.Tensor, inputs_embeds: torch.Tensor):
+        merged = torch.cat([image_features, inputs_embeds.to(image_features.dtype)], dim=1)
+        return merged, torch.ones(merged.shape[:2])
+
+    def generate(self, input_ids: torch.Tensor, pixel_values: torch.Tensor = None, inputs_embeds: torch.Tensor = None,
+                 max_new_tokens: int = 1024, num_beams: int = 1, **kwargs) -> torch.Tensor:
+        # Merged embeddings start with the image features, as `_merge_input_ids_with_image_features` lays them out
+        features = inputs_embeds[:, 0] if inputs_embeds is not None else self._encode_image(pixel_values)[:, 0]
+        batch_size = features.shape[0]
+        time.sleep((_env_float("STUB_MODEL_BATCH_MS", 20) + _env_float("STUB_MODEL_IMAGE_MS", 5) * batch_size * max(1, num_beams)) / 1000.0)
+
+        outputs = self.head(features).float().view(batch_size, self.boxes, -1)
+        corners = torch.sigmoid(outputs[..., :4]) * (LOC_BINS - 1)
+        low = torch.minimum(corners[..., :2], corners[..., 2:])
+        high = torch.maximum(corners[..., :2], corners[..., 2:])
+        locations = torch.cat([low, high], dim=-1).long() + LOC_OFFSET
+        labels = outputs[..., 4:].argmax(dim=-1, keepdim=True) + LABEL_OFFSET
+
+        body = torch.cat([labels, locations], dim=-1).flatten(1)[:, :max(0, max_new_tokens - 2)]
+        bos = torch.full((batch_size, 1), BOS_ID, dtype=torch.long)
+        eos = torch.full((batch_size, 1), EOS_ID, dtype=torch.long)
+        return torch.cat([bos, body, eos], dim=1).to(input_ids.device)
+
+
+class StubLoader:
+    """
+    Model loader for `FLORENCE_MODEL_LOADER`; ignores the model id and never touches the network.
+    """
+
+    def load_model(self, model_id: str, torch_dtype):
+        return StubFlorence(int(_env_float("STUB_MODEL_BOXES", 3))).to(torch_dtype)
+
+    def load_processor(self, model_id: str):
+        return StubProcessor()
+
+
+loader = StubLoader()
@@ -0,0 +1,80 @@
+import asyncio
+
+from app.services.detection_cache import DetectionCache
+
+
+def _key(i: int) -> str:
+    return f"{i:064x}-{'0' * 64}"
+
+
+def test_disk_tier_evicts_least_recently_used(tmp_path):
+    cache = DetectionCache(0, str(tmp_path), max_disk_bytes=1)
+    cache.put(_key(1), {"<OD>": {"bboxes": [], "labels": []}})
+    size = cache.stats()["disk_bytes"]
+    cache.max_disk_bytes = 2 * size
+
+    cache.put(_key(2), {"<OD>": {"bboxes": [], "labels": []}})
+    assert cache.get_disk(_key(1)) is not None
+    cache.put(_key(3), {"<OD>": {"bboxes": [], "labels": []}})
+
+    assert cache.get_disk(_key(2)) is None
+    assert cache.get_disk(_key(1)) is not None
+    assert cache.stats()["disk_bytes"] <= cache.max_disk_bytes
+
+
+def test_disk_index_survives_restart(tmp_path):
+    DetectionCache(0, str(tmp_path)).put(_key(1), {"answer": 1})
+
+    stats = DetectionCache(0, str(tmp_path)).stats()
+
+    assert stats["disk_entries"] == 1
+    assert stats["disk_bytes"] > 0
+
+
+def test_concurrent_misses_compute_once(tmp_path):
+    cache = DetectionCache(8, str(tmp_path))
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"answer": 1}
+
+    async def main():
+        return await asyncio.gather(*(cache.get_or_compute(_key(1), compute) for _ in range(5)))
+
+    results = asyncio.run(main())
+
+    assert len(calls) == 1
+    assert [value for value, _ in results] == [{"answer": 1}] * 5
+    assert sum(inferred for _, inferred in results) == 1
+    assert cache.stats()["coalesced"] == 4
+
+
+def test_cancelled_caller_does_not_cancel_shared_computation(tmp_path):
+    cache = DetectionCache(8, str(tmp_path))
+
+    async def compute():
+        await asyncio.sleep(0.01)
+        return {"answer": 1}
+
+    async def main():
+        first = asyncio.ensure_future(cache.get_or_compute(_key(1), compute))
+        second = asyncio.ensure_future(cache.get_or_compute(_key(1), compute))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main()) == ({"answer": 1}, False)
+
+
+def test_invalidate_leaves_writes_in_progress_alone(tmp_path):
+    cache = DetectionCache(0, str(tmp_path))
+    cache.put(_key(1), {"answer": 1})
+    path = cache._disk_path(_key(1))
+    with open(f"{path}.123.tmp", "w", encoding="utf-8") as f:
+        f.write("{}")
+
+    assert cache.invalidate() == 1
+    assert cache.get_disk(_key(1)) is None
+    assert (tmp_path / _key(1)[:2] / f"{_key(1)}.json.123.tmp").exists()
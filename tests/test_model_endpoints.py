@@ -0,0 +1,38 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api.endpoints import model
+
+
+class _InlineWorker:
+    # Runs the job on the calling thread instead of the inference worker's
+    async def run(self, fn, *args):
+        return fn(*args)
+
+
+def _client(monkeypatch, warmup_backend):
+    monkeypatch.setattr(model, "warmup_backend", warmup_backend)
+    monkeypatch.setattr(model, "inference_worker", _InlineWorker())
+    app = FastAPI()
+    app.include_router(model.router, prefix="/api/v1/model")
+    return TestClient(app)
+
+
+def test_warmup_runs_backend_warmup(monkeypatch):
+    calls = []
+    client = _client(monkeypatch, lambda: calls.append("warmup"))
+
+    response = client.post("/api/v1/model/warmup")
+
+    assert response.status_code == 200
+    assert calls == ["warmup"]
+
+
+def test_warmup_reports_backend_failure(monkeypatch):
+    def fail():
+        raise RuntimeError("out of memory")
+
+    response = _client(monkeypatch, fail).post("/api/v1/model/warmup")
+
+    assert response.status_code == 500
+    assert response.json()["detail"] == "out of memory"
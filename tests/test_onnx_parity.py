@@ -0,0 +1,77 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+transformers = pytest.importorskip("transformers")
+
+from app.services.onnx_florence import OnnxFlorence, export_onnx
+
+
+IMAGE_SIZE = 32
+PROMPT = [0, 100, 101, 102, 2]
+
+
+class TinyFlorence(torch.nn.Module):
+    # Florence-2's interface around a small random BART, built from a local config so nothing is downloaded
+    def __init__(self):
+        super().__init__()
+        config = transformers.BartConfig(
+            vocab_size=128, d_model=32, encoder_layers=2, decoder_layers=2, encoder_attention_heads=4,
+            decoder_attention_heads=4, encoder_ffn_dim=64, decoder_ffn_dim=64, max_position_embeddings=64,
+            init_std=0.2,
+        )
+        self.language_model = transformers.BartForConditionalGeneration(config)
+        self.language_model.generation_config = transformers.GenerationConfig(
+            decoder_start_token_id=2, bos_token_id=0, eos_token_id=2, pad_token_id=1, forced_bos_token_id=0,
+            forced_eos_token_id=2, no_repeat_ngram_size=3, length_penalty=1.0, early_stopping=True,
+        )
+        self.patches = torch.nn.Conv2d(3, 32, kernel_size=8, stride=8)
+
+    def get_input_embeddings(self):
+        return self.language_model.get_input_embeddings()
+
+    def _encode_image(self, pixel_values):
+        return self.patches(pixel_values).flatten(2).transpose(1, 2)
+
+    def _merge_input_ids_with_image_features(self, image_features, inputs_embeds):
+        embeds = torch.cat([image_features, inputs_embeds], dim=1)
+        return embeds, torch.ones(embeds.shape[:2], dtype=torch.long)
+
+    def generate(self, input_ids, pixel_values=None, inputs_embeds=None, **generate_kwargs):
+        if inputs_embeds is None:
+            inputs_embeds = self.get_input_embeddings()(input_ids)
+            inputs_embeds, _ = self._merge_input_ids_with_image_features(self._encode_image(pixel_values), inputs_embeds)
+        attention_mask = torch.ones(inputs_embeds.shape[:2], dtype=torch.long)
+        return self.language_model.generate(inputs_embeds=inputs_embeds, attention_mask=attention_mask, **generate_kwargs)
+
+
+@pytest.fixture(scope="module")
+def models(tmp_path_factory):
+    torch.manual_seed(0)
+    model = TinyFlorence().eval()
+    directory = str(tmp_path_factory.mktemp("onnx"))
+    export_onnx(model, directory, image_size=IMAGE_SIZE, prompt_length=len(PROMPT))
+    return model, OnnxFlorence(directory)
+
+
+def _strip(sequence, pad_token_id=1):
+    tokens = [int(token) for token in sequence]
+    while tokens and tokens[-1] == pad_token_id:
+        tokens.pop()
+    return tokens
+
+
+@pytest.mark.parametrize("num_beams", [1, 3])
+def test_onnx_decoding_matches_eager_generate(models, num_beams):
+    model, runtime = models
+    torch.manual_seed(1)
+    pixel_values = torch.randn(2, 3, IMAGE_SIZE, IMAGE_SIZE)
+    input_ids = torch.tensor([PROMPT, PROMPT])
+    generate_kwargs = {"max_new_tokens": 12, "num_beams": num_beams, "do_sample": False}
+
+    with torch.inference_mode():
+        expected = model.generate(input_ids=input_ids, pixel_values=pixel_values, **generate_kwargs)
+    actual = runtime.generate(input_ids.numpy(), pixel_values.numpy(), **generate_kwargs)
+
+    assert [_strip(row) for row in actual] == [_strip(row) for row in expected]